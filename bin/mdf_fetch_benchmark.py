@@ -0,0 +1,44 @@
+"""
+Micro-benchmark for the overhead of getting node values.
+
+Times a node that fetches the value of another, already evaluated, node
+many times so the time is dominated by the cost of the fetch itself
+(activating the context, finding the calling node and recording the
+dependency).
+
+usage: python mdf_fetch_benchmark.py [num_fetches]
+"""
+from mdf import MDFContext, varnode, evalnode
+from datetime import datetime
+import time
+import sys
+
+num_fetches = 1000000
+
+X = varnode(default=1.0)
+
+@evalnode
+def fetch_nodes():
+    x = X
+    for i in xrange(num_fetches):
+        x()
+    return num_fetches
+
+def main():
+    global num_fetches
+    if len(sys.argv) > 1:
+        num_fetches = int(sys.argv[1])
+
+    ctx = MDFContext(datetime(2000, 1, 1))
+    ctx[X]
+
+    start = time.time()
+    ctx[fetch_nodes]
+    elapsed = time.time() - start
+
+    print "%d fetches in %.3fs (%.0fns per fetch)" % (num_fetches,
+                                                     elapsed,
+                                                     elapsed * 1e9 / num_fetches)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Micro-benchmark for the per-timestep overhead of custom node types.
+
+Times advancing the date on a context with many nansumnode and
+returnsnode nodes (implemented as MDFKernels) and the same number of
+nodes using an equivalent node type written as a plain python
+MDFIterator, for float values and for small arrays. The best of
+several runs is reported.
+
+usage: python mdf_kernel_benchmark.py [num_nodes] [num_dates]
+"""
+from mdf import MDFContext, evalnode, nodetype, nansumnode, returnsnode
+from mdf.nodes import MDFIterator
+import pandas as pa
+import numpy as np
+import time
+import sys
+
+num_nodes = 200
+num_dates = 250
+
+class _pynansumnode(MDFIterator):
+    """nansum written as a python MDFIterator for comparison"""
+    def __init__(self, value):
+        self.is_float = not isinstance(value, np.ndarray)
+        if self.is_float:
+            self.accum = np.nan
+        else:
+            self.accum = np.empty(value.shape)
+            self.accum.fill(np.nan)
+        self.send(value)
+
+    def next(self):
+        return self.accum if self.is_float else self.accum.copy()
+
+    def send(self, value):
+        if self.is_float:
+            if value == value:
+                if self.accum != self.accum:
+                    self.accum = 0.0
+                self.accum += value
+            return self.accum
+        mask = ~np.isnan(value)
+        self.accum[np.isnan(self.accum) & mask] = 0.0
+        self.accum[mask] += value[mask]
+        return self.accum.copy()
+
+pynansumnode = nodetype(_pynansumnode)
+
+@evalnode
+def float_value():
+    i = 0.0
+    while True:
+        i += 1.0
+        yield i
+
+@evalnode
+def array_value():
+    i = 0.0
+    while True:
+        i += 1.0
+        yield np.arange(10.0) + i
+
+def _make_nodes(node_type, value_node, prefix):
+    nodes = []
+    for i in range(num_nodes):
+        func = lambda: value_node()
+        func.__name__ = "%s_%s_%d" % (prefix, value_node.short_name, i)
+        nodes.append(node_type(func))
+    return nodes
+
+def _time(nodes, dates, repeats=5):
+    """returns the best time in microseconds per node per timestep"""
+    best = None
+    for i in range(repeats):
+        ctx = MDFContext(dates[0])
+        for node in nodes:
+            ctx[node]
+
+        start = time.time()
+        for date in dates[1:]:
+            ctx.set_date(date)
+        elapsed = time.time() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1e6 / (len(dates) - 1) / len(nodes)
+
+def main():
+    global num_nodes, num_dates
+    if len(sys.argv) > 1:
+        num_nodes = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        num_dates = int(sys.argv[2])
+
+    dates = pa.bdate_range("2000-01-01", periods=num_dates)
+    for value_node in (float_value, array_value):
+        for name, node_type in (("nansumnode", nansumnode),
+                                ("returnsnode", returnsnode),
+                                ("python nansum", pynansumnode)):
+            nodes = _make_nodes(node_type, value_node, name.replace(" ", "_"))
+            print "%-14s %-12s %.2fus per node per timestep" % (name,
+                                                               value_node.short_name,
+                                                               _time(nodes, dates))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Benchmark for the custom Pyro serializer.
+
+Times serializing and deserializing a large array and DataFrame using
+bz2 compressed pickles and using the out of band format where the
+numpy buffers are sent separately from the pickle stream. The best of
+several runs is reported.
+
+usage: python mdf_serializer_benchmark.py [num_rows] [repeats]
+"""
+from mdf.remote.serializer import Serializer
+import pandas as pa
+import numpy as np
+import time
+import sys
+
+num_rows = 1000000
+repeats = 5
+
+def _time(serializer, data, repeats):
+    """returns the best serialize and deserialize times and the message size"""
+    best_serialize, best_deserialize = None, None
+    for i in range(repeats):
+        start = time.time()
+        serialized, compressed = serializer.serialize(data)
+        mid = time.time()
+        serializer.deserialize(serialized, compressed)
+        end = time.time()
+
+        if best_serialize is None or mid - start < best_serialize:
+            best_serialize = mid - start
+        if best_deserialize is None or end - mid < best_deserialize:
+            best_deserialize = end - mid
+    return best_serialize, best_deserialize, len(serialized)
+
+def main():
+    global num_rows, repeats
+    if len(sys.argv) > 1:
+        num_rows = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        repeats = int(sys.argv[2])
+
+    array = np.random.rand(num_rows)
+    df = pa.DataFrame({"x" : array, "y" : np.arange(num_rows)})
+    data = [array, df]
+
+    serializer = Serializer()
+    prev_out_of_band = Serializer._out_of_band
+    try:
+        for out_of_band in (False, True):
+            Serializer._out_of_band = out_of_band
+            print "%-12s serialize %.3fs, deserialize %.3fs, %d bytes" % (
+                        (("out of band" if out_of_band else "bz2"),)
+                        + _time(serializer, data, repeats))
+    finally:
+        Serializer._out_of_band = prev_out_of_band
+
+if __name__ == "__main__":
+    main()
@@ -28,19 +28,33 @@ __all__ = [
     "rowiternode",
     "datanode",
     "filternode",
+    "asyncdatanode",
     "applynode",
+    "panelnode",
+    "Universe",
+    "PanelArray",
+    "non_vectorizable",
     "now",
     "enable_trace",
+    "keep_history",
+    "set_history_options",
     "run",
+    "run_partitioned",
     "to_csv",
     "build_dataframe",
     "get_final_values",
     "plot",
     "scenario",
+    "sweep",
     "plot_surface",
     "heatmap",
+    "replay",
+    "ReplayRecorder",
+    "NodeCache",
+    "set_default_node_cache",
     "CSVWriter",
     "DataFrameBuilder",
+    "MemorySampler",
     "NodeLogger",
 
     # settings
@@ -68,7 +82,12 @@ from .nodes import (
     vargroup,
     evalnode,
     now,
-    enable_trace
+    enable_trace,
+    keep_history,
+)
+
+from .history import (
+    set_history_options,
 )
 
 from .nodetypes import (
@@ -82,25 +101,49 @@ from .nodetypes import (
     rowiternode,
     datanode,
     filternode,
+    asyncdatanode,
     applynode,
+    panelnode,
     lookaheadnode,
 )
 
+from .universe import (
+    Universe,
+    PanelArray,
+)
+
+from .vectorize import (
+    non_vectorizable,
+)
+
 from .runner import (
     run,
+    run_partitioned,
     to_csv,
     plot,
     scenario,
+    sweep,
     plot_surface,
     heatmap,
     build_dataframe,
     get_final_values
 )
 
+from .replay import (
+    replay,
+    ReplayRecorder,
+)
+
+from .cache import (
+    NodeCache,
+    set_default_node_cache,
+)
+
 from .builders import (
     CSVWriter,
     DataFrameBuilder,
     FinalValueCollector,
+    MemorySampler,
     NodeLogger,
 )
 
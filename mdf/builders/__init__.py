@@ -7,6 +7,7 @@ __all__ = [
     "CSVWriter",
     "DataFrameBuilder",
     "FinalValueCollector",
+    "MemorySampler",
     "NodeLogger",
 ]
 
@@ -4,6 +4,7 @@ Basic commonly used builder classes
 import numpy as np
 import pandas as pa
 from ..nodes import MDFNode, MDFEvalNode
+from ..universe import PanelArray
 from collections import deque, defaultdict
 import datetime
 import operator
@@ -143,6 +144,10 @@ def _pairs_to_node_label_lists(node_label_pairs):
     # return ([node,...], [label,...])
     return map(list, zip(*results))
 
+class _RowBuffer(list):
+    """list of rows used in place of a csv writer"""
+    writerow = list.append
+
 class CSVWriter(object):
     """
     callable object that appends values to a csv file
@@ -163,6 +168,8 @@ class CSVWriter(object):
         # can be closed.
         self.fh = fh
         self.open_fhs = []
+        self.headers_written = set()
+        self._buffered = False
 
         # fh may be either a file handle, a filename or a node
         # that evaluates to a file handle or name.
@@ -191,6 +198,29 @@ class CSVWriter(object):
     def __del__(self):
         self.close()
 
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if self._buffered:
+            # the handlers are bound methods so are recreated after unpickling
+            state["handlers"] = None
+        return state
+
+    def _buffered_copy(self):
+        """
+        returns a copy of this writer that keeps the rows in memory instead
+        of writing them, so they can be written by this writer using
+        append_result (used by mdf.run_partitioned).
+        """
+        copy = CSVWriter.__new__(CSVWriter)
+        copy.__dict__.update(self.__dict__)
+        copy.fh = self.fh if isinstance(self.fh, MDFNode) else None
+        copy.open_fhs = []
+        copy.handlers = None
+        copy.writers = defaultdict(_RowBuffer)
+        copy.headers_written = set()
+        copy._buffered = True
+        return copy
+
     def close(self):
         """closes any file handles opened by this writer"""
         while self.open_fhs:
@@ -201,20 +231,10 @@ class CSVWriter(object):
     def __call__(self, date, ctx):
         # get the node values from the context
         values = [ctx.get_value(node) for node in self.nodes]
+        values = [v.to_series() if isinstance(v, PanelArray) else v for v in values]
 
-        # get the writer from the context, or create it if it's not been
-        # created already.
         ctx_id = ctx.get_id()
-        try: 
-            writer = self.writers[ctx_id]
-        except KeyError:
-            fh = self.fh
-            if isinstance(fh, MDFNode):
-                fh = ctx.get_value(fh)
-            if isinstance(fh, basestring):
-                fh = open(fh, "wb")
-                self.open_fhs.append(fh)
-            writer = self.writers[ctx_id] = csv.writer(fh)
+        writer = self._get_writer(ctx)
 
         # figure out how to handle them and what to write in the header
         if self.handlers is None:
@@ -236,6 +256,7 @@ class CSVWriter(object):
 
             # write the header
             writer.writerow(header)
+            self.headers_written.add(ctx_id)
 
         # format the values and write the row
         row = [date]
@@ -243,6 +264,47 @@ class CSVWriter(object):
             handler(value, row)
         writer.writerow(row)
 
+    def _get_writer(self, ctx):
+        # get the writer from the context, or create it if it's not been
+        # created already.
+        ctx_id = ctx.get_id()
+        try: 
+            return self.writers[ctx_id]
+        except KeyError:
+            fh = self.fh
+            if isinstance(fh, MDFNode):
+                fh = ctx.get_value(fh)
+            if isinstance(fh, basestring):
+                fh = open(fh, "wb")
+                self.open_fhs.append(fh)
+            writer = self.writers[ctx_id] = csv.writer(fh)
+            return writer
+
+    def append_result(self, other, other_ctx, ctx, start_date=None):
+        """
+        Writes the rows kept by a buffered copy of this writer for a later
+        range of dates to the file for ctx. Any rows before start_date
+        are ignored.
+        """
+        other_ctx_id = other_ctx if isinstance(other_ctx, int) else other_ctx.get_id()
+        rows = other.writers.get(other_ctx_id)
+        if not rows:
+            return
+
+        header = None
+        if other_ctx_id in other.headers_written:
+            header, rows = rows[0], rows[1:]
+
+        writer = self._get_writer(ctx)
+        ctx_id = ctx.get_id()
+        if header is not None and ctx_id not in self.headers_written:
+            writer.writerow(header)
+            self.headers_written.add(ctx_id)
+
+        for row in rows:
+            if start_date is None or row[0] >= start_date:
+                writer.writerow(row)
+
     def _write_basetype(self, value, row):
         row.append(value)
 
@@ -391,6 +453,8 @@ class DataFrameBuilder(object):
         ctx_list = self.contexts or ([ctx] * len(self.nodes))
         for ctx_, node in zip(ctx_list, self.nodes):
             node_value = ctx_.get_value(node)
+            if isinstance(node_value, PanelArray):
+                node_value = node_value.to_series()
             handler_dict = self.context_handler_dict.setdefault(ctx.get_id(), {})
 
             key = (node.name, node.short_name, ctx_.get_id())
@@ -587,6 +651,42 @@ class DataFrameBuilder(object):
 
         self._cached_dataframes[ctx_id] = other.get_dataframe(other_ctx_id)
 
+    def append_result(self, other, other_ctx, ctx, start_date=None):
+        """
+        Appends a result from another df builder for a later range of
+        dates to this builder's result for ctx. Any rows in the other
+        result before start_date are ignored.
+
+        If not already finalized this method will call finalize and
+        so no more data can be collected after this is called.
+        """
+        ctx_id = ctx if isinstance(ctx, int) else ctx.get_id()
+        other_ctx_id = other_ctx if isinstance(other_ctx, int) else other_ctx.get_id()
+
+        if not self._finalized:
+            self.finalize()
+
+        # update self.nodes with any nodes from the other
+        nodes = set(self.nodes)
+        other_nodes = set(other.nodes)
+        additional_nodes = other_nodes.difference(nodes)
+        self.nodes += list(additional_nodes)
+
+        # the columns may be different if any nodes return dicts or series
+        for node in other.nodes:
+            columns = list(self._cached_columns.get((ctx_id, node), []))
+            columns += [c for c in other.get_columns(node, other_ctx_id) if c not in columns]
+            self._cached_columns[(ctx_id, node)] = columns
+
+        df = other.get_dataframe(other_ctx_id)
+        if start_date is not None:
+            df = df[df.index >= start_date]
+
+        prev_df = self._cached_dataframes.get(ctx_id)
+        if prev_df is not None:
+            df = pa.concat([prev_df, df])
+        self._cached_dataframes[ctx_id] = df
+
 class FinalValueCollector(object):
     """
     callable object that collects the final values for a set of nodes.
@@ -611,6 +711,20 @@ class FinalValueCollector(object):
         self.__values.clear()
         self.__contexts = []
 
+    def append_result(self, other, other_ctx, ctx, start_date=None):
+        """
+        Updates the values for ctx with the values collected by another
+        collector for a later range of dates.
+        """
+        values = other.get_values(other_ctx)
+        if values is None:
+            return
+
+        ctx_id = ctx if isinstance(ctx, int) else ctx.get_id()
+        self.__values[ctx_id] = values
+        if ctx_id not in self.__contexts:
+            self.__contexts.append(ctx_id)
+
     def get_values(self, ctx=None):
         """returns the collected values for a context"""
         if not self.__values:
@@ -639,6 +753,60 @@ class FinalValueCollector(object):
         ctx_id = self.__contexts[-1]
         return self.get_values(ctx_id)
 
+class MemorySampler(object):
+    """
+    callable object that samples the estimated memory held by the nodes
+    in each context. For use with mdf.run to find which nodes or shifted
+    contexts grow over the course of a run.
+    """
+
+    def __init__(self, period=1, builders=None):
+        """
+        ``period`` is the number of timesteps between samples
+        ``builders`` is an optional list of other builders to include in the samples
+        """
+        self.period = period
+        self.builders = builders
+        self.__samples = {}
+        self.__counts = {}
+        self.__last_report = None
+
+    def __call__(self, date, ctx):
+        ctx_id = ctx.get_id()
+        count = self.__counts.get(ctx_id, 0)
+        self.__counts[ctx_id] = count + 1
+        if count % self.period:
+            return
+
+        report = ctx.memory_report(include_shifted=False, builders=self.builders)
+        self.__samples.setdefault(ctx_id, []).append((date, report.total))
+        self.__last_report = report
+
+    def clear(self):
+        """clears all previously collected samples"""
+        self.__samples.clear()
+        self.__counts.clear()
+        self.__last_report = None
+
+    @property
+    def last_report(self):
+        """the most recent MemoryReport"""
+        return self.__last_report
+
+    def get_series(self, ctx):
+        """returns the sampled total bytes for a context as a pandas Series"""
+        ctx_id = ctx if isinstance(ctx, int) else ctx.get_id()
+        samples = self.__samples.get(ctx_id, [])
+        return pa.Series([x for d, x in samples],
+                         index=[d for d, x in samples],
+                         dtype=np.int64)
+
+    @property
+    def dataframe(self):
+        """returns a dataframe of the sampled total bytes with a column per context id"""
+        return pa.DataFrame(dict([(ctx_id, self.get_series(ctx_id))
+                                  for ctx_id in self.__samples]))
+
 class NodeLogger(object):
     """
     callable object for use with mdf run that logs a message
@@ -0,0 +1,412 @@
+"""
+Persistent cache of node values, used by evalnodes created with the
+cache option (see :py:func:`mdf.evalnode`).
+
+Values are stored in a sqlite database keyed by the node name, a
+fingerprint of the code of the node and the evalnodes it depends on, and
+the values of the varnodes (including :py:func:`now`) and shifted nodes it
+depends on. The nodes a node depends on are found the first time it's
+evaluated and stored with the cache, so the key can be worked out before
+evaluating the node in later runs.
+
+New values and the times values were last used are written to the
+database in batches, in a single transaction, when enough have built up,
+at the end of each :py:func:`mdf.run` and when the process exits.
+
+A cache may be used from several threads. Each thread has its own
+connection to the database.
+"""
+from .nodes import MDFNode, MDFVarNode, MDFEvalNode
+from .ctx_pickle import _get_node, MissingNodeError
+import cPickle
+import hashlib
+import logging
+import sqlite3
+import tempfile
+import threading
+import weakref
+import atexit
+import types
+import time
+import json
+import os
+
+_log = logging.getLogger(__name__)
+
+# returned by _get_cached_value when there's no cached value
+_cache_miss = object()
+
+_default_cache = None
+
+# all caches, so any pending writes can be flushed
+_caches = weakref.WeakSet()
+
+# pending writes are flushed when there are more than this many, or more
+# than this many bytes of values
+_max_pending_entries = 1000
+_max_pending_bytes = 64 << 20
+
+class NodeCache(object):
+    """
+    Cache of node values stored on disk in a sqlite database at path.
+
+    If max_size is set the least recently used values are removed when the
+    total size of the pickled values exceeds max_size bytes.
+
+    Nodes using a cache must only depend on varnodes, the current date and
+    other nodes in the same context, and not on any nodes that are updated
+    incrementally.
+    """
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self.__local = threading.local()
+        self.__lock = threading.RLock()
+        self.__pid = None
+        self.__size = None
+        self.__fingerprints = {}
+        self.__inputs = {}
+        self.__pending_entries = {}
+        self.__pending_bytes = 0
+        self.__pending_last_used = {}
+        _caches.add(self)
+
+    def __del__(self):
+        try:
+            self.flush()
+        except Exception:
+            _log.warn("Failed to write pending values to %s" % self.path, exc_info=True)
+
+    def __getstate__(self):
+        return {"path" : self.path, "max_size" : self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["max_size"])
+
+    def _connect(self):
+        # sqlite connections can't be shared between threads or with forked
+        # processes, so there's one per thread and process
+        local = self.__local
+        pid = os.getpid()
+        if getattr(local, "conn", None) is None or local.pid != pid:
+            local.conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            local.conn.execute("CREATE TABLE IF NOT EXISTS inputs ("
+                               "   node TEXT PRIMARY KEY,"
+                               "   inputs TEXT)")
+            local.conn.execute("CREATE TABLE IF NOT EXISTS entries ("
+                               "   key TEXT PRIMARY KEY,"
+                               "   value BLOB,"
+                               "   size INTEGER,"
+                               "   last_used REAL)")
+            local.conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+            local.pid = pid
+            with self.__lock:
+                if self.__pid != pid:
+                    # a forked process works out the size of the cache again
+                    self.__pid = pid
+                    self.__size = None
+        return local.conn
+
+    def flush(self):
+        """writes any pending values and last used times to the database"""
+        with self.__lock:
+            if not self.__pending_entries and not self.__pending_last_used:
+                return
+
+            entries, self.__pending_entries = self.__pending_entries, {}
+            last_used, self.__pending_last_used = self.__pending_last_used, {}
+            self.__pending_bytes = 0
+
+            conn = self._connect()
+            conn.execute("BEGIN")
+            try:
+                conn.executemany("INSERT OR REPLACE INTO entries (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                                 [(key, sqlite3.Binary(data), len(data), t)
+                                  for key, (data, t) in entries.iteritems()])
+                conn.executemany("UPDATE entries SET last_used = ? WHERE key = ?",
+                                 [(t, key) for key, t in last_used.iteritems() if key not in entries])
+            except:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def clear(self):
+        """removes all values from the cache"""
+        with self.__lock:
+            self.__pending_entries.clear()
+            self.__pending_last_used.clear()
+            self.__pending_bytes = 0
+            conn = self._connect()
+            conn.execute("DELETE FROM entries")
+            conn.execute("DELETE FROM inputs")
+            self.__size = 0
+            self.__inputs.clear()
+
+    def size(self):
+        """returns the total size of the values in the cache in bytes"""
+        with self.__lock:
+            self.flush()
+            conn = self._connect()
+            self.__size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            return self.__size
+
+    def __len__(self):
+        with self.__lock:
+            self.flush()
+            return self._connect().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def _get_node_key(self, node):
+        """returns the name of a node combined with a fingerprint of its code"""
+        fingerprint = self.__fingerprints.get(node)
+        if fingerprint is None:
+            sha = hashlib.sha1()
+            _add_code_fingerprint(sha, node.func)
+            fingerprint = self.__fingerprints[node] = "%s:%s" % (node.name, sha.hexdigest())
+        return fingerprint
+
+    def _get_inputs(self, node):
+        """returns the list of nodes node was found to depend on, or None"""
+        node_key = self._get_node_key(node)
+        inputs = self.__inputs.get(node_key)
+        if inputs is None:
+            with self.__lock:
+                row = self._connect().execute("SELECT inputs FROM inputs WHERE node = ?",
+                                              (node_key,)).fetchone()
+            if row is None:
+                return None
+            try:
+                inputs = [_get_node(name, is_bound) for name, is_bound in json.loads(row[0])]
+            except MissingNodeError:
+                return None
+            self.__inputs[node_key] = inputs
+        return inputs
+
+    def _set_inputs(self, node, inputs):
+        node_key = self._get_node_key(node)
+        # the order the inputs are stored in is the order they're added to the key
+        inputs = sorted(inputs, key=lambda n: (n.name, n.is_bound))
+        names = [(n.name, n.is_bound) for n in inputs]
+        with self.__lock:
+            self._connect().execute("INSERT OR REPLACE INTO inputs (node, inputs) VALUES (?, ?)",
+                                    (node_key, json.dumps(names)))
+            self.__inputs[node_key] = inputs
+
+    def _get_key(self, node, ctx, inputs):
+        """
+        returns the key for the value of node in ctx, or None if the
+        input values can't be used as a key. This evaluates any varnodes
+        node depends on, which also adds them as dependencies of node.
+        """
+        sha = hashlib.sha1(self._get_node_key(node))
+        shift_set = ctx.get_shift_set()
+        try:
+            for input_node in inputs:
+                if isinstance(input_node, MDFVarNode):
+                    value = input_node()
+                elif input_node in shift_set:
+                    value = shift_set[input_node]
+                else:
+                    # changing the code of an evalnode this node depends on
+                    # changes the value as well
+                    if isinstance(input_node, MDFEvalNode):
+                        sha.update(self._get_node_key(input_node))
+                    continue
+                sha.update(input_node.name)
+                if isinstance(value, MDFNode):
+                    sha.update("node:" + value.name)
+                else:
+                    sha.update(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+        except (cPickle.PicklingError, TypeError):
+            _log.debug("Can't create cache key for %s[%s]" % (node.name, ctx))
+            return None
+        return sha.hexdigest()
+
+    def get(self, node, ctx):
+        """returns the cached value of node in ctx or _cache_miss"""
+        inputs = self._get_inputs(node)
+        if inputs is None:
+            return _cache_miss
+
+        key = self._get_key(node, ctx, inputs)
+        if key is None:
+            return _cache_miss
+
+        with self.__lock:
+            pending = self.__pending_entries.get(key)
+            if pending is not None:
+                data = pending[0]
+            else:
+                row = self._connect().execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return _cache_miss
+                data = str(row[0])
+                self.__pending_last_used[key] = time.time()
+                self.__flush_if_needed()
+
+        # add the dependencies the node would have had if it had been evaluated
+        # (the varnodes have been added by _get_key already)
+        if ctx.get_parent() is None:
+            for input_node in inputs:
+                if not isinstance(input_node, MDFVarNode):
+                    node.add_dependency(ctx, input_node, ctx)
+
+        return cPickle.loads(data)
+
+    def put(self, node, ctx, value):
+        """adds the value of node in ctx to the cache"""
+        inputs = _find_inputs(node, ctx)
+        if inputs is None:
+            _log.debug("Not caching %s[%s] as it depends on nodes that can't be cached" % (node.name, ctx))
+            return
+
+        # the inputs are the union of all nodes ever found so values cached
+        # previously can still be found if the node has conditional dependencies
+        prev_inputs = self._get_inputs(node) or []
+        if not inputs.issubset(prev_inputs):
+            inputs.update(prev_inputs)
+            self._set_inputs(node, inputs)
+        inputs = self._get_inputs(node)
+
+        key = self._get_key(node, ctx, inputs)
+        if key is None:
+            return
+
+        try:
+            data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        except (cPickle.PicklingError, TypeError):
+            _log.debug("Not caching %s[%s] as its value can't be pickled" % (node.name, ctx))
+            return
+
+        with self.__lock:
+            prev = self.__pending_entries.get(key)
+            if prev is not None:
+                self.__pending_bytes -= len(prev[0])
+            self.__pending_entries[key] = (data, time.time())
+            self.__pending_bytes += len(data)
+            self.__flush_if_needed()
+
+            if self.max_size is not None:
+                if self.__size is None:
+                    self.size()
+                else:
+                    self.__size += len(data)
+                if self.__size > self.max_size:
+                    self._evict()
+
+    def __flush_if_needed(self):
+        if len(self.__pending_entries) + len(self.__pending_last_used) > _max_pending_entries \
+        or self.__pending_bytes > _max_pending_bytes:
+            self.flush()
+
+    def _evict(self):
+        """removes the least recently used values until the cache is below max_size"""
+        with self.__lock:
+            self.flush()
+            conn = self._connect()
+            excess = self.size() - self.max_size
+            if excess <= 0:
+                return
+
+            keys = []
+            for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_used"):
+                keys.append(key)
+                excess -= size
+                if excess <= 0:
+                    break
+
+            conn.execute("DELETE FROM entries WHERE key IN (%s)" % ",".join("?" * len(keys)), keys)
+            self.size()
+
+def _add_code_fingerprint(sha, func):
+    """adds a function's code to the sha1 object"""
+    func = getattr(func, "__func__", func)
+    code = getattr(func, "__code__", None)
+    if code is None:
+        sha.update(repr(func))
+        return
+
+    def add_code(code):
+        sha.update(code.co_code)
+        sha.update(repr(code.co_names))
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                add_code(const)
+            else:
+                sha.update(repr(const))
+
+    add_code(code)
+    sha.update(repr(getattr(func, "__defaults__", None)))
+
+def _find_inputs(node, ctx):
+    """
+    returns the set of nodes node depends on in ctx, or None if
+    it depends on anything that prevents it from being cached.
+    """
+    inputs = set()
+    seen = set()
+    remaining = [(node, ctx)]
+    while remaining:
+        caller, caller_ctx = remaining.pop()
+        for dependency, dependency_ctx in caller.get_dependencies(caller_ctx):
+            if (dependency, dependency_ctx) in seen:
+                continue
+            seen.add((dependency, dependency_ctx))
+
+            # nodes in other contexts or that are updated incrementally
+            # can't be re-created from the inputs alone
+            if dependency_ctx is not ctx and not ctx.is_shift_of(dependency_ctx):
+                return None
+            if isinstance(dependency, MDFEvalNode) \
+            and dependency.has_timestep_update(dependency_ctx):
+                return None
+
+            inputs.add(dependency)
+            remaining.append((dependency, dependency_ctx))
+
+    return inputs
+
+def flush_node_caches():
+    """
+    Writes any values added to any :py:class:`NodeCache` that haven't
+    been written to disk yet. This is called at the end of each
+    :py:func:`mdf.run` and when the process exits.
+    """
+    for cache in list(_caches):
+        try:
+            cache.flush()
+        except sqlite3.Error:
+            _log.error("Failed to write pending values to %s" % cache.path, exc_info=True)
+
+atexit.register(flush_node_caches)
+
+def set_default_node_cache(cache):
+    """
+    Sets the :py:class:`NodeCache` used by evalnodes created with cache=True.
+    """
+    global _default_cache
+    if _default_cache is not None and _default_cache is not cache:
+        _default_cache.flush()
+    _default_cache = cache
+
+def get_default_node_cache():
+    """
+    Returns the :py:class:`NodeCache` used by evalnodes created with cache=True.
+    Unless set by :py:func:`set_default_node_cache` this is a cache in the
+    system temp directory limited to 1GB.
+    """
+    global _default_cache
+    if _default_cache is None:
+        path = os.path.join(tempfile.gettempdir(), "mdf_node_cache.sqlite")
+        _default_cache = NodeCache(path, max_size=1 << 30)
+    return _default_cache
+
+def _get_cached_value(node, cache, ctx):
+    if cache is True:
+        cache = get_default_node_cache()
+    return cache.get(node, ctx)
+
+def _cache_value(node, cache, ctx, value):
+    if cache is True:
+        cache = get_default_node_cache()
+    cache.put(node, ctx, value)
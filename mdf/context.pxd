@@ -10,10 +10,12 @@ cdef extern from "Python.h":
 cdef class MDFContext
 cdef class MDFNodeBase
 cdef class ShiftSet
+cdef class ThreadState
 
 # globals
 cdef:
-    dict _current_contexts
+    dict _thread_states
+    ThreadState _last_thread_state
     dict _all_nodes
     int _profiling_enabled
 
@@ -47,9 +49,21 @@ cdef class NodeOrBuilderTimer(object):
 
 cpdef int _profiling_is_enabled()
 
-cdef class Cookie(object):
-    cdef object thread_id
-    cdef MDFContext prev_context
+cdef class ThreadState(object):
+    cdef long thread_id
+    cdef MDFContext current
+    cdef dict eval_stacks
+
+cdef ThreadState _get_thread_state(thread_id=?)
+
+cdef class _EvalLock(object):
+    cdef object lock
+    cdef object num_pending_lock
+    cdef int num_pending
+
+    cdef add_pending(self, int count)
+    cdef bint acquire_if_pending(self, ThreadState thread_state) except -1
+cdef inline cqueue _get_eval_stack(MDFContext ctx, ThreadState thread_state)
 
 cdef class NowNodeValue(object):
     cdef object value
@@ -57,6 +71,7 @@ cdef class NowNodeValue(object):
 cdef class MDFNodeBase(object):
     cdef bint _has_set_date_callback
     cdef bint _has_timestep_update
+    cdef bint _keep_history
 
     #
     # subset of MDFNode C methods used by MDFContext
@@ -103,6 +118,33 @@ cdef class MDFContext(object):
     cdef dict _nodes_requiring_set_date_callback
     cdef int _has_nodes_requiring_set_date_callback
 
+    # updated by MDFNode when a NodeState is created or cleared for this context
+    cdef dict _nodes_with_state
+
+    # incremented by MDFNode when a new dependency is added in this context
+    cdef int _dependency_version
+
+    # see freeze_dependencies
+    cdef int _dependencies_frozen
+    cdef int _verify_dependencies
+    cdef int _freeze_after_steps
+    cdef int _stable_steps
+    cdef int _last_dependency_version
+
+    # nodes that could depend on this context's shifts (see nodes._get_affected_nodes)
+    cdef object _affected_nodes
+    cdef int _affected_nodes_version
+
+    # values of nodes with history enabled (see MDFContext.history)
+    cdef dict _node_histories
+
+    # held while evaluating nodes asynchronously (see get_value_async),
+    # shared by a root context and all its shifted contexts
+    cdef _EvalLock _eval_lock
+
+    # used to evaluate independent nodes concurrently (see set_timestep_pool)
+    cdef object _timestep_pool
+
     cdef _init(self, now,
                MDFContext _shift_parent=?,
                _shift_set=?,
@@ -113,11 +155,14 @@ cdef class MDFContext(object):
     #
     cdef Timer _start_timer(self, object node)
     cdef Timer _stop_timer(self)
-    cdef MDFNodeBase _get_calling_node(self, MDFContext prev_ctx=?)
+    cdef MDFNodeBase _get_calling_node(self, MDFContext prev_ctx=?, ThreadState thread_state=?)
     cdef MDFContext _shift(MDFContext self, shift_set, int cache_context=?)
-    cdef Cookie _activate(self, MDFContext prev_ctx=?, thread_id=?)
-    cdef _deactivate(self, Cookie cookie)
+    cdef MDFContext _activate(self, ThreadState thread_state)
+    cdef _deactivate(self, ThreadState thread_state, MDFContext prev_ctx)
     cdef _set_date(self, date)
+    cdef list _get_timestep_levels(self)
+    cdef _evaluate_levels(self, list levels, ThreadState thread_state, MDFContext prev_ctx)
+    cdef _append_history(self, MDFNodeBase node, value)
 
     # 
     # semi-public C methods used by MDFNode
@@ -132,13 +177,16 @@ cdef class MDFContext(object):
     #
     cpdef _activate_ctx(self, MDFContext prev_ctx=?, thread_id=?)
     cpdef get_value(self, MDFNodeBase node)
+    cdef _get_value(self, MDFNodeBase node)
     cpdef set_value(self, MDFNodeBase node, value)
     cpdef set_override(self, MDFNodeBase node, MDFNodeBase override_node)
+    cpdef history(self, MDFNodeBase node, start=?, end=?)
     cpdef MDFContext get_parent(self)
     cpdef dict get_shift_set(self)
     cpdef list get_shifted_contexts(self)
     cpdef iter_shifted_contexts(self)    
     cpdef set_date(self, date)
+    cpdef set_timestep_pool(self, pool)
     cpdef get_date(self)
     cpdef shift(self, shift_set, cache_context=?)
     cpdef ppstats(self)
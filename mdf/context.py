@@ -5,8 +5,11 @@ from datetime import datetime
 import cython
 import warnings
 import sys
+import threading
+from multiprocessing.pool import ThreadPool
 from .common import DIRTY_FLAGS
 from . import io
+from .history import NodeHistory
 
 # this is usually cimported in context.pxd
 # uncomment if not compiling with Cython
@@ -23,6 +26,7 @@ _python_version = cython.declare(int, sys.version_info[0])
 # imported when MDFContext is constructed
 MDFNode = None
 _now_node = None
+_get_affected_nodes = None
 _pickle_context = None
 _unpickle_context = None
 _pickle_shift_set = None
@@ -59,14 +63,55 @@ class DuplicateNodeError(Exception):
                                 "duplicate nodes to be allowed call "
                                 "mdf.allow_duplicate_nodes().")
 
+class DependenciesFrozenError(Exception):
+    def __init__(self, node, ctx, called_node, called_ctx):
+        Exception.__init__(self,
+                            "New dependency %s[%s] -> %s[%s] added after "
+                            "the dependencies were frozen" % (node.name,
+                                                              ctx,
+                                                              called_node.name,
+                                                              called_ctx))
+
 class NoCurrentContextError(RuntimeError):
     def __init__(self):
         RuntimeError.__init__(self, "No current context")
 
-class Cookie(object):
-    def __init__(self, thread_id, prev_context):
+class ThreadState(object):
+    """the current context for a thread"""
+    def __init__(self, thread_id):
         self.thread_id = thread_id
-        self.prev_context = prev_context
+        self.current = None
+
+        # set while evaluating nodes in a timestep pool so each thread
+        # has its own stack of nodes being evaluated in each context
+        # (see MDFContext.set_timestep_pool)
+        self.eval_stacks = None
+
+class _EvalLock(object):
+    """
+    Lock shared by related contexts, held while evaluating nodes for
+    get_value_async, and the number of those evaluations still pending.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.num_pending_lock = threading.Lock()
+        self.num_pending = 0
+
+    def add_pending(self, count):
+        with self.num_pending_lock:
+            self.num_pending += count
+
+    def acquire_if_pending(self, thread_state):
+        """
+        acquires the lock if any evaluations for get_value_async are pending
+        and returns True, or returns False without acquiring it.
+        Threads evaluating nodes for a timestep pool don't acquire it as
+        the thread calling set_date already holds it.
+        """
+        if self.num_pending == 0 or thread_state.eval_stacks is not None:
+            return False
+        self.lock.acquire()
+        return True
 
 class MDFNodeBase(object):
     """
@@ -111,10 +156,11 @@ class MDFNodeBase(object):
 def _lazy_imports():
     # import MDFNode after this module has been imported
     # to avoid circular import dependencies
-    global MDFNode, _now_node
+    global MDFNode, _now_node, _get_affected_nodes
     import nodes
     MDFNode = nodes.MDFNode
     _now_node = nodes._now_node
+    _get_affected_nodes = nodes._get_affected_nodes
 
     global _pickle_context, _unpickle_context
     import ctx_pickle
@@ -178,9 +224,14 @@ _null_timer = NullTimer()
 # contexts. It gets added to as MDFNode instances are
 # constructed via register_node.
 _all_nodes = cython.declare(dict, {})
-_current_contexts = cython.declare(dict, {})
+_thread_states = cython.declare(dict, {})
+_last_thread_state = None
 _ctx_id_counter = itertools.count()
 
+# pool used by MDFContext.get_value_async, created when first needed
+_default_thread_pool = None
+_default_thread_pool_lock = threading.Lock()
+
 class NowNodeValue:
     """
     the now node is special as it's the only node that may be shifted
@@ -331,7 +382,18 @@ class MDFContext(object):
         self._has_incrementally_updated_nodes = False
         self._nodes_requiring_set_date_callback = {}
         self._has_nodes_requiring_set_date_callback = False
+        self._nodes_with_state = {}
+        self._dependency_version = 0
+        self._dependencies_frozen = False
+        self._verify_dependencies = False
+        self._freeze_after_steps = 0
+        self._stable_steps = 0
+        self._last_dependency_version = 0
+        self._affected_nodes = None
+        self._affected_nodes_version = -1
+        self._node_histories = {}
         self._node_eval_stack = cqueue()
+        self._timestep_pool = None
         self._timers = {}
         self._timer_stack = []
         self._parent = None
@@ -346,6 +408,14 @@ class MDFContext(object):
             while parent._parent is not None:
                 parent = parent._parent
             self._parent = parent
+            self._eval_lock = parent._eval_lock
+
+            # shifted contexts freeze their dependencies once they've stopped
+            # changing if the parent does (see freeze_dependencies)
+            self._freeze_after_steps = parent._freeze_after_steps
+            self._verify_dependencies = parent._verify_dependencies
+        else:
+            self._eval_lock = _EvalLock()
 
         # a context can be 'shifted' which means that it's a shallow copy
         # of an existing context but with one or more values changed.
@@ -398,6 +468,11 @@ class MDFContext(object):
                     or node.get_alt_context(self) is self:
                         self[node] = value
 
+            # find the nodes already evaluated in the parent that could be affected
+            # by the shift. Any other nodes evaluated in the parent context don't
+            # depend on the shift and their alt context is the parent.
+            _get_affected_nodes(self)
+
         # if this context is a root context set the now node's value
         if _shift_parent is None \
         or (len(self._shift_set) == 1 and _now_node in self._shift_set):
@@ -416,11 +491,68 @@ class MDFContext(object):
         """returns a unique id for this context"""
         return self._id
 
+    def freeze_dependencies(self, stable_steps=None, verify=False):
+        """
+        Stops recording the dependencies between nodes as they're evaluated
+        in this context and any contexts shifted from it, which makes getting
+        node values faster.
+
+        This should only be done once all the nodes have been evaluated and
+        the dependencies between them won't change, e.g. after the first few
+        dates of a run. Nodes evaluated for the first time after that won't
+        be updated when the nodes they depend on change.
+
+        If stable_steps is set the dependencies are frozen once no new
+        dependencies have been found for that many dates.
+
+        If verify is True the dependencies are still recorded and
+        DependenciesFrozenError is raised if a new one is found.
+
+        Setting the date to an earlier date unfreezes the dependencies, and if
+        stable_steps is set they're frozen again once they're stable.
+        """
+        ctx = cython.declare(MDFContext)
+        contexts = [self]
+        if self._parent is None:
+            contexts.extend(self._all_child_contexts.values())
+
+        for ctx in contexts:
+            ctx._verify_dependencies = verify
+            ctx._freeze_after_steps = stable_steps or 0
+            ctx._stable_steps = 0
+            ctx._last_dependency_version = ctx._dependency_version
+            ctx._dependencies_frozen = stable_steps is None
+
+    def unfreeze_dependencies(self):
+        """
+        Starts recording the dependencies between nodes again after
+        :py:meth:`freeze_dependencies`.
+        """
+        ctx = cython.declare(MDFContext)
+        contexts = [self]
+        if self._parent is None:
+            contexts.extend(self._all_child_contexts.values())
+
+        for ctx in contexts:
+            ctx._freeze_after_steps = 0
+            ctx._stable_steps = 0
+            ctx._dependencies_frozen = False
+
+    @property
+    def dependencies_frozen(self):
+        """True if the dependencies are frozen (see freeze_dependencies)"""
+        return bool(self._dependencies_frozen)
+
     def clear(self):
         """
         clears all cached data for this context
         """
-        for node in _all_nodes.itervalues():
+        # MDFNode.clear removes the node from _nodes_with_state so
+        # swap in a new dict rather than iterating over the current one
+        nodes_with_state = cython.declare(dict)
+        nodes_with_state = self._nodes_with_state
+        self._nodes_with_state = {}
+        for node in nodes_with_state:
             node.clear(self)
 
         self._incrementally_updated_nodes.clear()
@@ -429,6 +561,12 @@ class MDFContext(object):
         self._nodes_requiring_set_date_callback.clear()
         self._has_nodes_requiring_set_date_callback = False
 
+        self._affected_nodes = None
+
+        for history in self._node_histories.itervalues():
+            history.clear()
+        self._node_histories.clear()
+
         # clear the shifted contexts
         for shifted_ctx in self._shifted_cache.itervalues():
             shifted_ctx.clear()
@@ -447,7 +585,9 @@ class MDFContext(object):
         if not _all_nodes:
             return
         # clear any nodes that have cached state for this context
-        for node in _all_nodes.itervalues():
+        nodes_with_state = self._nodes_with_state
+        self._nodes_with_state = {}
+        for node in nodes_with_state:
             node.clear(self)
 
     def __str__(self):
@@ -540,6 +680,30 @@ class MDFContext(object):
         """
         return self._shift(shift_set, cache_context)
 
+    def _release_shifted_contexts(self, contexts):
+        """
+        removes contexts shifted from this context from its shifted contexts
+        and clears their cached data, so they're no longer updated or
+        returned by :py:meth:`shift`.
+        """
+        parent = cython.declare(MDFContext)
+        parent = self._parent or self
+        ctx = cython.declare(MDFContext)
+
+        released = []
+        for ctx in contexts:
+            if parent._all_child_contexts.pop(ctx._id_obj, None) is None:
+                continue
+            parent._shifted_contexts.pop(ctx, None)
+            if parent._shifted_cache.get(ctx._shift_key) is ctx:
+                del parent._shifted_cache[ctx._shift_key]
+            ctx.clear()
+            released.append(ctx._id_obj)
+
+        for ctx in itertools.chain([parent], parent._all_child_contexts.values()):
+            for ctx_id in released:
+                ctx._is_shift_of_cache.pop(ctx_id, None)
+
     def get_parent(self):
         return self._parent
 
@@ -654,14 +818,14 @@ class MDFContext(object):
         parent = cython.declare(MDFContext)
         prev_ctx = cython.declare(MDFContext)
         shifted_ctx = cython.declare(MDFContext)
-        cookie = cython.declare(Cookie)
+        thread_state = cython.declare(ThreadState)
         node = cython.declare(MDFNodeBase)
+        eval_stack = cython.declare(cqueue)
 
-        # get the prev_ctx and thread_id by activating the current context
-        cookie = self._activate(None, None)
-        thread_id = cookie.thread_id
-        prev_ctx = cookie.prev_context
-        self._deactivate(cookie)
+        # get the current context and thread
+        thread_state = _get_thread_state()
+        thread_id = thread_state.thread_id
+        prev_ctx = thread_state.current
 
         # get a list of all the contexts that are shifted by the same now
         # node as this context
@@ -722,13 +886,14 @@ class MDFContext(object):
 
             for ctx in contexts_with_set_date_callbacks:
                 # get the calling node and activate the context once and for all nodes
-                calling_node = ctx._get_calling_node(prev_ctx)
-                cookie = ctx._activate(prev_ctx, thread_id)
+                calling_node = ctx._get_calling_node(prev_ctx, thread_state)
+                ctx._activate(thread_state)
+                eval_stack = _get_eval_stack(ctx, thread_state)
                 try:
                     # call the callbacks (this may call other nodes and so might
                     # modify the set of nodes with callbacks)
                     for node in ctx._nodes_requiring_set_date_callback.keys():
-                        cqueue_push(ctx._node_eval_stack, node)
+                        cqueue_push(eval_stack, node)
                         try:
                             with ctx._profile(node) as timer:
                                 dirty = node.on_set_date(ctx, date)
@@ -736,9 +901,9 @@ class MDFContext(object):
                                 on_set_date_dirty.append((node, ctx))
                                 on_set_date_dirty_count += 1
                         finally:
-                            cqueue_pop(ctx._node_eval_stack)
+                            cqueue_pop(eval_stack)
                 finally:
-                    ctx._deactivate(cookie)
+                    ctx._deactivate(thread_state, prev_ctx)
 
         # now all the on_set_date callbacks have been called update the date
         # for each context and mark any incrementally updated nodes as dirty.
@@ -746,6 +911,16 @@ class MDFContext(object):
             # set now on the context
             ctx._now = date
 
+            # freeze the dependencies if they've not changed for enough dates
+            if ctx._freeze_after_steps > 0 and not ctx._dependencies_frozen:
+                if ctx._dependency_version == ctx._last_dependency_version:
+                    ctx._stable_steps += 1
+                else:
+                    ctx._stable_steps = 0
+                    ctx._last_dependency_version = ctx._dependency_version
+                if ctx._stable_steps >= ctx._freeze_after_steps:
+                    ctx._dependencies_frozen = True
+
             # mark any incrementally updated nodes as dirty
             if ctx._has_incrementally_updated_nodes:
                 for node in ctx._incrementally_updated_nodes.iterkeys():
@@ -777,6 +952,10 @@ class MDFContext(object):
                 ctx._nodes_requiring_set_date_callback.clear()
                 ctx._has_nodes_requiring_set_date_callback = False
 
+                # the dependencies and callbacks need recording again
+                ctx._dependencies_frozen = False
+                ctx._stable_steps = 0
+
             return
 
         # Evaluate any nodes that have to be updated incrementally each timestep.
@@ -792,15 +971,113 @@ class MDFContext(object):
                 continue
 
             # get the calling node and activate the context once and for all nodes
-            calling_node = ctx._get_calling_node(prev_ctx)
-            cookie = ctx._activate(prev_ctx, thread_id)
-
+            calling_node = ctx._get_calling_node(prev_ctx, thread_state)
+
+            # evaluate independent nodes concurrently if there's a pool for this context
+            if ctx._timestep_pool is not None \
+            and num_contexts == 1 \
+            and calling_node is None \
+            and not _profiling_enabled:
+                levels = ctx._get_timestep_levels()
+                if levels is not None:
+                    ctx._evaluate_levels(levels, thread_state, prev_ctx)
+                    continue
+
+            ctx._activate(thread_state)
             try:
                 # get the value to trigger the update
                 for node in ctx._incrementally_updated_nodes.keys():
                     ctx._get_node_value(node, calling_node, ctx, thread_id)
             finally:
-                ctx._deactivate(cookie)
+                ctx._deactivate(thread_state, prev_ctx)
+
+    def _get_timestep_levels(self):
+        """
+        returns the dirty nodes the incrementally updated nodes depend on
+        (including themselves) grouped into lists of nodes that only depend
+        on nodes in earlier lists, or None if any depend on dirty nodes in
+        other contexts or on nodes in unrelated contexts.
+        """
+        node_levels = {}
+        visited = set()
+        to_process = [(node, False) for node in self._incrementally_updated_nodes.keys()]
+        while to_process:
+            node, dependencies_done = to_process.pop()
+            if dependencies_done:
+                level = 0
+                for dependency, dependency_ctx in node.get_dependencies(self):
+                    dependency_level = node_levels.get(dependency)
+                    if dependency_level is not None and dependency_level >= level:
+                        level = dependency_level + 1
+                node_levels[node] = level
+                continue
+
+            if node in visited:
+                continue
+            visited.add(node)
+
+            # dependencies in contexts that aren't shifts of this context's
+            # parent (e.g. a separate context used by a node) can't be looked up
+            try:
+                dependencies = node.get_dependencies(self)
+            except KeyError:
+                return None
+
+            # nodes are processed after their dirty dependencies
+            to_process.append((node, True))
+            for dependency, dependency_ctx in dependencies:
+                if not dependency.is_dirty(dependency_ctx):
+                    continue
+                if dependency_ctx is not self:
+                    return None
+                if dependency not in visited:
+                    to_process.append((dependency, False))
+
+        levels = [[] for i in range(max(node_levels.itervalues()) + 1)] if node_levels else []
+        for node, level in node_levels.iteritems():
+            levels[level].append(node)
+        return levels
+
+    def _evaluate_levels(self, levels, thread_state, prev_ctx):
+        """
+        evaluates the lists of nodes returned by _get_timestep_levels in order,
+        evaluating the nodes in each list concurrently in the timestep pool.
+        """
+        for nodes in levels:
+            if len(nodes) > 1:
+                self._timestep_pool.map(_evaluate_in_thread, [(self, node) for node in nodes])
+                continue
+
+            self._activate(thread_state)
+            try:
+                for node in nodes:
+                    self._get_node_value(node, None, self, thread_state.thread_id)
+            finally:
+                self._deactivate(thread_state, prev_ctx)
+
+    def set_timestep_pool(self, pool):
+        """
+        Sets a pool of threads used to update the nodes that are updated
+        incrementally each time the date is changed.
+
+        When the date is set the nodes that need updating are grouped into
+        levels using the dependencies recorded so far, and nodes in the same
+        level that don't depend on each other are evaluated concurrently.
+        This only speeds things up for nodes that release the GIL, e.g. nodes
+        doing large numpy calculations or I/O.
+
+        pool may be a multiprocessing.pool.ThreadPool or an executor with a
+        map method. If it's None (the default) nodes are evaluated one at a
+        time.
+
+        Nodes are only evaluated concurrently in a context with no shifted
+        contexts and when profiling isn't enabled. Any dirty nodes that the
+        updated nodes have depended on before are evaluated before them
+        (even if they are only called conditionally). Nodes that are first
+        called by nodes evaluated concurrently must be safe to evaluate
+        from more than one thread.
+        """
+        self._timestep_pool = pool
 
     def set_date(self, date):
         """
@@ -810,51 +1087,72 @@ class MDFContext(object):
         context and also calls the update functions for any previously
         evaluated time-dependent nodes in this context.
         """
-        cookie = self._activate()
+        thread_state = cython.declare(ThreadState)
+        thread_state = _get_thread_state()
+        locked = self._eval_lock.acquire_if_pending(thread_state)
         try:
-            self._set_date(date)
+            prev_ctx = self._activate(thread_state)
+            try:
+                self._set_date(date)
+            finally:
+                self._deactivate(thread_state, prev_ctx)
         finally:
-            self._deactivate(cookie)
+            if locked:
+                self._eval_lock.lock.release()
 
     def _activate_ctx(self, prev_ctx=None, thread_id=None):
-        return self._activate(prev_ctx, thread_id)
+        """sets self as the current context and returns the previous one"""
+        return self._activate(_get_thread_state(thread_id))
 
-    def _activate(self, prev_ctx=None, thread_id=None):
-        """set self as the current context"""
-        # activate this context if different from the previous context
-        thread_id = thread_id if thread_id is not None else PyThread_get_thread_ident()
-        if prev_ctx is None:
-            try:
-                prev_ctx = _current_contexts[thread_id]
-            except KeyError:
-                pass
-
-        _current_contexts[thread_id] = self
-        return Cookie(thread_id, prev_ctx)
+    def _activate(self, thread_state):
+        """sets self as the current context for a thread and returns the previous one"""
+        prev_ctx = cython.declare(MDFContext)
+        prev_ctx = thread_state.current
+        thread_state.current = self
+        return prev_ctx
 
-    def _deactivate(self, cookie):
-        """re-set the previous context as the current context"""
-        _current_contexts[cookie.thread_id] = cookie.prev_context
+    def _deactivate(self, thread_state, prev_ctx):
+        """re-sets the previous context returned by _activate as the current context"""
+        thread_state.current = prev_ctx
 
     def _get_node_value(self, node, calling_node=None, prev_ctx=None, thread_id=None):
         alt_ctx = cython.declare(MDFContext)
+        thread_state = cython.declare(ThreadState)
+        active_ctx = cython.declare(MDFContext)
 
         # activate the context
-        cookie = self._activate(prev_ctx, thread_id)
-        prev_ctx = cookie.prev_context
+        thread_state = _get_thread_state(thread_id)
+        active_ctx = self._activate(thread_state)
+        if prev_ctx is None:
+            prev_ctx = active_ctx
+
+        eval_stack = cython.declare(cqueue)
+        eval_stack = _get_eval_stack(self, thread_state)
+
+        # if the dependencies are frozen there's nothing to record
+        # so just get the value
+        if self._dependencies_frozen and not self._verify_dependencies:
+            try:
+                cqueue_push(eval_stack, node)
+                try:
+                    return node.get_value(self, thread_id)
+                finally:
+                    cqueue_pop(eval_stack)
+            finally:
+                self._deactivate(thread_state, active_ctx)
 
         # if we're in the middle of a node evaluation get
         # the last node on the eval stack
         if calling_node is None:
-            calling_node = self._get_calling_node(prev_ctx)
+            calling_node = self._get_calling_node(prev_ctx, thread_state)
 
         try:
             # push this node on the stack and get its value
-            cqueue_push(self._node_eval_stack, node)
+            cqueue_push(eval_stack, node)
             try:
                 return node.get_value(self, thread_id)
             finally:
-                cqueue_pop(self._node_eval_stack)
+                cqueue_pop(eval_stack)
 
                 if node._has_set_date_callback:
                     self._nodes_requiring_set_date_callback[node] = None
@@ -867,7 +1165,14 @@ class MDFContext(object):
 
                 # add this node to the calling node's dependencies in the alt context
                 if calling_node is not None:
-                    calling_node._add_dependency(prev_ctx, node, alt_ctx)
+                    if self._dependencies_frozen:
+                        # verifying the frozen dependencies haven't changed
+                        dependency_version = prev_ctx._dependency_version
+                        calling_node._add_dependency(prev_ctx, node, alt_ctx)
+                        if prev_ctx._dependency_version != dependency_version:
+                            raise DependenciesFrozenError(calling_node, prev_ctx, node, alt_ctx)
+                    else:
+                        calling_node._add_dependency(prev_ctx, node, alt_ctx)
 
                 # if this node can be updated incrementally add it to the set
                 # for this context to evaluate when the date's changed
@@ -876,12 +1181,23 @@ class MDFContext(object):
                     alt_ctx._has_incrementally_updated_nodes = True
         finally:
             # deactivate the context
-            self._deactivate(cookie)
+            self._deactivate(thread_state, active_ctx)
 
     def get_value(self, node):
         """
         returns the value of the node in this context
         """
+        # while there are evaluations pending from get_value_async this has
+        # to wait for them as they share the node state
+        if self._eval_lock.num_pending > 0 \
+        and self._eval_lock.acquire_if_pending(_get_thread_state()):
+            try:
+                return self._get_value(node)
+            finally:
+                self._eval_lock.lock.release()
+        return self._get_value(node)
+
+    def _get_value(self, node):
         if _profiling_enabled:
             stop_time = time.clock()
             ctx = cython.declare(MDFContext)
@@ -899,11 +1215,52 @@ class MDFContext(object):
             if _profiling_enabled and timer is not None:
                 timer.resume()
 
+    def get_value_async(self, node, pool=None):
+        """
+        Evaluates a node in this context in a background thread so that a
+        single process can evaluate nodes in several contexts concurrently
+        (e.g. a service handling multiple requests).
+
+        pool may be a multiprocessing.pool.ThreadPool or an executor with a
+        submit method (e.g. from the futures package). If it's None a
+        default ThreadPool is used.
+
+        Returns the AsyncResult or Future from the pool.
+
+        Evaluations in related contexts (this context, its parent and any
+        contexts shifted from them) are run one at a time as they share node
+        state, but evaluations in unrelated contexts can run at the same time.
+        Each thread keeps track of its own current context.
+
+        While any evaluations are pending, calls to get_value, set_value and
+        set_date on related contexts wait for them to finish. Calls that had
+        already started before get_value_async was called aren't waited for,
+        so those shouldn't be made from other threads at the same time.
+        """
+        global _default_thread_pool
+        if pool is None:
+            with _default_thread_pool_lock:
+                if _default_thread_pool is None:
+                    _default_thread_pool = ThreadPool()
+                pool = _default_thread_pool
+
+        self._eval_lock.add_pending(1)
+        try:
+            if hasattr(pool, "submit"):
+                return pool.submit(_get_value_locked, self, node)
+            return pool.apply_async(_get_value_locked, (self, node))
+        except:
+            self._eval_lock.add_pending(-1)
+            raise
+
     def set_value(self, node, value):
         """        
         Sets a value of a node in the context.
         """
-        cookie = self._activate()
+        thread_state = cython.declare(ThreadState)
+        thread_state = _get_thread_state()
+        locked = self._eval_lock.acquire_if_pending(thread_state)
+        prev_ctx = self._activate(thread_state)
         try:
             # shifted contexts are immutable, with the exception of the now
             # node if the context is shifted by now
@@ -920,20 +1277,54 @@ class MDFContext(object):
 
             node.set_value(self, value)
         finally:
-            self._deactivate(cookie)
+            self._deactivate(thread_state, prev_ctx)
+            if locked:
+                self._eval_lock.lock.release()
 
     def set_override(self, node, override_node):
         """
         Sets an override for a node in this context.
         """
-        cookie = self._activate()
+        thread_state = cython.declare(ThreadState)
+        thread_state = _get_thread_state()
+        prev_ctx = self._activate(thread_state)
         try:
             if self._finalized \
             and self._shift_set:
                 raise AttributeError("Shifted contexts are read-only")
             node.set_override(self, override_node)
         finally:
-            self._deactivate(cookie)
+            self._deactivate(thread_state, prev_ctx)
+
+    def _append_history(self, node, value):
+        history = self._node_histories.get(node)
+        if history is None:
+            history = self._node_histories[node] = NodeHistory()
+        history.append(self._now, value)
+
+    def history(self, node, start=None, end=None):
+        """
+        Returns the values of a node for the dates between start and end
+        (inclusive) it's been evaluated on in this context as a pandas
+        Series, or a DataFrame if the values are arrays or Series.
+
+        The node must have history enabled (see :py:func:`keep_history`).
+        The values are returned from the history without re-evaluating
+        anything.
+        """
+        if not node._keep_history:
+            raise AttributeError("History isn't enabled for %s" % node.name)
+
+        history = self._node_histories.get(node)
+        if history is None and self._parent is not None:
+            # the node may only have been evaluated in a less shifted context
+            alt_ctx = cython.declare(MDFContext)
+            alt_ctx = node.get_alt_context(self)
+            history = alt_ctx._node_histories.get(node)
+
+        if history is None:
+            history = NodeHistory()
+        return history.get(start, end)
 
     def __getitem__(self, node):
         """
@@ -955,19 +1346,19 @@ class MDFContext(object):
             return
         self.set_value(node, value)
 
-    def _get_calling_node(self, prev_ctx=None):
-        if prev_ctx is None:
-            thread_id = PyThread_get_thread_ident()
-            try:
-                prev_ctx = _current_contexts[thread_id]
-            except KeyError:
-                prev_ctx = None
+    def _get_calling_node(self, prev_ctx=None, thread_state=None):
+        if thread_state is None:
+            thread_state = _get_thread_state()
 
+        if prev_ctx is None:
+            prev_ctx = thread_state.current
             if prev_ctx is None:
                 prev_ctx = self
 
-        if len(prev_ctx._node_eval_stack) > 0:
-            return prev_ctx._node_eval_stack[-1]
+        eval_stack = cython.declare(cqueue)
+        eval_stack = _get_eval_stack(prev_ctx, thread_state)
+        if len(eval_stack) > 0:
+            return eval_stack[-1]
 
         return None
 
@@ -1024,7 +1415,7 @@ class MDFContext(object):
         returns a set of all nodes that have been called in this context
         """
         nodes_with_value = set()
-        for node in _all_nodes.itervalues():
+        for node in self._nodes_with_state:
             if node.has_value(self) or node.was_called(self):
                 nodes_with_value.add(node)
         return nodes_with_value
@@ -1201,15 +1592,81 @@ class MDFContext(object):
         colors.update(self._dot_colors)
         return _to_dot(self, filename, nodes, colors, all_contexts, max_depth, rankdir)
 
-def _get_current_context(thread_id=None):
-    """returns the current context during node evaluation"""
-    if thread_id is None:
-        thread_id = PyThread_get_thread_ident()
+    def memory_report(self, include_shifted=True, builders=None):
+        """
+        returns an estimate of the memory held by each node in this context
+        as an mdf.memory.MemoryReport.
+
+        Each node's memory is split into the memory held by its value, by
+        its generator or node type state (e.g. the queue of a queuenode) and
+        by its dependency graph bookkeeping.
+
+        If include_shifted is true the nodes in all shifted contexts of this
+        context are included as well.
+
+        builders may be a list of builders (e.g. as passed to mdf.run) to
+        include the memory held by those in the report.
+        """
+        from memory import _memory_report
+        return _memory_report(self, include_shifted, builders)
+
+def _get_thread_state(thread_id=None):
+    """returns the ThreadState for a thread, or the current thread if thread_id is None"""
+    global _last_thread_state
+    thread_id_ = cython.declare(long)
+    thread_id_ = PyThread_get_thread_ident() if thread_id is None else thread_id
+
+    # most of the time everything's evaluated in the same thread so check
+    # the last state used before looking it up
+    thread_state = cython.declare(ThreadState)
+    thread_state = _last_thread_state
+    if thread_state is not None and thread_state.thread_id == thread_id_:
+        return thread_state
+
+    thread_state = _thread_states.get(thread_id_)
+    if thread_state is None:
+        thread_state = _thread_states[thread_id_] = ThreadState(thread_id_)
+    _last_thread_state = thread_state
+    return thread_state
+
+def _get_eval_stack(ctx, thread_state):
+    """returns the stack of nodes being evaluated in a context by a thread"""
+    if thread_state.eval_stacks is None:
+        return ctx._node_eval_stack
+
+    eval_stack = thread_state.eval_stacks.get(ctx._id_obj)
+    if eval_stack is None:
+        eval_stack = thread_state.eval_stacks[ctx._id_obj] = cqueue()
+    return eval_stack
+
+def _evaluate_in_thread(args):
+    """evaluates a node in a thread in a context's timestep pool"""
+    ctx, node = args
+    ctx_ = cython.declare(MDFContext)
+    ctx_ = ctx
+
+    thread_state = cython.declare(ThreadState)
+    thread_state = _get_thread_state()
+    eval_stacks = thread_state.eval_stacks
+    thread_state.eval_stacks = {}
     try:
-        ctx = _current_contexts[thread_id]
-    except KeyError:
-        ctx = None
+        ctx_._get_node_value(node, None, ctx_, thread_state.thread_id)
+    finally:
+        thread_state.eval_stacks = eval_stacks
 
+def _get_value_locked(ctx, node):
+    """gets a node value in ctx while holding the context's eval lock"""
+    ctx_ = cython.declare(MDFContext)
+    ctx_ = ctx
+    try:
+        with ctx_._eval_lock.lock:
+            return ctx_._get_value(node)
+    finally:
+        ctx_._eval_lock.add_pending(-1)
+
+def _get_current_context(thread_id=None):
+    """returns the current context during node evaluation"""
+    ctx = _get_thread_state(thread_id).current
     if ctx is None:
         raise NoCurrentContextError()
     return ctx
@@ -1,7 +1,8 @@
 from nodes cimport NodeState, MDFNode, MDFVarNode
 from context cimport MDFContext, _all_nodes
 
-cpdef _pickle_context(MDFContext ctx)
+cpdef dict _get_required_node_states(MDFContext ctx, root_nodes, categories)
+cpdef _pickle_context(MDFContext ctx, root_nodes=?, categories=?, value_writer=?)
 cpdef MDFContext _unpickle_context(cls, ctx_id, now, node_states, shift_sets)
 
 cpdef _pickle_node(MDFNode node)
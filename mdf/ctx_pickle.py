@@ -1,7 +1,7 @@
 """
 Functions to provide pickle support to MDF classes
 """
-from nodes import MDFNode, MDFVarNode, NodeState
+from nodes import MDFNode, MDFVarNode, NodeState, LazyNodeValue
 from context import MDFContext, ShiftSet
 import cython
 import sys
@@ -88,9 +88,18 @@ class NodeStateWrapper(object):
     for use while unpickling to allow the full node_state
     to be re-constructed from pickable data.
     """
-    def __init__(self, node_state):
+    def __init__(self, node_state, required=None, value_writer=None):
         self.node_state = node_state
 
+        # if only some node states are being pickled this is a dict of
+        # ctx_id -> set of nodes being pickled, used to filter the callers
+        # and callees.
+        self.required = required
+
+        # optional function called with the node value that returns
+        # the object to pickle in its place
+        self.value_writer = value_writer
+
         # additional attributes
         self.alt_context_id = None
         self.prev_alt_context_id = None
@@ -104,32 +113,129 @@ class NodeStateWrapper(object):
             None
         )
 
-def _pickle_context(ctx):
+class PartialContext(object):
+    """
+    Wrapper around a context that pickles only the node states required
+    by a set of root nodes and/or in a set of categories, and the shifted
+    contexts those node states are in.
+
+    If value_writer is not None it's called with each node value and
+    the object it returns is pickled instead of the value.
+
+    When unpickled the result is an MDFContext.
+    """
+    def __init__(self, ctx, root_nodes=None, categories=None, value_writer=None):
+        self.ctx = ctx
+        self.root_nodes = root_nodes
+        self.categories = categories
+        self.value_writer = value_writer
+
+    def __reduce__(self):
+        return (
+            _unpickle_context,
+            _pickle_context(self.ctx, self.root_nodes, self.categories, self.value_writer),
+            None,
+            None,
+            None
+        )
+
+def _get_required_node_states(ctx, root_nodes, categories):
+    """
+    returns a dict of ctx_id -> set of nodes for the node states required
+    by root_nodes in ctx, or by all nodes in ctx and its shifted contexts
+    if root_nodes is None.
+
+    If categories is not None only nodes in one of those categories are
+    included, but all dependencies are still followed.
+    """
+    node = cython.declare(MDFNode)
+    node_state = cython.declare(NodeState)
+
+    shifted_ctx = cython.declare(MDFContext)
+
+    if root_nodes is not None:
+        to_visit = [(node, ctx._id_obj) for node in root_nodes]
+    else:
+        # start from all nodes in ctx and all its shifted contexts as
+        # not every node state in a shifted context is reachable from ctx
+        to_visit = [(node, ctx._id_obj) for node in ctx._nodes_with_state]
+        for shifted_ctx in ctx.get_shifted_contexts():
+            to_visit.extend([(node, shifted_ctx._id_obj) for node in shifted_ctx._nodes_with_state])
+
+    if categories is not None:
+        categories = set(categories)
+
+    required = {}
+    seen = set()
+    while to_visit:
+        node, ctx_id = to_visit.pop()
+        if (node, ctx_id) in seen:
+            continue
+        seen.add((node, ctx_id))
+
+        node_state = node._states.get(ctx_id)
+        if node_state is None:
+            continue
+
+        if categories is None \
+        or categories.intersection(node.categories):
+            required.setdefault(ctx_id, set()).add(node)
+
+        for callee_ctx_id, callees in node_state.callees.iteritems():
+            for callee in callees:
+                to_visit.append((callee, callee_ctx_id))
+
+        # the value may be stored in a different context to the one
+        # the node was called in if it doesn't depend on the shifted nodes
+        if node_state.alt_context is not None:
+            to_visit.append((node, node_state.alt_context._id_obj))
+
+    return required
+
+def _pickle_context(ctx, root_nodes=None, categories=None, value_writer=None):
     """
     returns a picklable tuple of args to be passed to _unpickle_context
     
     The context and all of its shifted contexts are pickled, along with
     and node states that exist for any of those contexts.
+
+    If root_nodes or categories are not None only the node states required
+    by the root nodes, or in those categories, are pickled along with the
+    shifted contexts they're in.
+
+    If value_writer is not None it's called with each node value and
+    the object it returns is pickled instead of the value.
     """
     shifted_ctx = cython.declare(MDFContext)
     node = cython.declare(MDFNode)
     node_state = cython.declare(NodeState)
 
-    all_ctx_ids = [ctx.get_id()]
+    required = None
+    if root_nodes is not None or categories is not None:
+        required = _get_required_node_states(ctx, root_nodes, categories)
+
+    all_ctxs = [ctx]
 
     # get the shift sets for all shifted contexts
     shift_sets = []
     for shifted_ctx in ctx.get_shifted_contexts():
+        if required is not None and shifted_ctx._id_obj not in required:
+            continue
         shift_set = shifted_ctx.get_shift_set()
         shift_sets.append((shifted_ctx.get_id(), shift_set))
-        all_ctx_ids.append(shifted_ctx.get_id())
+        all_ctxs.append(shifted_ctx)
 
     # get the cached values for all nodes in any of the contexts we're interested in
     node_states = []
-    for node in _all_nodes.itervalues():
-        for ctx_id, node_state in node._states.iteritems():
-            if ctx_id in all_ctx_ids:
-                node_states.append((ctx_id, node, NodeStateWrapper(node_state)))
+    for shifted_ctx in all_ctxs:
+        if required is not None:
+            nodes = required.get(shifted_ctx._id_obj, ())
+        else:
+            nodes = shifted_ctx._nodes_with_state
+
+        for node in nodes:
+            node_state = node._states[shifted_ctx._id_obj]
+            node_states.append((shifted_ctx._id_obj, node, NodeStateWrapper(node_state, required, value_writer)))
 
     return (ctx.__class__,
             ctx.get_id(),
@@ -197,6 +303,7 @@ def _unpickle_context(cls, ctx_id, now, node_states, shift_sets):
     """
     node = cython.declare(MDFNode)
     node_state = cython.declare(NodeState)
+    new_ctx = cython.declare(MDFContext)
 
     root = cls(now)
 
@@ -232,8 +339,9 @@ def _unpickle_context(cls, ctx_id, now, node_states, shift_sets):
             new_callee_ctx_id = ctx_id_fixup[callee_ctx_id]
             node_state.callees[new_callee_ctx_id] = callees
 
-        new_ctx_id = ctx_id_fixup[ctx_id]
-        node._states[new_ctx_id] = node_state
+        new_ctx = all_ctxs[ctx_id]
+        node._states[new_ctx._id_obj] = node_state
+        new_ctx._nodes_with_state[node] = None
 
     return root
 
@@ -250,11 +358,21 @@ def _pickle_node_state(node_state_wrapper):
     attribs["has_value"] = node_state.has_value
     attribs["date"] = node_state.date
     attribs["value"] = node_state.value
+    if isinstance(attribs["value"], LazyNodeValue):
+        attribs["value"] = attribs["value"].load()
+    if node_state_wrapper.value_writer is not None:
+        attribs["value"] = node_state_wrapper.value_writer(attribs["value"])
     attribs["called"] = node_state.called
     attribs["callers"] = node_state.callers
     attribs["callees"] = node_state.callees
     attribs["override"] = node_state.override
 
+    # if only some node states are being pickled remove any references to the others
+    required = node_state_wrapper.required
+    if required is not None:
+        attribs["callers"] = _filter_dependencies(node_state.callers, required)
+        attribs["callees"] = _filter_dependencies(node_state.callees, required)
+
     # store context and override references as ids instead of objects
     if node_state.alt_context:
         extra_attribs["alt_context_id"] = node_state.alt_context.get_id()
@@ -264,6 +382,20 @@ def _pickle_node_state(node_state_wrapper):
 
     return (node_state.ctx_id, node_state.dirty_flags, attribs, extra_attribs)
 
+def _filter_dependencies(dependencies, required):
+    """
+    returns a copy of a callers or callees dict of ctx_id -> set of nodes
+    with only the nodes in required (also a dict of ctx_id -> set of nodes).
+    """
+    filtered = {}
+    for ctx_id, nodes in dependencies.iteritems():
+        required_nodes = required.get(ctx_id)
+        if required_nodes:
+            nodes = nodes.intersection(required_nodes)
+            if nodes:
+                filtered[ctx_id] = nodes
+    return filtered
+
 def _unpickle_node_state(ctx_id, dirty_flags, attribs, additional_attribs):
     """
     returns a NodeStateWrapper object from the picked results of _pickle_node_state
@@ -0,0 +1,261 @@
+"""
+Storage for the history of node values kept by contexts for nodes
+with history enabled (see :py:func:`mdf.keep_history`).
+
+Values are stored in chunks of typed numpy arrays, one row per date.
+Numeric values, numpy arrays and pandas Series are stored in typed
+arrays and anything else is stored in object arrays. Old chunks can
+be spilled to disk to bound the memory used (see
+:py:func:`mdf.set_history_options`).
+"""
+from .universe import PanelArray
+import numpy as np
+import pandas as pa
+import tempfile
+import logging
+import os
+
+_log = logging.getLogger(__name__)
+
+_options = {
+    "chunk_size" : 1024,
+    "max_chunks_in_memory" : None,
+    "spill_dir" : None,
+}
+
+def set_history_options(chunk_size=None, max_chunks_in_memory=None, spill_dir=None):
+    """
+    Sets the options used for node histories created after this is called.
+
+    chunk_size is the number of dates stored in each chunk.
+
+    If max_chunks_in_memory is set, any chunks older than the most recent
+    max_chunks_in_memory chunks are written to files in spill_dir (or the
+    system temp directory) and memory mapped when the history's queried.
+    """
+    if chunk_size is not None:
+        _options["chunk_size"] = chunk_size
+    _options["max_chunks_in_memory"] = max_chunks_in_memory
+    _options["spill_dir"] = spill_dir
+
+def _to_array(value):
+    """
+    returns (array, columns) to store value in a typed chunk, or
+    (None, None) if it has to be stored as an object.
+    """
+    if isinstance(value, pa.Series):
+        if value.dtype != object:
+            return value.values, value.index
+    elif isinstance(value, PanelArray):
+        if value.dtype != object:
+            columns = value.universe.index if value.universe is not None and value.ndim == 1 else None
+            return np.asarray(value), columns
+    elif isinstance(value, np.ndarray):
+        if value.dtype != object:
+            return value, None
+    elif isinstance(value, (bool, int, long, float, np.number, np.bool_)):
+        return np.asarray(value), None
+    return None, None
+
+class _Chunk(object):
+    """rows of dates (as int64 nanoseconds) and values"""
+
+    def __init__(self, dates, values, columns):
+        self.dates = dates
+        self.values = values
+        self.columns = columns
+        self.size = len(dates)
+        self.__filenames = None
+
+    @classmethod
+    def new(cls, size, array, columns):
+        if array is None:
+            values = np.empty(size, dtype=object)
+        else:
+            values = np.empty((size,) + array.shape, dtype=array.dtype)
+        chunk = cls(np.empty(size, dtype=np.int64), values, columns)
+        chunk.size = 0
+        return chunk
+
+    @property
+    def is_spilled(self):
+        return self.__filenames is not None
+
+    def fits(self, array, columns):
+        """returns True if a value converted by _to_array can be stored in this chunk"""
+        if array is None or self.values.dtype == object:
+            return array is None and self.values.dtype == object
+        if array.shape != self.values.shape[1:] \
+        or not np.can_cast(array.dtype, self.values.dtype):
+            return False
+        if columns is None or self.columns is None:
+            return columns is None and self.columns is None
+        return columns.equals(self.columns)
+
+    def trim(self):
+        """drops any unused rows"""
+        self.dates = self.dates[:self.size]
+        self.values = self.values[:self.size]
+
+    def spill(self, spill_dir):
+        """writes the chunk to disk and releases the arrays"""
+        filenames = []
+        for array in (self.dates, self.values):
+            fd, filename = tempfile.mkstemp(prefix="mdf_history_", suffix=".npy", dir=spill_dir)
+            with os.fdopen(fd, "wb") as fh:
+                np.save(fh, array)
+            filenames.append(filename)
+        self.__filenames = filenames
+        self.dates = self.values = None
+
+    def load(self):
+        """returns (dates, values), memory mapping them if the chunk's been spilled"""
+        if self.__filenames is None:
+            return self.dates[:self.size], self.values[:self.size]
+        dates_filename, values_filename = self.__filenames
+        dates = np.load(dates_filename, mmap_mode="r")
+        try:
+            values = np.load(values_filename, mmap_mode="r")
+        except ValueError:
+            # object arrays can't be memory mapped
+            values = np.load(values_filename)
+        return dates, values
+
+    def unspill(self):
+        """reads a spilled chunk back into memory"""
+        if self.__filenames is not None:
+            dates, values = self.load()
+            self.dates, self.values = np.array(dates), np.array(values)
+            self.remove()
+
+    def remove(self):
+        """deletes any files the chunk's been spilled to"""
+        filenames, self.__filenames = self.__filenames, None
+        for filename in filenames or []:
+            try:
+                os.remove(filename)
+            except OSError:
+                _log.warn("Failed to remove %s" % filename)
+
+class NodeHistory(object):
+    """
+    The history of values of a node in a context.
+    """
+
+    def __init__(self):
+        self.__chunk_size = _options["chunk_size"]
+        self.__max_chunks_in_memory = _options["max_chunks_in_memory"]
+        self.__spill_dir = _options["spill_dir"]
+        self.__chunks = []
+        self.__tz = None
+
+    def __del__(self):
+        self.clear()
+
+    def __len__(self):
+        return sum(c.size for c in self.__chunks)
+
+    def clear(self):
+        chunks, self.__chunks = self.__chunks, []
+        for chunk in chunks:
+            chunk.remove()
+
+    def append(self, date, value):
+        """adds the value for a date, replacing any values for the same or later dates"""
+        date = pa.Timestamp(date)
+        if not self.__chunks:
+            self.__tz = date.tz
+        date = date.value
+
+        # if the date's gone backwards drop the values that are being replaced
+        if self.__chunks:
+            last_chunk = self.__chunks[-1]
+            if last_chunk.size == 0 or last_chunk.dates[last_chunk.size - 1] >= date:
+                self.__truncate(date)
+
+        array, columns = _to_array(value)
+        chunk = self.__chunks[-1] if self.__chunks else None
+        if chunk is None \
+        or chunk.is_spilled \
+        or chunk.size == len(chunk.dates) \
+        or not chunk.fits(array, columns):
+            if chunk is not None:
+                chunk.trim()
+            chunk = _Chunk.new(self.__chunk_size, array, columns)
+            self.__chunks.append(chunk)
+            self.__spill_old_chunks()
+
+        chunk.dates[chunk.size] = date
+        chunk.values[chunk.size] = value if array is None else array
+        chunk.size += 1
+
+    def __truncate(self, date):
+        """drops the values for any dates on or after date"""
+        while self.__chunks:
+            chunk = self.__chunks[-1]
+            chunk.unspill()
+            size = np.searchsorted(chunk.dates[:chunk.size], date)
+            if size > 0:
+                chunk.size = size
+                chunk.trim()
+                return
+            self.__chunks.pop()
+
+    def __spill_old_chunks(self):
+        if self.__max_chunks_in_memory is None:
+            return
+        in_memory = [c for c in self.__chunks if not c.is_spilled]
+        for chunk in in_memory[:-self.__max_chunks_in_memory - 1]:
+            chunk.spill(self.__spill_dir)
+
+    def get(self, start=None, end=None):
+        """
+        returns the values between start and end (inclusive) as a pandas
+        Series, or a DataFrame if the values are 1d arrays or Series.
+        """
+        start = pa.Timestamp(start).value if start is not None else None
+        end = pa.Timestamp(end).value if end is not None else None
+
+        all_dates, all_values, all_columns = [], [], []
+        for chunk in self.__chunks:
+            dates, values = chunk.load()
+            if len(dates) == 0:
+                continue
+            if start is not None and dates[-1] < start:
+                continue
+            if end is not None and dates[0] > end:
+                break
+
+            i = np.searchsorted(dates, start) if start is not None else 0
+            j = np.searchsorted(dates, end, side="right") if end is not None else len(dates)
+            all_dates.append(np.asarray(dates[i:j]))
+            all_values.append(values[i:j])
+            all_columns.append(chunk.columns)
+
+        index = pa.DatetimeIndex(np.concatenate(all_dates).astype("M8[ns]") if all_dates else [])
+        if self.__tz is not None:
+            index = index.tz_localize("UTC").tz_convert(self.__tz)
+
+        if not all_values:
+            return pa.Series([], index=index)
+
+        # if all the chunks have the same shape and columns they can be concatenated
+        shapes = set(v.shape[1:] for v in all_values)
+        if len(shapes) == 1 \
+        and all((c is None and all_columns[0] is None) or (c is not None and all_columns[0] is not None and c.equals(all_columns[0]))
+                for c in all_columns):
+            values = np.concatenate(all_values)
+            if values.ndim == 1:
+                return pa.Series(values, index=index)
+            if values.ndim == 2:
+                return pa.DataFrame(values, index=index, columns=all_columns[0])
+
+        # otherwise return a Series of the individual values
+        rows = []
+        for values, columns in zip(all_values, all_columns):
+            for value in values:
+                rows.append(pa.Series(value, index=columns) if columns is not None else value)
+        series = pa.Series(np.empty(len(rows), dtype=object), index=index)
+        for i, row in enumerate(rows):
+            series.iat[i] = row
+        return series
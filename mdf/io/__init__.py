@@ -4,11 +4,19 @@ Functions for saving and loading MDF objects.
 import os
 import sys
 import logging
-import shutil
-from .simplezipfile import SimpleZipFile
+from .simplezipfile import SimpleZipFile, ZIP_DEFLATED, ZIP_STORED
+from . import arrayfile
 from bz2 import BZ2File
 from gzip import GzipFile
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
 import pickle
 
 _log = logging.getLogger(__name__)
@@ -16,17 +24,51 @@ _log = logging.getLogger(__name__)
 if sys.version_info[0] > 2:
     basestring = str
 
+# compression used for each file extension
+_compression_by_ext = {
+    ".zip"  : "zip",
+    ".gz"   : "gzip",
+    ".bz2"  : "bz2",
+    ".xz"   : "lzma",
+    ".lzma" : "lzma",
+}
+
+_compression_types = ("none", "zip", "gzip", "bz2", "lzma")
+
+def _get_compression(filename, compression):
+    """
+    returns the compression to use for a filename, either from
+    the compression argument or from the file extension.
+    """
+    if compression is None:
+        _, ext = os.path.splitext(filename)
+        compression = _compression_by_ext.get(ext, "none")
+
+    if compression not in _compression_types:
+        raise ValueError("Unknown compression '%s' (expected one of %s)" % (
+                            compression, ", ".join(_compression_types)))
+
+    if compression == "lzma" and lzma is None:
+        raise ImportError("lzma compression requires the lzma module "
+                          "(backports.lzma on Python 2)")
+
+    return compression
+
 # access via the MDFContext.save method
-def save_context(ctx, filename, start_date=None, end_date=None):
+def save_context(ctx, filename, start_date=None, end_date=None,
+                 compression=None, compresslevel=None,
+                 out_of_band=False, out_of_band_threshold=arrayfile.DEFAULT_THRESHOLD,
+                 root_nodes=None, categories=None):
     """
     Write the context and its state, including all shifted contexts and node
     states, to a binary file.
 
     The resulting file can be re-loaded using :py:func:`MDFContext.load`.
 
-    If filename endswith .zip or .bz2 or .gz the data will be compressed.
-    The :py:func:`MDFContext.load` method is able to load these compressed
-    files.
+    If filename endswith .zip, .gz, .bz2 or .xz the data will be compressed.
+    The data is compressed as it's written without using any temporary
+    files. The :py:func:`MDFContext.load` method is able to load these
+    compressed files.
 
     :param filename: filename of the output file, or an open file handle.
 
@@ -35,8 +77,40 @@ def save_context(ctx, filename, start_date=None, end_date=None):
 
     :param end_date: datetime used as an optional argument to start the mdf
                      viewer in the .bat file.
+
+    :param compression: one of 'none', 'zip', 'gzip', 'bz2' or 'lzma' to override
+                        the compression selected by the file extension.
+
+    :param compresslevel: compression level to use. For 'zip' and 'gzip' this
+                          is the zlib level from 0 to 9, where 0 stores the data
+                          uncompressed and 1 is fastest. For 'lzma' it's the preset.
+
+    :param out_of_band: if True numpy arrays (including those in pandas objects)
+                        larger than out_of_band_threshold bytes are written
+                        uncompressed to a separate file, filename + '.arrays',
+                        instead of being pickled, along with any large node
+                        values. They can then be memory mapped and the node
+                        values loaded lazily when loading (see :py:func:`load_context`).
+
+    :param root_nodes: if not None only the node states required to evaluate
+                       these nodes in the context are saved, along with any
+                       shifted contexts they depend on.
+
+    :param categories: if not None only node states for nodes in one of these
+                       categories are saved.
     """
     close_fh = True
+    array_writer = None
+    if out_of_band:
+        if not isinstance(filename, basestring):
+            raise ValueError("out_of_band can only be used when saving to a filename")
+        array_writer = arrayfile.ArrayFileWriter(arrayfile.get_array_filename(filename),
+                                                 out_of_band_threshold)
+
+    if root_nodes is not None or categories is not None or array_writer is not None:
+        from ..ctx_pickle import PartialContext
+        ctx = PartialContext(ctx, root_nodes, categories,
+                             array_writer.write_value if array_writer is not None else None)
 
     # determine what compression to use, if any
     if not isinstance(filename, basestring):
@@ -45,53 +119,91 @@ def save_context(ctx, filename, start_date=None, end_date=None):
     else:
         # use w+b to workaround problem writing large chunks of data in a single call to fwrite
         # http://support.microsoft.com/default.aspx?scid=kb;en-us;899149
-
-        base, ext = os.path.splitext(filename)
-        if ext == ".zip":
+        compression = _get_compression(filename, compression)
+        if compression == "zip":
+            base, ext = os.path.splitext(filename)
             inner_filename = os.path.basename(base) + ".dag"
-            fh = SimpleZipFile(filename, inner_filename=inner_filename, mode="w+b")
-        elif ext == ".bz2":
-            fh = BZ2File(filename, "wb") # w+b isn't a valid mode for BZ2File
-        elif ext == ".gz":
-            fh = GzipFile(filename, "w+b")
+            fh = SimpleZipFile(filename,
+                               inner_filename=inner_filename,
+                               mode="w+b",
+                               compression=ZIP_STORED if compresslevel == 0 else ZIP_DEFLATED,
+                               compresslevel=compresslevel,
+                               allowZip64=True)
+        elif compression == "bz2":
+            fh = BZ2File(filename, "wb", compresslevel=compresslevel or 9) # w+b isn't a valid mode for BZ2File
+        elif compression == "gzip":
+            fh = GzipFile(filename, "w+b", compresslevel=9 if compresslevel is None else compresslevel)
+        elif compression == "lzma":
+            fh = lzma.LZMAFile(filename, "wb", preset=compresslevel)
         else:
             fh = open(filename, "w+b")
 
     try:
-        pickle.dump(ctx, fh, pickle.HIGHEST_PROTOCOL)
+        if array_writer is not None:
+            arrayfile.dump(ctx, fh, array_writer, pickle.HIGHEST_PROTOCOL)
+        else:
+            pickle.dump(ctx, fh, pickle.HIGHEST_PROTOCOL)
+    except:
+        if array_writer is not None:
+            array_writer.close(discard=True)
+        raise
     finally:
+        if array_writer is not None:
+            array_writer.close()
         if close_fh:
             fh.close()
 
 
 # access via the MDFContext.load static method
-def load_context(filename):
+def load_context(filename, compression=None, mmap=False):
     """
     Load a context from a file and return a new MDFContext with the same
     state as the context that was saved (i.e. all the same shifted contexts
     and node values).
-    
+
+    Compressed files are decompressed as they're read.
+
     :param filename: filename of the file to load or an open file handle.
+
+    :param compression: one of 'none', 'zip', 'gzip', 'bz2' or 'lzma' to override
+                        the compression selected by the file extension.
+
+    :param mmap: if the context was saved with out_of_band=True and mmap is True
+                 the array file is memory mapped, and the array data is only
+                 read from disk when it's accessed. Node values saved in the
+                 array file are only unpickled when they're first accessed.
+                 The arrays are copy-on-write so changes to them are never
+                 written back to the file.
     """
     close_fh = True
+    array_reader = None
 
     # determine what compression to use, if any
     if not isinstance(filename, basestring):
         fh = filename
         close_fh = False
     else:
-        _, ext = os.path.splitext(filename)
-        if ext == ".zip":
+        # the array file is only opened if the pickle references it
+        array_reader = arrayfile.ArrayFileReader(arrayfile.get_array_filename(filename), mmap=mmap)
+
+        compression = _get_compression(filename, compression)
+        if compression == "zip":
             fh = SimpleZipFile(filename, mode="rb")
-        elif ext == ".bz2":
+        elif compression == "bz2":
             fh = BZ2File(filename, "rb")
-        elif ext == ".gz":
+        elif compression == "gzip":
             fh = GzipFile(filename, "rb")
+        elif compression == "lzma":
+            fh = lzma.LZMAFile(filename, "rb")
         else:
             fh = open(filename, "rb")
 
     try:
+        if array_reader is not None:
+            return arrayfile.load(fh, array_reader)
         return pickle.load(fh)
     finally:
+        if array_reader is not None:
+            array_reader.close()
         if close_fh:
             fh.close()
@@ -0,0 +1,291 @@
+"""
+classes used for saving large arrays out of band when pickling mdf objects
+
+Numpy arrays (including those backing pandas objects) above a size
+threshold are written as raw aligned buffers to a separate array file
+and the pickle only contains a reference to each array's location in
+that file. When loading, the array file can be memory mapped so the
+array data is only read from disk when it's accessed.
+
+Node values holding large arrays are also pickled separately to the array
+file so they can be unpickled lazily when they're first accessed.
+
+The array file starts with a token that's also included in every
+persistent id, so an array file left over from a previous save is never
+used in place of the one the pickle was written with.
+"""
+from functools import partial
+from io import BytesIO
+import numpy as np
+import pandas as pa
+import tempfile
+import logging
+import pickle
+import uuid
+import os
+
+_log = logging.getLogger(__name__)
+
+# tags used in the persistent ids written to the pickle
+_PERSISTENT_ID_TAG = "mdf.io.array"
+_VALUE_PERSISTENT_ID_TAG = "mdf.io.value"
+
+# the array file starts with this followed by the token
+_MAGIC = b"MDFARRAYS\0"
+_TOKEN_SIZE = 32
+
+# arrays are aligned to this many bytes in the array file
+_ALIGNMENT = 64
+
+# arrays smaller than this are pickled inline
+DEFAULT_THRESHOLD = 1 << 16
+
+def get_array_filename(filename):
+    """returns the filename of the array file used for a saved context"""
+    return filename + ".arrays"
+
+def get_out_of_band_data(obj, threshold):
+    """
+    returns (data, fortran_order) if obj is an array that can be stored
+    out of band, or None. data is a C contiguous array with the same
+    bytes as obj (obj transposed if obj is fortran ordered).
+
+    Only plain numeric arrays of at least threshold bytes are stored
+    out of band, anything else is left to be pickled.
+    """
+    if type(obj) not in (np.ndarray, np.memmap):
+        return None
+
+    if obj.nbytes < threshold \
+    or obj.dtype.hasobject \
+    or obj.dtype.fields is not None:
+        return None
+
+    if obj.flags.c_contiguous:
+        return obj, False
+    if obj.flags.f_contiguous:
+        return obj.T, True
+    return None
+
+def _get_array_nbytes(value):
+    """
+    returns the number of bytes of numpy array data in value, found from its
+    type rather than by pickling it. Only arrays, pandas objects and lists,
+    tuples and dicts of them are counted.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, pa.core.generic.NDFrame):
+        return sum(block.values.nbytes for block in value._data.blocks)
+    if isinstance(value, (list, tuple)):
+        return sum(_get_array_nbytes(x) for x in value)
+    if isinstance(value, dict):
+        return sum(_get_array_nbytes(x) for x in value.itervalues())
+    return 0
+
+class _PickledValue(object):
+    """reference to a value pickled to the array file by ArrayFileWriter.write_value"""
+
+    def __init__(self, offset, size):
+        self.offset = offset
+        self.size = size
+
+class ArrayFileWriter(object):
+    """
+    Writes arrays to an array file and returns the persistent id
+    to use for each array written.
+
+    The arrays are written to a temporary file that replaces filename
+    when the writer is closed, so any existing array file that may be
+    memory mapped isn't modified.
+    """
+
+    def __init__(self, filename, threshold=DEFAULT_THRESHOLD):
+        self.__filename = filename
+        fd, self.__tmp_filename = tempfile.mkstemp(prefix=os.path.basename(filename) + ".",
+                                                   dir=os.path.dirname(os.path.abspath(filename)))
+        self.__fh = os.fdopen(fd, "wb")
+        self.__threshold = threshold
+        self.__token = uuid.uuid4().hex
+        self.__fh.write(_MAGIC + self.__token.encode("ascii"))
+        self.__offset = len(_MAGIC) + _TOKEN_SIZE
+
+        # arrays already written, keyed by id. The array is kept alongside
+        # the persistent id so the id can't be reused by another object.
+        self.__written = {}
+
+    def close(self, discard=False):
+        """
+        closes the temporary file and moves it to the array filename,
+        or deletes it if discard is True.
+        """
+        self.__written.clear()
+        if self.__fh is None:
+            return
+        self.__fh.close()
+        self.__fh = None
+
+        if discard:
+            os.unlink(self.__tmp_filename)
+            return
+
+        # windows can't rename over an existing file
+        if os.name == "nt" and os.path.exists(self.__filename):
+            os.unlink(self.__filename)
+        os.rename(self.__tmp_filename, self.__filename)
+
+    def __align(self):
+        # pad so everything starts on an aligned offset
+        padding = -self.__offset % _ALIGNMENT
+        if padding:
+            self.__fh.write(b"\0" * padding)
+            self.__offset += padding
+
+    def write_value(self, value):
+        """
+        pickles value to the array file if it holds at least threshold bytes
+        of arrays, and returns an object to pickle in its place that's
+        unpickled lazily. Otherwise value is returned to be pickled inline.
+        """
+        if _get_array_nbytes(value) < self.__threshold:
+            return value
+
+        buf = BytesIO()
+        dump(value, buf, self)
+        data = buf.getvalue()
+
+        self.__align()
+        result = _PickledValue(self.__offset, len(data))
+        self.__fh.write(data)
+        self.__offset += len(data)
+        return result
+
+    def persistent_id(self, obj):
+        """
+        returns a persistent id for obj if it's an array that should be
+        stored in the array file, or None.
+        """
+        if isinstance(obj, _PickledValue):
+            return (_VALUE_PERSISTENT_ID_TAG, self.__token, obj.offset, obj.size)
+
+        try:
+            return self.__written[id(obj)][1]
+        except KeyError:
+            pass
+
+        result = get_out_of_band_data(obj, self.__threshold)
+        if result is None:
+            return None
+        data, fortran_order = result
+
+        self.__align()
+        pid = (_PERSISTENT_ID_TAG,
+               self.__token,
+               self.__offset,
+               obj.dtype.str,
+               obj.shape,
+               fortran_order)
+
+        data.tofile(self.__fh)
+        self.__offset += obj.nbytes
+        self.__written[id(obj)] = (obj, pid)
+        return pid
+
+class ArrayFileReader(object):
+    """
+    Reads arrays written by ArrayFileWriter from their persistent ids.
+
+    If mmap is True the array file is memory mapped and the returned
+    arrays are copy-on-write views of the mapped file, and values
+    pickled separately by ArrayFileWriter.write_value are only unpickled
+    when they're first accessed. Otherwise everything is read into
+    memory as it's unpickled.
+
+    The file isn't opened until the first persistent id is loaded, so
+    a reader can be used to load pickles that don't reference one.
+    """
+
+    def __init__(self, filename, mmap=False):
+        self.__filename = filename
+        self.__mmap = mmap
+        self.__token = None
+        self.__buffer = None
+        self.__fh = None
+        self.__arrays = {}
+
+    def close(self):
+        # lazily loaded values still need the mapping after the pickle's
+        # been loaded, and any memory mapped arrays keep their own reference to it
+        if not self.__mmap:
+            self.__arrays.clear()
+        if self.__fh is not None:
+            self.__fh.close()
+            self.__fh = None
+
+    def __open(self, token):
+        """opens the array file and checks it was written with the same token as a persistent id"""
+        if self.__token is None:
+            header_size = len(_MAGIC) + _TOKEN_SIZE
+            if self.__mmap:
+                self.__buffer = np.memmap(self.__filename, dtype=np.uint8, mode="c")
+                header = self.__buffer[:header_size].tobytes()
+            else:
+                self.__fh = open(self.__filename, "rb")
+                header = self.__fh.read(header_size)
+            if header == _MAGIC + token.encode("ascii"):
+                self.__token = token
+
+        if token != self.__token:
+            raise pickle.UnpicklingError("Array file '%s' wasn't written with the pickle being loaded"
+                                            % self.__filename)
+
+    def __read(self, offset, size):
+        """returns size bytes from offset in the array file as a uint8 array"""
+        if self.__mmap:
+            return self.__buffer[offset:offset + size]
+        self.__fh.seek(offset)
+        return np.fromfile(self.__fh, dtype=np.uint8, count=size)
+
+    def __load_value(self, offset, size):
+        return load(BytesIO(self.__read(offset, size).tobytes()), self)
+
+    def persistent_load(self, pid):
+        tag, token = pid[:2]
+        if tag not in (_PERSISTENT_ID_TAG, _VALUE_PERSISTENT_ID_TAG):
+            raise pickle.UnpicklingError("Unsupported persistent id '%s'" % (pid,))
+        self.__open(token)
+
+        if tag == _VALUE_PERSISTENT_ID_TAG:
+            offset, size = pid[2:]
+            if self.__mmap:
+                from ..nodes import LazyNodeValue
+                return LazyNodeValue(partial(self.__load_value, offset, size))
+            return self.__load_value(offset, size)
+
+        offset, dtype, shape, fortran_order = pid[2:]
+        try:
+            return self.__arrays[offset]
+        except KeyError:
+            pass
+
+        dtype = np.dtype(dtype)
+        count = 1
+        for n in shape:
+            count *= n
+
+        data = self.__read(offset, count * dtype.itemsize).view(dtype)
+        array = data.reshape(shape, order="F" if fortran_order else "C")
+        self.__arrays[offset] = array
+        return array
+
+def dump(obj, fh, array_writer, protocol=pickle.HIGHEST_PROTOCOL):
+    """pickle obj to fh writing large arrays to array_writer"""
+    pickler = pickle.Pickler(fh, protocol)
+    pickler.persistent_id = array_writer.persistent_id
+    pickler.dump(obj)
+
+def load(fh, array_reader):
+    """unpickle an object from fh reading large arrays from array_reader"""
+    unpickler = pickle.Unpickler(fh)
+    unpickler.persistent_load = array_reader.persistent_load
+    return unpickler.load()
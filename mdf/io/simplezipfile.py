@@ -1,91 +1,318 @@
 """
 classes used for reading and writing compressed mdf objects
 """
-from zipfile import ZipFile, ZIP_DEFLATED
-from tempfile import NamedTemporaryFile
+from zipfile import (
+    ZipFile,
+    ZIP_DEFLATED,
+    ZIP_STORED,
+    ZIP64_LIMIT,
+    LargeZipFile,
+    structFileHeader,
+    stringFileHeader,
+    structCentralDir,
+    stringCentralDir,
+    structEndArchive,
+    stringEndArchive,
+    structEndArchive64,
+    stringEndArchive64,
+    structEndArchive64Locator,
+    stringEndArchive64Locator,
+)
 import logging
+import struct
+import time
+import zlib
 import os
 
 _log = logging.getLogger(__name__)
 
+# general purpose flag indicating that the crc and sizes follow the data
+# in a data descriptor rather than being in the local file header
+_FLAG_DATA_DESCRIPTOR = 0x08
+
+_ZIP64_EXTRA_ID = 0x0001
+_ZIP64_VERSION = 45
+_DEFAULT_VERSION = 20
+
+# data written to the zipfile is buffered and compressed in chunks of this size
+_CHUNK_SIZE = 1 << 20
+
 class SimpleZipFile(object):
     """
     File-like object for reading from and writing to simple zipfiles
-    with a single inner file
+    with a single inner file.
+
+    Data is compressed as it's written and decompressed as it's read
+    so no temporary files are used and the whole inner file is never
+    held in memory.
+
+    compresslevel is the zlib compression level (0-9) used when writing
+    with ZIP_DEFLATED compression.
     """
 
     def __init__(self, filename, inner_filename=None, mode="w",
-                    compression=ZIP_DEFLATED, allowZip64=False):
+                    compression=ZIP_DEFLATED, allowZip64=False, compresslevel=None):
+        # not marked as open until the file's been opened successfully
+        self.__closed = True
+
         mode = mode.rstrip("+b")
         assert mode in ("r", "w"), "unsupported mode '%s'" % mode
+        assert compression in (ZIP_DEFLATED, ZIP_STORED), \
+            "unsupported compression '%s'" % compression
         self.__mode = mode
         self.__filename = filename
-        self.__inner_filename = inner_filename
         self.__compression = compression
         self.__allow_zip_64 = allowZip64
-        
-        # keep a reference to unlink as during shutdown the os module may be
-        # discarded before this object is
-        self.__unlink = os.unlink
-        self.__closed = False
-
-        # Open a named temporary file for reading and writing.
-        #
-        # Don't delete on close because the file needs to be closed before it
-        # can be written to the zipfile as there's no way to incremenatally write
-        # bytes to a zipfile, and loading the whole file into memory could be
-        # problematic.
-        #
-        self._fh = NamedTemporaryFile("w+b", delete=False)
 
         if mode == "r":
-            # unzip the whole file into the temporary file
-            zip_fh = ZipFile(filename, "r")
+            self.__zip_fh = ZipFile(filename, "r")
             try:
-                if inner_filename:
-                    self._fh.write(zip_fh.read(inner_filename))
-                else:
-                    infos = zip_fh.infolist()
+                if not inner_filename:
+                    infos = self.__zip_fh.infolist()
                     assert len(infos) == 1, "Multiple entries found (%s)" % infos
-                    self._fh.write(zip_fh.read(infos[0]))
+                    inner_filename = infos[0].filename
+                self._fh = self.__zip_fh.open(inner_filename, "r")
+            except:
+                self.__zip_fh.close()
+                raise
+            self.__closed = False
+            return
 
-                # seek self back to the start of the file for reading
-                self._fh.seek(0, os.SEEK_SET)
-            finally:
-                zip_fh.close()
+        if not inner_filename:
+            base, ext = os.path.splitext(filename)
+            inner_filename = os.path.basename(base) + ".txt"
+
+        if isinstance(inner_filename, bytes):
+            self.__inner_filename = inner_filename
+        else:
+            self.__inner_filename = inner_filename.encode("utf-8")
+
+        if compresslevel is None:
+            compresslevel = zlib.Z_DEFAULT_COMPRESSION
 
-    def __getattr__(self, name):
-        if name in self.__dict__:
-            return self.__dict__[name]
-        if name in self.__class__.__dict__:
-            return self.__dict__.__class__[name]
-        return getattr(self.__dict__["_fh"], name)
+        self.__compressor = None
+        if compression == ZIP_DEFLATED:
+            self.__compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+        self.__crc = 0
+        self.__file_size = 0
+        self.__compress_size = 0
+        self.__buffer = []
+        self.__buffer_size = 0
+
+        t = time.localtime()
+        self.__dos_date = (t[0] - 1980) << 9 | t[1] << 5 | t[2]
+        self.__dos_time = t[3] << 11 | t[4] << 5 | (t[5] // 2)
+
+        self._fh = open(filename, "wb")
+        try:
+            self.__write_local_header()
+        except:
+            self._fh.close()
+            raise
+        self.__closed = False
 
     def __del__(self):
         self.close()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read(self, n=-1):
+        return self._fh.read(n)
+
+    def readline(self, limit=-1):
+        return self._fh.readline(limit)
+
+    def write(self, data):
+        if self.__mode != "w":
+            raise IOError("SimpleZipFile not opened for writing")
+        if self.__closed:
+            raise ValueError("I/O operation on closed file")
+
+        # pickle writes lots of small strings so buffer them up
+        # and compress in larger chunks
+        self.__buffer.append(data)
+        self.__buffer_size += len(data)
+        if self.__buffer_size >= _CHUNK_SIZE:
+            self.__flush_buffer()
+
+    def flush(self):
+        pass
+
     def close(self):
         if self.__closed:
             return
-
-        tmp_filename = self._fh.name
-        self._fh.close()
         self.__closed = True
+
+        if self.__mode == "r":
+            try:
+                self._fh.close()
+            finally:
+                self.__zip_fh.close()
+            return
+
         try:
-            # write everything to the zipfile
-            if "w" in self.__mode:
-                inner_filename = self.__inner_filename
-                if not inner_filename:
-                    base, ext = os.path.splitext(self.__filename)
-                    inner_filename = os.path.basename(base) + ".txt"
-
-                _log.debug("Compressing %s" % (self.__filename))
-                zip_fh = ZipFile(self.__filename, "w", self.__compression)
-                try:
-                    zip_fh.write(tmp_filename, inner_filename)
-                finally:
-                    zip_fh.close()
+            self.__flush_buffer()
+            if self.__compressor is not None:
+                self.__write_compressed(self.__compressor.flush())
+                self.__compressor = None
+
+            _log.debug("Compressed %s (%d -> %d bytes)" % (self.__filename,
+                                                          self.__file_size,
+                                                          self.__compress_size))
+
+            if self.__file_size > ZIP64_LIMIT or self.__compress_size > ZIP64_LIMIT:
+                if not self.__allow_zip_64:
+                    raise LargeZipFile("Filesize would require ZIP64 extensions")
+
+            self.__write_data_descriptor()
+            self.__write_central_directory()
         finally:
-            # delete the tempfile
-            self.__unlink(tmp_filename)
-            self._fh = None
+            self._fh.close()
+
+    def __flush_buffer(self):
+        if not self.__buffer:
+            return
+        data = b"".join(self.__buffer)
+        self.__buffer = []
+        self.__buffer_size = 0
+
+        self.__crc = zlib.crc32(data, self.__crc) & 0xffffffff
+        self.__file_size += len(data)
+        if self.__compressor is not None:
+            data = self.__compressor.compress(data)
+        self.__write_compressed(data)
+
+    def __write_compressed(self, data):
+        if data:
+            self._fh.write(data)
+            self.__compress_size += len(data)
+
+    def __write_local_header(self):
+        # the sizes aren't known until all the data's been written, so they're
+        # left empty here and written in the data descriptor after the data.
+        extract_version = _DEFAULT_VERSION
+        extra = b""
+        file_size = compress_size = 0
+        if self.__allow_zip_64:
+            # the zip64 extra field tells readers the data descriptor has 8 byte sizes
+            extract_version = _ZIP64_VERSION
+            extra = struct.pack("<HHQQ", _ZIP64_EXTRA_ID, 16, 0, 0)
+            file_size = compress_size = 0xffffffff
+
+        self.__extract_version = extract_version
+        self.__header_offset = self._fh.tell()
+        header = struct.pack(structFileHeader,
+                             stringFileHeader,
+                             extract_version,
+                             0,
+                             _FLAG_DATA_DESCRIPTOR,
+                             self.__compression,
+                             self.__dos_time,
+                             self.__dos_date,
+                             0,
+                             compress_size,
+                             file_size,
+                             len(self.__inner_filename),
+                             len(extra))
+        self._fh.write(header)
+        self._fh.write(self.__inner_filename)
+        self._fh.write(extra)
+
+    def __write_data_descriptor(self):
+        fmt = "<4sLQQ" if self.__allow_zip_64 else "<4sLLL"
+        self._fh.write(struct.pack(fmt,
+                                   b"PK\x07\x08",
+                                   self.__crc,
+                                   self.__compress_size,
+                                   self.__file_size))
+
+    def __write_central_directory(self):
+        # any values too large for the standard record go in a zip64 extra field
+        extra_values = []
+        file_size = self.__file_size
+        if file_size > ZIP64_LIMIT:
+            extra_values.append(file_size)
+            file_size = 0xffffffff
+
+        compress_size = self.__compress_size
+        if compress_size > ZIP64_LIMIT:
+            extra_values.append(compress_size)
+            compress_size = 0xffffffff
+
+        header_offset = self.__header_offset
+        if header_offset > ZIP64_LIMIT:
+            extra_values.append(header_offset)
+            header_offset = 0xffffffff
+
+        extra = b""
+        if extra_values:
+            if not self.__allow_zip_64:
+                raise LargeZipFile("Zipfile size would require ZIP64 extensions")
+            extra = struct.pack("<HH" + "Q" * len(extra_values),
+                                _ZIP64_EXTRA_ID,
+                                8 * len(extra_values),
+                                *extra_values)
+
+        centdir_offset = self._fh.tell()
+        centdir = struct.pack(structCentralDir,
+                              stringCentralDir,
+                              self.__extract_version,
+                              3, # unix
+                              self.__extract_version,
+                              0,
+                              _FLAG_DATA_DESCRIPTOR,
+                              self.__compression,
+                              self.__dos_time,
+                              self.__dos_date,
+                              self.__crc,
+                              compress_size,
+                              file_size,
+                              len(self.__inner_filename),
+                              len(extra),
+                              0,
+                              0,
+                              0,
+                              (0o644 & 0xffff) << 16,
+                              header_offset)
+        self._fh.write(centdir)
+        self._fh.write(self.__inner_filename)
+        self._fh.write(extra)
+
+        centdir_size = self._fh.tell() - centdir_offset
+        if centdir_offset > ZIP64_LIMIT:
+            if not self.__allow_zip_64:
+                raise LargeZipFile("Zipfile size would require ZIP64 extensions")
+
+            zip64_end_offset = self._fh.tell()
+            self._fh.write(struct.pack(structEndArchive64,
+                                       stringEndArchive64,
+                                       44,
+                                       _ZIP64_VERSION,
+                                       _ZIP64_VERSION,
+                                       0,
+                                       0,
+                                       1,
+                                       1,
+                                       centdir_size,
+                                       centdir_offset))
+            self._fh.write(struct.pack(structEndArchive64Locator,
+                                       stringEndArchive64Locator,
+                                       0,
+                                       zip64_end_offset,
+                                       1))
+            centdir_offset = 0xffffffff
+
+        self._fh.write(struct.pack(structEndArchive,
+                                   stringEndArchive,
+                                   0,
+                                   0,
+                                   1,
+                                   1,
+                                   centdir_size,
+                                   centdir_offset,
+                                   0))
@@ -0,0 +1,18 @@
+from nodes cimport NodeState, MDFNode
+from nodetypes cimport (
+    MDFDelayNode,
+    MDFCustomNodeIterator,
+    MDFKernel,
+    _queuenode,
+    _delaynode,
+    _samplenode,
+    _cumprodnode,
+    _ffillnode,
+    _returnsnode,
+    _rowiternode,
+)
+from context cimport MDFContext
+
+cpdef list _get_iterator_members(obj)
+cpdef tuple _get_node_state_sizes(MDFNode node, NodeState node_state, set seen)
+cpdef _memory_report(MDFContext ctx, int include_shifted=?, builders=?)
@@ -0,0 +1,281 @@
+"""
+Functions for estimating the memory held by node states in a context.
+
+This is used by MDFContext.memory_report and the MemorySampler builder
+to find out which nodes and shifted contexts are holding on to data.
+
+The sizes are estimates. Numpy arrays and pandas objects are measured
+exactly (nbytes and memory_usage), but other python objects are measured
+using sys.getsizeof on the object and anything it contains. Any object
+seen more than once in the same report is only counted the first time.
+"""
+from nodes import MDFNode, NodeState
+from nodetypes import (
+    MDFDelayNode,
+    MDFCustomNodeIterator,
+    MDFKernel,
+    _queuenode,
+    _delaynode,
+    _samplenode,
+    _cumprodnode,
+    _ffillnode,
+    _returnsnode,
+    _rowiternode,
+)
+from context import MDFContext
+from collections import deque
+import numpy as np
+import pandas as pa
+import cython
+import types
+import sys
+
+# columns of the dataframe held by MemoryReport
+_byte_columns = ["value", "iterator", "dependencies", "total"]
+_columns = ["node", "ctx", "ctx_id", "category"] + _byte_columns
+
+# objects that are shared by the whole graph and not owned by any node state
+_shared_types = (MDFNode,
+                 MDFContext,
+                 type,
+                 types.ModuleType,
+                 types.FunctionType,
+                 types.BuiltinFunctionType,
+                 types.MethodType)
+
+def _sizeof(obj, seen):
+    """
+    returns the estimated number of bytes held by obj, excluding any objects
+    whose ids are in the set seen. seen is updated with the ids of any objects
+    counted.
+    """
+    if obj is None or isinstance(obj, _shared_types):
+        return 0
+
+    obj_id = id(obj)
+    if obj_id in seen:
+        return 0
+    seen.add(obj_id)
+
+    if isinstance(obj, np.ndarray):
+        # views don't own their data, so only count the data for the owner
+        size = sys.getsizeof(obj, 0)
+        if obj.flags.owndata:
+            size += obj.nbytes
+        if obj.dtype == object:
+            for x in obj.flat:
+                size += _sizeof(x, seen)
+        return size
+
+    if isinstance(obj, (pa.Series, pa.DataFrame)):
+        usage = obj.memory_usage(index=True, deep=True)
+        if isinstance(usage, pa.Series):
+            usage = usage.sum()
+        return int(usage)
+
+    size = sys.getsizeof(obj, 0)
+
+    if isinstance(obj, (list, tuple, set, frozenset, deque)):
+        for x in obj:
+            size += _sizeof(x, seen)
+        return size
+
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += _sizeof(k, seen)
+            size += _sizeof(v, seen)
+        return size
+
+    # generators keep their state in the frame's locals
+    frame = getattr(obj, "gi_frame", None)
+    if frame is not None:
+        for x in frame.f_locals.values():
+            size += _sizeof(x, seen)
+        return size
+
+    # the node type iterators are extension types without a __dict__
+    for x in _get_iterator_members(obj):
+        size += _sizeof(x, seen)
+
+    obj_dict = getattr(obj, "__dict__", None)
+    if obj_dict is not None:
+        size += _sizeof(obj_dict, seen)
+
+    return size
+
+def _get_iterator_members(obj):
+    """
+    returns a list of the objects referenced by the built-in node type
+    iterators (or an empty list if obj isn't one of those iterators)
+    """
+    custom_iter = cython.declare(MDFCustomNodeIterator)
+    queue_iter = cython.declare(_queuenode)
+    delay_iter = cython.declare(_delaynode)
+    sample_iter = cython.declare(_samplenode)
+    kernel_iter = cython.declare(MDFKernel)
+    cumprod_iter = cython.declare(_cumprodnode)
+    ffill_iter = cython.declare(_ffillnode)
+    returns_iter = cython.declare(_returnsnode)
+    rowiter_iter = cython.declare(_rowiternode)
+
+    if isinstance(obj, MDFCustomNodeIterator):
+        custom_iter = obj
+        return [custom_iter.value_generator, custom_iter.node_type_generator]
+
+    if isinstance(obj, _queuenode):
+        queue_iter = obj
+        return [queue_iter.queue]
+
+    if isinstance(obj, _delaynode):
+        delay_iter = obj
+        return [delay_iter.queue]
+
+    if isinstance(obj, _samplenode):
+        sample_iter = obj
+        return [sample_iter._sample]
+
+    if isinstance(obj, _cumprodnode):
+        cumprod_iter = obj
+        return [cumprod_iter.accum, cumprod_iter.nan_mask]
+
+    if isinstance(obj, _ffillnode):
+        ffill_iter = obj
+        return [ffill_iter.current_value]
+
+    if isinstance(obj, _returnsnode):
+        returns_iter = obj
+        return [returns_iter.out, returns_iter.current_values, returns_iter.prev_values]
+
+    if isinstance(obj, MDFKernel):
+        kernel_iter = obj
+        return [kernel_iter.out]
+
+    if isinstance(obj, _rowiternode):
+        rowiter_iter = obj
+        return [rowiter_iter._data,
+                rowiter_iter._current_value,
+                rowiter_iter._prev_value,
+                rowiter_iter._missing_value]
+
+    return []
+
+def _get_node_state_sizes(node, node_state, seen):
+    """
+    returns a tuple of (value bytes, iterator bytes, dependency bytes)
+    for a node state.
+    """
+    delay_node = cython.declare(MDFDelayNode)
+
+    value_size = _sizeof(node_state.value, seen)
+
+    iterator_size = _sizeof(node_state.generator, seen)
+
+    # delay nodes keep the previous values outside of the node state
+    if isinstance(node, MDFDelayNode):
+        delay_node = node
+        data = delay_node._dn_per_ctx_data.get(node_state.ctx_id)
+        if data is not None:
+            iterator_size += _sizeof(data, seen)
+
+    dependency_size = _sizeof(node_state.callers, seen) \
+                    + _sizeof(node_state.callees, seen) \
+                    + _sizeof(node_state.depends_on_cache, seen) \
+                    + _sizeof(node_state.add_dependency_cache, seen)
+
+    return value_size, iterator_size, dependency_size
+
+def _memory_report(ctx, include_shifted=True, builders=None):
+    """
+    returns a MemoryReport of the estimated memory held by all nodes in ctx,
+    and all of its shifted contexts if include_shifted is True.
+
+    If builders is not None it should be a list of builder objects (e.g. those
+    passed to mdf.run) and the memory held by each of those is included in
+    the report with the category 'builder'.
+    """
+    node = cython.declare(MDFNode)
+    node_state = cython.declare(NodeState)
+    shifted_ctx = cython.declare(MDFContext)
+
+    contexts = [ctx]
+    if include_shifted and ctx.get_parent() is None:
+        contexts.extend(ctx.get_shifted_contexts())
+
+    seen = set()
+    rows = []
+    for shifted_ctx in contexts:
+        ctx_id = shifted_ctx._id
+        for node in shifted_ctx._nodes_with_state:
+            node_state = node._states[shifted_ctx._id_obj]
+            value_size, iterator_size, dependency_size = \
+                _get_node_state_sizes(node, node_state, seen)
+            total_size = value_size + iterator_size + dependency_size
+
+            for category in node.categories:
+                rows.append((node.name,
+                             str(shifted_ctx),
+                             ctx_id,
+                             category,
+                             value_size,
+                             iterator_size,
+                             dependency_size,
+                             total_size))
+
+    for builder in (builders or []):
+        size = _sizeof(builder, seen)
+        rows.append(("<%s 0x%x>" % (builder.__class__.__name__, id(builder)),
+                     str(ctx),
+                     ctx.get_id(),
+                     "builder",
+                     size,
+                     0,
+                     0,
+                     size))
+
+    return MemoryReport(rows)
+
+class MemoryReport(object):
+    """
+    Estimated memory held by nodes in a context and its shifted contexts.
+
+    The full report is available as a dataframe with one row per node,
+    context and category. Nodes in more than one category appear once for
+    each category, so use the aggregated views by_node, by_context and
+    by_category rather than summing the dataframe directly.
+    """
+
+    def __init__(self, rows):
+        self.dataframe = pa.DataFrame(rows, columns=_columns)
+
+    @property
+    def total(self):
+        """total estimated bytes held by all nodes and builders in the report"""
+        return int(self.by_context()["total"].sum())
+
+    def by_node(self):
+        """returns a dataframe of bytes per node, largest first"""
+        return self._aggregate("node")
+
+    def by_context(self):
+        """returns a dataframe of bytes per context, largest first"""
+        return self._aggregate("ctx")
+
+    def by_category(self):
+        """returns a dataframe of bytes per category, largest first"""
+        df = self.dataframe.copy()
+        df["category"] = df["category"].fillna("None")
+        return df.groupby("category")[_byte_columns].sum().sort_values("total", ascending=False)
+
+    def _aggregate(self, key):
+        # nodes with several categories have a row for each one
+        df = self.dataframe.drop_duplicates(subset=["node", "ctx_id"])
+        return df.groupby(key)[_byte_columns].sum().sort_values("total", ascending=False)
+
+    def __str__(self):
+        return "<MemoryReport: %d nodes, %d contexts, %.1f Mb>" % (
+                    len(self.by_node()),
+                    len(self.by_context()),
+                    self.total / float(1 << 20))
+
+    def __repr__(self):
+        return str(self)
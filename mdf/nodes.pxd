@@ -37,6 +37,7 @@ cdef class MDFNode(MDFNodeBase):
     # from base class
     # cdef bint _has_set_date_callback
     # cdef bint _has_timestep_update
+    # cdef bint _keep_history
 
     cdef object _name
     cdef object _short_name
@@ -90,6 +91,10 @@ cdef class MDFNode(MDFNodeBase):
     cpdef MDFNode get_override(self, MDFContext ctx)
     cpdef get_state(self, MDFContext)
 
+cpdef _get_all_callers(nodes)
+cpdef _get_affected_nodes(MDFContext ctx)
+cpdef MDFContext _get_node_alt_context(MDFNode node, MDFContext ctx)
+
 cdef class MDFVarNode(MDFNode):
     cdef object _default_value
     cdef MDFContext _get_alt_context(self, MDFContext ctx)
@@ -100,6 +105,7 @@ cdef class MDFEvalNode(MDFNode):
     cdef int _is_generator
     cdef object _filter_func
     cdef dict _bound_nodes
+    cdef object _cache
 
     # docstring of the inner function
     cdef public object func_doc
@@ -10,7 +10,7 @@ import types
 import os
 import re
 from .parser import tokenize, get_assigned_node_name
-from context import MDFContext, MDFNodeBase
+from context import MDFContext, MDFNodeBase, get_nodes
 from common import DIRTY_FLAGS
 
 # these are cimported in nodes.pxd
@@ -33,8 +33,14 @@ def enable_trace(enable=True):
     global _trace_enabled
     _trace_enabled = enable
 
+# categories of nodes with history enabled (see keep_history)
+_history_categories = set()
+
 _pickle_node = None
 _unpickle_node = None
+_get_cached_value = None
+_cache_value = None
+_cache_miss = None
 
 def _lazy_imports():
     global _pickle_node, _unpickle_node
@@ -42,6 +48,12 @@ def _lazy_imports():
     _pickle_node = ctx_pickle._pickle_node
     _unpickle_node = ctx_pickle._unpickle_node
 
+    global _get_cached_value, _cache_value, _cache_miss
+    import cache
+    _get_cached_value = cache._get_cached_value
+    _cache_value = cache._cache_value
+    _cache_miss = cache._cache_miss
+
 
 def _get_calling_module_and_class():
     """
@@ -206,6 +218,15 @@ class NodeState(object):
             ),
         ]) + "\n</NodeState>"
 
+class LazyNodeValue(object):
+    """
+    placeholder for a node value that's only loaded the first time
+    it's accessed, used when loading saved contexts.
+    """
+
+    def __init__(self, load):
+        self.load = load
+
 class MDFIterator(object):
     """
     MDFIterator is used as a way of writing path-dependent evalnodes.
@@ -393,6 +414,7 @@ class MDFNode(MDFNodeBase):
         self._has_on_dirty_callback = hasattr(self, "on_set_dirty")
         self._has_set_date_callback = hasattr(self, "on_set_date")
         self._has_timestep_update = False
+        self._keep_history = bool(_history_categories.intersection(self._categories))
         self._dirty_flags_propagate_mask = self.dirty_flags_propagate_mask
 
         # derived nodes are nodes that are derived from this one via the special methods added to
@@ -546,6 +568,7 @@ class MDFNode(MDFNodeBase):
 
         # otherwise create a new state for this context and return it
         state = self._states[ctx._id_obj] = NodeState(ctx._id_obj, self._default_dirty_flags_)
+        ctx._nodes_with_state[self] = None
         return state
 
     def get_state(self, ctx):
@@ -587,6 +610,7 @@ class MDFNode(MDFNodeBase):
             del self._states[ctx._id_obj]
         except KeyError:
             pass
+        ctx._nodes_with_state.pop(self, None)
 
     def clear_value(self, ctx):
         """
@@ -639,6 +663,10 @@ class MDFNode(MDFNodeBase):
         # don't add this dependency again
         node_state.add_dependency_cache.add((called_node, called_ctx._id_obj))
 
+        # the dependency graph has changed, so any affected node sets computed
+        # for the shifted contexts of a root context need recomputing
+        ctx._dependency_version += 1
+
         self._clear_dependency_cache(ctx)
 
     def _clear_dependency_cache(self, ctx):
@@ -997,6 +1025,9 @@ class MDFNode(MDFNodeBase):
         if not node_state.has_value:
             raise KeyError("%s not found in %s" % (self.name, ctx))
 
+        if type(node_state.value) is LazyNodeValue:
+            node_state.value = node_state.value.load()
+
         return node_state.value, node_state.date
 
     def _get_cached_value(self, ctx):
@@ -1005,6 +1036,8 @@ class MDFNode(MDFNodeBase):
         *doesn't check a value exists*
         """
         node_state = self._get_state(ctx)
+        if type(node_state.value) is LazyNodeValue:
+            node_state.value = node_state.value.load()
         return node_state.value
 
     def get_alt_context(self, ctx):
@@ -1083,6 +1116,9 @@ class MDFNode(MDFNodeBase):
         node_state.date = ctx._now
         node_state.value = value
 
+        if self._keep_history:
+            ctx._append_history(self, value)
+
         # touch the node to reset the flags and touch and callers
         self._touch(node_state, DIRTY_FLAGS_ALL, _quiet)
 
@@ -1265,6 +1301,95 @@ def create_NodeSetDirtyState(depth, node_state, node, flags):
     obj.flags = flags
     return obj
 
+def _get_all_callers(nodes):
+    """
+    returns the set of nodes and all the nodes that call them, directly
+    or indirectly, in any context in the dependency graph built so far.
+    """
+    node = cython.declare(MDFNode)
+    caller = cython.declare(MDFNode)
+    node_state = cython.declare(NodeState)
+
+    # walk up the callers of the nodes in all contexts
+    all_callers = set()
+    remaining = cqueue()
+    for node in nodes:
+        all_callers.add(node)
+        for node_state in node._states.itervalues():
+            cqueue_push(remaining, node_state)
+
+    seen = set()
+    while cqueue_len(remaining) > 0:
+        node_state = cqueue_popleft(remaining)
+        if node_state in seen:
+            continue
+        seen.add(node_state)
+
+        for ctx_id, callers in node_state.callers.iteritems():
+            for caller in callers:
+                all_callers.add(caller)
+                try:
+                    cqueue_push(remaining, caller._states[ctx_id])
+                except KeyError:
+                    pass
+
+    return all_callers
+
+def _get_node_alt_context(node, ctx):
+    """
+    returns the context the value of node in ctx belongs in, i.e. the
+    least shifted context with all the shifts the node depends on
+    (see MDFNode.get_alt_context).
+    """
+    return node.get_alt_context(ctx)
+
+def _get_affected_nodes(ctx):
+    """
+    returns the set of nodes that could depend on any of the nodes ctx
+    is shifted by (see _get_all_callers).
+
+    The set is cached on ctx until a new dependency is added in the parent
+    context.
+    """
+    parent = cython.declare(MDFContext)
+    parent = ctx._parent
+    if ctx._affected_nodes is not None \
+    and ctx._affected_nodes_version == parent._dependency_version:
+        return ctx._affected_nodes
+
+    ctx._affected_nodes = _get_all_callers(ctx._shift_set)
+    ctx._affected_nodes_version = parent._dependency_version
+    return ctx._affected_nodes
+
+def keep_history(node=None, category=None):
+    """
+    Enables keeping the history of a node's values in each context it's
+    evaluated in, so they can be retrieved later using
+    :py:meth:`MDFContext.history`.
+
+    Can be used as a decorator on a node, or called with a category to
+    enable history for all nodes in that category, including any nodes
+    created later::
+
+        @keep_history
+        @evalnode
+        def my_node():
+            ...
+
+        keep_history(category="pnl")
+    """
+    node_ = cython.declare(MDFNode)
+    if node is not None:
+        node_ = node
+        node_._keep_history = True
+        return node
+
+    assert category is not None, "keep_history requires a node or a category"
+    categories = [category] if isinstance(category, basestring) else category
+    _history_categories.update(categories)
+    for node_ in get_nodes(categories):
+        node_._keep_history = True
+
 class MDFVarNode(MDFNode):
     """most basic type of node that just holds a value"""
     _no_default_value_ = object()
@@ -1372,11 +1497,13 @@ class MDFEvalNode(MDFNode):
 
     _staticmethod_counter = itertools.count()
 
-    def __init__(self, func, name=None, short_name=None, fqname=None, cls=None, category=None, filter=None):
+    def __init__(self, func, name=None, short_name=None, fqname=None, cls=None, category=None, filter=None, cache=None):
         self._func = self._validate_func(func)
         self._bound_nodes = {}
         self._is_generator = _isgeneratorfunction(self._func)
         self._filter_func = filter
+        self._cache = cache if cache is not False else None
+        assert self._cache is None or not self._is_generator, "generator nodes can't be cached"
         if name is None:
             name = self._get_func_name(func)
         MDFNode.__init__(self, name=name, short_name=short_name, fqname=fqname, cls=cls, category=category)
@@ -1434,6 +1561,8 @@ class MDFEvalNode(MDFNode):
         else:
             self._filter_func = other._filter_func
 
+        self._cache = other._cache
+
         # set the docstring for the bound node to the same as the unbound one
         self.func_doc = other.func_doc
 
@@ -1576,6 +1705,12 @@ class MDFEvalNode(MDFNode):
                                                       ctx,
                                                       DIRTY_FLAGS.to_string(dirty_flags)))
 
+        # if the node's cached look for a value from a previous run
+        if self._cache is not None:
+            value = _get_cached_value(self, self._cache, ctx)
+            if value is not _cache_miss:
+                return value
+
         # call the function, set the value and return it
         if _profiling_enabled:
             with ctx._profile(self) as timer:
@@ -1583,6 +1718,9 @@ class MDFEvalNode(MDFNode):
         else:
             value = self._func()
 
+        if self._cache is not None:
+            _cache_value(self, self._cache, ctx, value)
+
         if self._is_generator:
             gen = value
 
@@ -1636,9 +1774,21 @@ class MDFEvalNode(MDFNode):
         best_match_num_shifts = cython.declare(int)
         shifted_node = cython.declare(MDFNode)
 
+        parent = ctx.get_parent() or ctx
+
+        # if this node has been called in the parent context and isn't one of the
+        # nodes that could be affected by the shift then it belongs in the parent.
+        if parent is not ctx:
+            try:
+                shifted_node_state = self._states[parent._id_obj]
+                if shifted_node_state.called \
+                and self not in _get_affected_nodes(ctx):
+                    return parent
+            except KeyError:
+                pass
+
         # find the most shifted context where this node has been called
         # and where this context is a shift of that shifted context
-        parent = ctx.get_parent() or ctx
 
         best_match = None
         best_match_num_shifts = -1
@@ -1721,9 +1871,11 @@ class MDFEvalNode(MDFNode):
                 self.add_dependency(alt_ctx, callee, callee_ctx)
 
         # remove dependencies from self[ctx] since effectively we
-        # called self[alt_ctx] instead
+        # called self[alt_ctx] instead, which is the same dependency
+        # added when self[ctx] is evaluated from alt_ctx subsequently.
         node_state.callees.clear()
         self._clear_dependency_cache(ctx)
+        self.add_dependency(ctx, self, alt_ctx)
 
         # transfer the generator from ctx to alt_ctx
         alt_state.generator = node_state.generator
@@ -1766,7 +1918,7 @@ class MDFEvalNode(MDFNode):
         MDFNode.set_value(self, ctx, value)
 
 # for using decorator syntax to delclare eval nodes
-def evalnode(func=None, filter=None, category=None):
+def evalnode(func=None, filter=None, category=None, cache=None):
     """
     Decorator for creating an :py:class:`MDFNode` whose value is determined
     by calling the function func.
@@ -1816,10 +1968,16 @@ def evalnode(func=None, filter=None, category=None):
     the node valuation being advanced on every timestep. If supplied, it
     should be a function or node that returns True if the node should
     be advanced for the current timestep or False otherwise.
+
+    **cache** may be set to a :py:class:`NodeCache`, or True to use the
+    default cache, to store the node's values on disk and re-use them in
+    later runs instead of calling *func*. The values are keyed by the
+    node's code and the values of the varnodes and shifts it depends on,
+    so *func* must be a pure function of those and not a generator.
     """
     if func:
-        return MDFEvalNode(func, category=category, filter=filter)
-    return lambda x: evalnode(x, filter, category)
+        return MDFEvalNode(func, category=category, filter=filter, cache=cache)
+    return lambda x: evalnode(x, filter, category, cache)
 
 class MDFTimeNode(MDFVarNode):
 
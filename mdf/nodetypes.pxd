@@ -22,6 +22,8 @@ cdef class MDFCustomNode(MDFEvalNode):
     # protected python methods
     cpdef _cn_eval_func(self)
 
+cdef class MDFKernel(MDFIterator)
+
 cdef class MDFCustomNodeIterator(MDFIterator):
     cdef MDFCustomNode custom_node
     cdef object func
@@ -30,6 +32,8 @@ cdef class MDFCustomNodeIterator(MDFIterator):
     cdef int is_generator
     cdef int node_type_is_generator
     cdef object node_type_generator
+    cdef int node_type_is_kernel
+    cdef MDFKernel kernel
 
 cdef class MDFQueueNode(MDFCustomNode):
     pass
@@ -65,19 +69,31 @@ cdef class _samplenode(MDFIterator):
     cpdef next(self)
     cpdef send(self, value)
 
-cdef class MDFNanSumNode(MDFCustomNode):
-    pass
-
-cdef class _nansumnode(MDFIterator):
-    cdef object accum
-    cdef double accum_f
+cdef class MDFKernel(MDFIterator):
     cdef int is_float
-
+    cdef double value_f
+    cdef object out
+    cdef double[:] out_view
+    cdef object index
+    cdef object universe
+    cdef tuple shape
+
+    # methods implemented by subclasses
+    cdef init_float(self)
+    cdef init_array(self, Py_ssize_t size)
+    cdef double send_float(self, double value) except? -1
+    cdef send_array(self, double[:] value, double[:] out)
+
+    cdef _send(self, value)
     cpdef next(self)
     cpdef send(self, value)
 
-    cdef inline _send_vector(self, value)
-    cdef inline double _send_float(self, double value)
+cdef class MDFNanSumNode(MDFCustomNode):
+    pass
+
+cdef class _nansumnode(MDFKernel):
+    cdef double send_float(self, double value) except? -1
+    cdef send_array(self, double[:] value, double[:] out)
 
 cdef class MDFCumulativeProductNode(MDFCustomNode):
     pass
@@ -104,17 +120,18 @@ cdef class _ffillnode(MDFIterator):
     cpdef next(self)
     cpdef send(self, value)
 
-cdef class _returnsnode(MDFIterator):
-    cdef int is_float
+cdef class _returnsnode(MDFKernel):
     cdef double current_value_f
     cdef double prev_value_f
-    cdef double return_f
-    cdef object current_value
-    cdef object prev_value
-    cdef object returns
+    cdef object current_values
+    cdef object prev_values
+    cdef double[:] current_view
+    cdef double[:] prev_view
 
-    cpdef next(self)
-    cpdef send(self, value)
+    cdef init_float(self)
+    cdef init_array(self, Py_ssize_t size)
+    cdef double send_float(self, double value) except? -1
+    cdef send_array(self, double[:] value, double[:] out)
 
 cdef class _rowiternode(MDFIterator):
     cdef object _data
@@ -127,6 +144,7 @@ cdef class _rowiternode(MDFIterator):
     cdef object _missing_value_orig
     cdef object _missing_value
     cdef int _ffill
+    cdef object _universe
     cdef int _is_dataframe
     cdef int _is_widepanel
     cdef int _is_series
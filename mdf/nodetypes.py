@@ -5,6 +5,7 @@ import numpy as np
 import pandas as pa
 import inspect
 import types
+import threading
 import sys
 import cython
 
@@ -22,6 +23,7 @@ from .nodes import (
 from .context import MDFContext, _get_current_context
 from .ctx_pickle import _unpickle_custom_node, _pickle_custom_node
 from .parser import get_assigned_node_name
+from .universe import Universe, PanelArray
 from .common import DIRTY_FLAGS
 
 _python_version = cython.declare(int, sys.version_info[0])
@@ -78,6 +80,11 @@ class MDFCustomNodeIterator(MDFIterator):
         self.node_type_is_generator = _isgeneratorfunction(self.node_type_func)
         self.node_type_generator = None
 
+        # kernels are called directly rather than via send (see MDFKernel)
+        self.node_type_is_kernel = isinstance(self.node_type_func, type) \
+                                    and issubclass(self.node_type_func, MDFKernel)
+        self.kernel = None
+
     def __iter__(self):
         return self
 
@@ -92,6 +99,15 @@ class MDFCustomNodeIterator(MDFIterator):
             else:
                 value = self.func()
 
+        if self.node_type_is_kernel:
+            if self.kernel is None:
+                kwargs = self.custom_node._get_kwargs()
+                self.kernel = self.node_type_func(value, **kwargs)
+                self.node_type_generator = self.kernel
+                return self.kernel.next()
+
+            return self.kernel._send(value)
+
         if self.node_type_is_generator:
             if not self.node_type_generator:
                 # create the new node type generator and return
@@ -282,6 +298,11 @@ class MDFCustomNode(MDFEvalNode):
         """node this custom node was derived from if created via a method call."""
         return self._base_node
 
+    @property
+    def kwnodes(self):
+        """nodes passed as keyword arguments to the node type function."""
+        return dict(self._kwnodes)
+
     #
     # Properties for use with MDFCustomNodeIterator
     #
@@ -1011,7 +1032,7 @@ class _delaynode(MDFIterator):
             if isinstance(value, pa.Series):
                 initial_value = pa.Series(initial_value, index=value.index, dtype=value.dtype)
             elif isinstance(value, np.ndarray):
-                tmp = np.ndarray(value.shape, dtype=value.dtype)
+                tmp = np.empty_like(value)
                 tmp.fill(initial_value)
                 initial_value = tmp
 
@@ -1078,7 +1099,7 @@ class _samplenode(MDFIterator):
             if isinstance(value, pa.Series):
                 initial_value = pa.Series(initial_value, index=value.index, dtype=value.dtype)
             elif isinstance(value, np.ndarray):
-                tmp = np.ndarray(value.shape, dtype=value.dtype)
+                tmp = np.empty_like(value)
                 tmp.fill(initial_value)
                 initial_value = tmp
 
@@ -1099,10 +1120,135 @@ class _samplenode(MDFIterator):
 # decorators don't work on cythoned classes
 samplenode = nodetype(_samplenode, cls=MDFSampleNode, method="sample")
 
+class MDFKernel(MDFIterator):
+    """
+    Base class for node types written as Cython cdef classes with typed
+    methods, which are called directly from C each timestep instead of
+    through Python.
+
+    The node value may be a float, a numpy array, a pandas Series or a
+    :py:class:`mdf.PanelArray` and is converted to a double or an array of
+    doubles. Subclasses implement
+    the typed methods for the values they support and call
+    MDFKernel.__init__ at the end of their own __init__ once their
+    parameters have been set up. Any keyword arguments are only evaluated
+    once when the kernel is constructed.
+
+    For floats, init_float is called once and then send_float is called
+    with each new value and returns the node's new value. self.value_f is
+    the node's previous value (initially NaN).
+
+    For arrays, init_array is called once with the number of elements and
+    then send_array is called with each new value (flattened) and writes
+    the node's new value to out. out holds the previous value when
+    send_array is called (initially all NaN).
+
+    A kernel is registered with :py:func:`nodetype` in the same way as any
+    other :py:class:`MDFIterator`. e.g. in a .pxd file::
+
+        cdef class _mykernel(MDFKernel):
+            cdef double scale
+            cdef double send_float(self, double value) except? -1
+            cdef send_array(self, double[:] value, double[:] out)
+
+    and in the .pyx or .py file::
+
+        class _mykernel(MDFKernel):
+            _init_kwargs_ = ["filter_node_value", "scale"]
+
+            def __init__(self, value, filter_node_value, scale=1.0):
+                self.scale = scale
+                MDFKernel.__init__(self, value, filter_node_value)
+
+            def send_float(self, value):
+                return value * self.scale
+
+            def send_array(self, value, out):
+                for i in range(value.shape[0]):
+                    out[i] = value[i] * self.scale
+
+        mykernelnode = nodetype(cls=MDFMyKernelNode, method="mykernel")(_mykernel)
+    """
+    _init_kwargs_ = ["filter_node_value"]
+
+    def __init__(self, value, filter_node_value=True):
+        self.index = None
+        self.universe = None
+        self.shape = None
+        if isinstance(value, (pa.Series, np.ndarray)):
+            self.is_float = False
+            if isinstance(value, pa.Series):
+                self.index = value.index
+            elif isinstance(value, PanelArray):
+                self.universe = value.universe
+            self.shape = value.shape
+            self.out = np.empty(int(np.prod(value.shape)), dtype=np.float64)
+            self.out.fill(np.nan)
+            self.out_view = self.out
+            self.init_array(len(self.out))
+        else:
+            self.is_float = True
+            self.value_f = np.nan
+            self.init_float()
+
+        if filter_node_value:
+            self._send(value)
+
+    def init_float(self):
+        """called once when the node's values are floats"""
+        pass
+
+    def init_array(self, size):
+        """called once with the number of elements when the node's values are arrays"""
+        pass
+
+    def send_float(self, value):
+        """returns the node's new value given the latest float value"""
+        raise NotImplementedError("%s doesn't support float values" % self.__class__.__name__)
+
+    def send_array(self, value, out):
+        """writes the node's new value to out given the latest values"""
+        raise NotImplementedError("%s doesn't support array values" % self.__class__.__name__)
+
+    def _send(self, value):
+        if self.is_float:
+            self.value_f = self.send_float(value)
+            return self.value_f
+
+        if self.index is not None:
+            # Series are aligned by label to the index of the first value
+            if value.index is not self.index and not value.index.equals(self.index):
+                value = value.reindex(self.index)
+            value = value.values
+        elif self.universe is not None:
+            if not isinstance(value, PanelArray) or value.universe is not self.universe:
+                raise ValueError("%s expects values for the same universe each time" % self.__class__.__name__)
+
+        array = np.ascontiguousarray(value, dtype=np.float64).reshape(-1)
+        if array.shape[0] != self.out.shape[0]:
+            raise ValueError("%s expects values with %d elements; got %d" % (self.__class__.__name__,
+                                                                             self.out.shape[0],
+                                                                             array.shape[0]))
+        self.send_array(array, self.out_view)
+        return self.next()
+
+    def next(self):
+        if self.is_float:
+            return self.value_f
+        out = self.out.reshape(self.shape)
+        if self.index is not None:
+            return pa.Series(out.copy(), index=self.index)
+        if self.universe is not None:
+            return self.universe.wrap(out.copy())
+        return out.copy()
+
+    def send(self, value):
+        return self._send(value)
+
 class MDFNanSumNode(MDFCustomNode):
     pass
 
-class _nansumnode(MDFIterator):
+class _nansumnode(MDFKernel):
     """
     Decorator that creates an :py:class:`MDFNode` that maintains
     the `nansum` of the result of `func`.
@@ -1130,47 +1276,29 @@ class _nansumnode(MDFIterator):
     _init_kwargs_ = ["filter_node_value"]
 
     def __init__(self, value, filter_node_value):
-        self.is_float = False
-        if isinstance(value, pa.Series):
-            self.accum = pa.Series(np.nan, index=value.index, dtype=value.dtype)
-        elif isinstance(value, np.ndarray):
-            self.accum = np.ndarray(value.shape, dtype=value.dtype)
-            self.accum.fill(np.nan)
-        else:
-            self.is_float = True
-            self.accum_f = np.nan
-            
-        if filter_node_value:
-            self.send(value)
-
-    def _send_vector(self, value):
-        mask = ~np.isnan(value)
-
-        # set an nans in the accumulator where the value is not
-        # NaN to zero
-        accum_mask = np.isnan(self.accum)
-        if accum_mask.any():
-            self.accum[accum_mask & mask] = 0.0
-
-        self.accum[mask] += value[mask]
-        return self.accum.copy()
+        MDFKernel.__init__(self, value, filter_node_value)
 
-    def _send_float(self, value):
+    def send_float(self, value):
+        accum = cython.declare(cython.double, self.value_f)
         if value == value:
-            if self.accum_f != self.accum_f:
-                self.accum_f = 0.0
-            self.accum_f += value
-        return self.accum_f
-
-    def next(self):
-        if self.is_float:
-            return self.accum_f
-        return self.accum.copy()
-
-    def send(self, value):
-        if self.is_float:
-            return self._send_float(value)
-        return self._send_vector(value)
+            if accum != accum:
+                accum = 0.0
+            accum += value
+        return accum
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def send_array(self, value, out):
+        i = cython.declare(cython.Py_ssize_t)
+        x = cython.declare(cython.double)
+        accum = cython.declare(cython.double)
+        for i in range(value.shape[0]):
+            x = value[i]
+            if x == x:
+                accum = out[i]
+                if accum != accum:
+                    accum = 0.0
+                out[i] = accum + x
 
 # decorators don't work on cythoned types
 nansumnode = nodetype(cls=MDFNanSumNode, method="nansum")(_nansumnode)
@@ -1321,7 +1449,7 @@ class _ffillnode(MDFIterator):
                                                        index=value.index,
                                                        dtype=value.dtype)
                     else:
-                        self.current_value = np.ndarray(value.shape, dtype=value.dtype)
+                        self.current_value = np.empty_like(value)
                         self.current_value.fill(initial_value) 
                 else:
                     # this ensures the current_value ends up being the same type
@@ -1332,7 +1460,7 @@ class _ffillnode(MDFIterator):
                 if isinstance(value, pa.Series):
                     self.current_value = pa.Series(np.nan, index=value.index, dtype=value.dtype)
                 else:
-                    self.current_value = np.ndarray(value.shape, dtype=value.dtype)
+                    self.current_value = np.empty_like(value)
                     self.current_value.fill(np.nan)
 
         # update the current value
@@ -1363,7 +1491,7 @@ ffillnode = nodetype(cls=MDFForwardFillNode, method="ffill")(_ffillnode)
 class MDFReturnsNode(MDFCustomNode):
     pass
 
-class _returnsnode(MDFIterator):
+class _returnsnode(MDFKernel):
     """
     Decorator that creates an :py:class:`MDFNode` that returns
     the returns of a price series.
@@ -1397,63 +1525,60 @@ class _returnsnode(MDFIterator):
     _init_kwargs_ = ["filter_node_value"]
 
     def __init__(self, value, filter_node_value):
-        self.is_float = False
-        if isinstance(value, float):
-            # floating point returns
-            self.is_float = True
-            self.prev_value_f = np.nan
-            self.current_value_f = np.nan
-            self.return_f = 0.0
-        else:
-            # Series or ndarray returns
-            if not isinstance(value, (pa.Series, np.ndarray)):
-                raise RuntimeError("returns node expects a float, pa.Series or ndarray") 
-    
-            if isinstance(value, pa.Series):
-                self.prev_value = pa.Series(np.nan, index=value.index)
-                self.current_value = pa.Series(np.nan, index=value.index)
-            else:
-                self.prev_value = np.ndarray(value.shape, dtype=value.dtype)
-                self.current_value = np.ndarray(value.shape, dtype=value.dtype)
-                self.returns = np.ndarray(value.shape, dtype=value.dtype)
-                self.prev_value.fill(np.nan)
-                self.current_value.fill(np.nan)
-                self.returns.fill(0.0)
-
-        # update the current value
-        if filter_node_value:
-            self.send(value)
-
-    def next(self):
-        if self.is_float:
-            return self.return_f
-        return self.returns
-
-    def send(self, value):
-        if self.is_float:
-            value_f = cython.declare(cython.double, value)
-
-            # advance previous to the current value and update current
-            # value with the new value unless it's nan (in which case we
-            # leave it as it is - ie fill forward).
-            self.prev_value_f = self.current_value_f
-            if value_f == value_f:
-                self.current_value_f = value_f
-
-            self.return_f = (self.current_value_f / self.prev_value_f) - 1.0
-            if np.isnan(self.return_f):
-                self.return_f = 0.0
-            return self.return_f
-
-        # advance prev_value and update current value with any new
-        # non-nan values
-        mask = ~np.isnan(value)
-        self.prev_value = self.current_value.copy()
-        self.current_value[mask] = value[mask]
-
-        self.returns = (self.current_value / self.prev_value) - 1.0
-        self.returns[np.isnan(self.returns)] = 0.0
-        return self.returns
+        if not isinstance(value, (float, pa.Series, np.ndarray)):
+            raise RuntimeError("returns node expects a float, pa.Series or ndarray")
+        MDFKernel.__init__(self, value, filter_node_value)
+
+    def init_float(self):
+        self.prev_value_f = np.nan
+        self.current_value_f = np.nan
+        self.value_f = 0.0
+
+    def init_array(self, size):
+        self.prev_values = np.empty(size, dtype=np.float64)
+        self.prev_values.fill(np.nan)
+        self.prev_view = self.prev_values
+        self.current_values = np.empty(size, dtype=np.float64)
+        self.current_values.fill(np.nan)
+        self.current_view = self.current_values
+        self.out.fill(0.0)
+
+    @cython.cdivision(True)
+    def send_float(self, value):
+        # advance previous to the current value and update current
+        # value with the new value unless it's nan (in which case we
+        # leave it as it is - ie fill forward).
+        self.prev_value_f = self.current_value_f
+        if value == value:
+            self.current_value_f = value
+
+        result = cython.declare(cython.double)
+        result = (self.current_value_f / self.prev_value_f) - 1.0
+        if result != result:
+            result = 0.0
+        return result
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    def send_array(self, value, out):
+        i = cython.declare(cython.Py_ssize_t)
+        x = cython.declare(cython.double)
+        result = cython.declare(cython.double)
+        prev = cython.declare(cython.double[:], self.prev_view)
+        current = cython.declare(cython.double[:], self.current_view)
+        for i in range(value.shape[0]):
+            # advance prev_value and update current value with any new
+            # non-nan values
+            prev[i] = current[i]
+            x = value[i]
+            if x == x:
+                current[i] = x
+
+            result = (current[i] / prev[i]) - 1.0
+            if result != result:
+                result = 0.0
+            out[i] = result
 
 # decorators don't work on cythoned types
 returnsnode = nodetype(cls=MDFReturnsNode, method="returns")(_returnsnode)
@@ -1483,6 +1608,10 @@ class _rowiternode(MDFIterator):
     by, effectively shifting the data.
     
     `ffill` causes the value to get forward filled if True, default is False.
+
+    If `universe` is set the data must be a DataFrame. Its columns are
+    aligned to the :py:class:`mdf.Universe` once and each row is returned
+    as a :py:class:`mdf.PanelArray` instead of a Series.
     
     e.g.::
     
@@ -1509,9 +1638,10 @@ class _rowiternode(MDFIterator):
             # get the row from dataframe_node for the current_date 'now'
             current_row = dataframe_node.rowiter()
     """
-    _init_kwargs_ = ["owner_node", "index_node", "missing_value", "delay", "ffill"]
+    _init_kwargs_ = ["owner_node", "index_node", "missing_value", "delay", "ffill", "universe"]
 
-    def __init__(self, data, owner_node, index_node=now, missing_value=np.nan, delay=0, ffill=False):
+    def __init__(self, data, owner_node, index_node=now, missing_value=np.nan, delay=0, ffill=False,
+                    universe=None):
         """data should be a dataframe, widepanel or timeseries"""
         self._current_index = None
         self._current_value = None
@@ -1519,6 +1649,7 @@ class _rowiternode(MDFIterator):
         self._missing_value_orig = missing_value
         self._index_to_date = False
         self._ffill = ffill
+        self._universe = Universe(universe) if universe is not None else None
 
         # call the index node to make sure this node depends on it and remember the type
         index_value = index_node()
@@ -1544,7 +1675,20 @@ class _rowiternode(MDFIterator):
         self._missing_value = self._missing_value_orig
 
         try:
-            if isinstance(data, pa.DataFrame):
+            if self._universe is not None:
+                if not isinstance(data, pa.DataFrame):
+                    raise AssertionError("datanode expects a DataFrame when a universe is set; "
+                                         "got '%s'" % data.__class__.__name__)
+
+                # align the columns to the universe once and iterate over
+                # the rows of the aligned values
+                self._is_series = True
+                self._missing_value = self._universe.align(self._missing_value)
+                values = data.reindex(columns=self._universe.index).values
+                self._iter = iter(zip(data.index, self._universe.wrap(values)))
+                self._current_index, self._current_value = next(self._iter)
+
+            elif isinstance(data, pa.DataFrame):
                 self._is_dataframe = True
 
                 # convert missing value to a row with the same columns as the dataframe
@@ -1719,7 +1863,8 @@ def datanode(name=None,
              delay=0,
              ffill=False,
              filter=None,
-             category=None):
+             category=None,
+             universe=None):
     """
     Return a new mdf node for iterating over a dataframe, panel or series.
     
@@ -1738,6 +1883,10 @@ def datanode(name=None,
     by, effectively shifting the data.
     
     `ffill` causes the value to get forward filled if True, default is False.
+
+    If `universe` is set the data must be a DataFrame and the rows are
+    returned as :py:class:`mdf.PanelArray` values aligned to that
+    :py:class:`mdf.Universe` instead of as Series.
     
     `data` may either be a data object itself (DataFrame, WidePanel or
     Series) or a node that evaluates to one of those types.
@@ -1773,6 +1922,7 @@ def datanode(name=None,
                                 "delay" : delay,
                                 "missing_value" : missing_value,
                                 "ffill" : ffill,
+                                "universe" : universe,
                               })
     return node
 
@@ -1828,6 +1978,141 @@ def filternode(name=None,
                               })
     return node
 
+#
+# async data nodes are datanodes where the data is loaded by a function
+# that can be started in a background thread before it's needed
+#
+class _AsyncLoader(object):
+    """
+    Calls a loader function once, either in a pool when start is called
+    or synchronously when the data is first needed.
+    """
+    def __init__(self, loader):
+        self.loader = loader
+        self.__lock = threading.Lock()
+        self.__result = None
+        self.__data = None
+        self.__loaded = False
+
+    def start(self, pool):
+        """starts loading the data in pool if it's not already loading"""
+        with self.__lock:
+            if self.__result is None and not self.__loaded:
+                if hasattr(pool, "submit"):
+                    self.__result = pool.submit(self.loader)
+                else:
+                    self.__result = pool.apply_async(self.loader)
+
+    @property
+    def pending(self):
+        """True if the data hasn't been loaded and isn't being loaded"""
+        with self.__lock:
+            return self.__result is None and not self.__loaded
+
+    def __call__(self):
+        with self.__lock:
+            if not self.__loaded:
+                result, self.__result = self.__result, None
+                if result is None:
+                    self.__data = self.loader()
+                elif hasattr(result, "get"):
+                    self.__data = result.get()
+                else:
+                    self.__data = result.result()
+                self.__loaded = True
+            return self.__data
+
+    def reset(self):
+        """discards the loaded data so it's loaded again when next needed"""
+        with self.__lock:
+            self.__result = None
+            self.__data = None
+            self.__loaded = False
+
+class MDFAsyncDataNode(MDFRowIteratorNode):
+    """
+    datanode whose data is returned by a loader function that can be
+    run in a background thread (see :py:func:`asyncdatanode`).
+    """
+
+    def __init__(self, loader, name, **kwargs):
+        self._loader = _AsyncLoader(loader)
+        MDFRowIteratorNode.__init__(self,
+                                    name=name,
+                                    func=MDFCallable(name, self._loader),
+                                    node_type_func=_rowiternode,
+                                    **kwargs)
+        self.func_doc = getattr(loader, "__doc__", None)
+
+    def prefetch(self, pool):
+        """starts loading the data in pool"""
+        self._loader.start(pool)
+
+    @property
+    def pending(self):
+        """True if the data hasn't been loaded or started loading yet"""
+        return self._loader.pending
+
+    def reload(self):
+        """discards the loaded data so it's loaded again when next needed"""
+        self._loader.reset()
+
+def asyncdatanode(loader=None,
+                  name=None,
+                  index_node=now,
+                  missing_value=np.nan,
+                  delay=0,
+                  ffill=False,
+                  filter=None,
+                  category=None,
+                  universe=None):
+    """
+    Return a new mdf node for iterating over a dataframe, panel or series
+    returned by calling `loader`, which is usually a function that reads
+    data from a file, database or service.
+
+    The loader is only called once and is called the first time the node
+    is evaluated, unless the load was already started by :py:func:`run`.
+    Before the first timestep :py:func:`run` finds any async data nodes
+    referenced by the nodes of its callbacks and calls their loaders
+    concurrently in a pool of threads, so independent inputs are loaded
+    at the same time.
+
+    The other arguments are the same as for :py:func:`datanode`.
+
+    This can be used as a decorator, in which case the node is named
+    after the decorated function::
+
+        @asyncdatanode
+        def prices():
+            return pa.read_csv("prices.csv", index_col=0, parse_dates=True)
+    """
+    if loader is None:
+        return lambda func: asyncdatanode(func,
+                                          name=name,
+                                          index_node=index_node,
+                                          missing_value=missing_value,
+                                          delay=delay,
+                                          ffill=ffill,
+                                          filter=filter,
+                                          category=category,
+                                          universe=universe)
+
+    if name is None:
+        name = _get_func_name(loader)
+
+    return MDFAsyncDataNode(loader,
+                            name=name,
+                            category=category,
+                            filter=filter,
+                            nodetype_func_kwargs={
+                              "index_node" : index_node,
+                              "delay" : delay,
+                              "missing_value" : missing_value,
+                              "ffill" : ffill,
+                              "universe" : universe,
+                            })
+
 #
 # applynode is a way of transforming a plain function into an mdf
 # node by binding other nodes to its parameters.
@@ -1867,6 +2152,47 @@ def _applynode(value, func, args=(), kwargs={}):
 # decorators don't work on cythoned types
 applynode = nodetype(cls=MDFApplyNode, method="apply")(_applynode)
 
+#
+# panelnode aligns cross-sectional values to a fixed universe so that
+# nodes using them can work with plain arrays instead of Series.
+#
+class MDFPanelNode(MDFCustomNode):
+    nodetype_kwargs = ["universe", "fill_value"]
+
+def _panelnode(value, universe, fill_value=np.nan):
+    """
+    Decorator that creates an :py:class:`MDFNode` that returns the
+    result of the decorated function as a :py:class:`mdf.PanelArray`
+    aligned to a :py:class:`mdf.Universe`.
+
+    The decorated function may return a Series, which is reindexed to
+    the universe, an array already in the order of the universe or a
+    scalar. Any labels in the universe missing from the value are set
+    to `fill_value`.
+
+    e.g.::
+
+        assets = Universe(["AAPL", "GOOG", "MSFT"])
+
+        @panelnode(universe=assets)
+        def weights():
+            return pa.Series(...)
+
+    or using the nodetype method syntax (see :ref:`nodetype_method_syntax`)::
+
+        @evalnode
+        def weights():
+            return pa.Series(...)
+
+        @evalnode
+        def node():
+            return weights.panel(universe=assets)
+    """
+    return Universe(universe).align(value, fill_value)
+
+# decorators don't work on cythoned types
+panelnode = nodetype(cls=MDFPanelNode, method="panel")(_panelnode)
+
 #
 # lookaheadnode evaluates a node over a date range or for a number
 # of periods in the future and returns a pandas series of values.
@@ -1962,6 +2288,229 @@ def _lookaheadnode(value_unused, owner_node, periods, filter_node=None, offset=p
 # decorators don't work on cythoned classes
 lookaheadnode = nodetype(_lookaheadnode, cls=MDFLookAheadNode, method="lookahead")
 
+#
+# Arithmetic operators on nodes create expression nodes. Applying an
+# operator to an expression node creates a new expression node with the
+# whole expression rather than a node that depends on the first one, so
+# chains of operators are evaluated by a single node in one pass.
+#
+_operator_symbols = {
+    "__add__" : "+",
+    "__sub__" : "-",
+    "__mul__" : "*",
+    "__div__" : "/",
+    "__truediv__" : "/",
+    "__neg__" : "-",
+}
+
+_operator_ufuncs = {
+    "__add__" : np.add,
+    "__sub__" : np.subtract,
+    "__mul__" : np.multiply,
+    "__div__" : np.divide,
+    "__truediv__" : np.true_divide,
+    "__neg__" : np.negative,
+}
+
+# opcodes for _CompiledExpression
+_LOAD_NODE = 0
+_LOAD_CONST = 1
+_UNARY_OP = 2
+_BINARY_OP = 3
+
+def _operand_key(operand):
+    """returns a hashable key for an operand of an expression"""
+    if isinstance(operand, (MDFNode, _Expression)):
+        return operand
+    if isinstance(operand, (bool, int, long, float, complex, np.number)):
+        return (type(operand), repr(operand))
+    # other constants are only the same if they're the same object
+    return ("id", id(operand))
+
+class _Expression(object):
+    """an operator applied to nodes, constants or other expressions"""
+
+    def __init__(self, op_name, operands):
+        self.op_name = op_name
+        self.operands = tuple(operands)
+        self.key = (op_name,) + tuple(_operand_key(x) for x in self.operands)
+        self.hash = hash(self.key)
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        return isinstance(other, _Expression) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __reduce__(self):
+        return (_Expression, (self.op_name, self.operands))
+
+    def nodes(self):
+        """returns the nodes in the expression in the order they're evaluated"""
+        nodes = []
+        for operand in self.operands:
+            if isinstance(operand, _Expression):
+                nodes.extend(operand.nodes())
+            elif isinstance(operand, MDFNode):
+                nodes.append(operand)
+        return nodes
+
+    def format(self, short=False):
+        """returns the expression as a string using the node names or short names"""
+        operands = []
+        for operand in self.operands:
+            if isinstance(operand, _Expression):
+                operand = "(%s)" % operand.format(short)
+            elif isinstance(operand, MDFNode):
+                operand = operand.short_name if short else operand.name
+            elif isinstance(operand, (bool, int, long, float, complex, np.number)):
+                operand = repr(operand)
+            else:
+                operand = "<%s at 0x%x>" % (type(operand).__name__, id(operand))
+            operands.append(operand)
+
+        symbol = _operator_symbols[self.op_name]
+        if len(operands) == 1:
+            return "%s%s" % (symbol, operands[0])
+        return (" %s " % symbol).join(operands)
+
+    def bind(self, owner):
+        """returns the expression with any nodes that are members of owner bound to it"""
+        operands = []
+        for operand in self.operands:
+            if isinstance(operand, _Expression):
+                operand = operand.bind(owner)
+            elif isinstance(operand, MDFEvalNode) and _is_member_of(owner, operand):
+                operand = operand.__get__(None, owner)
+            operands.append(operand)
+
+        if all(x is y for x, y in zip(operands, self.operands)):
+            return self
+        return _Expression(self.op_name, operands)
+
+    def compile(self, program=None):
+        """returns the expression as a list of instructions in postfix order"""
+        if program is None:
+            program = []
+        for operand in self.operands:
+            if isinstance(operand, _Expression):
+                operand.compile(program)
+            elif isinstance(operand, MDFNode):
+                program.append((_LOAD_NODE, operand, None))
+            else:
+                program.append((_LOAD_CONST, operand, None))
+
+        op = getattr(operator, self.op_name)
+        ufunc = _operator_ufuncs[self.op_name]
+        program.append((_UNARY_OP if len(self.operands) == 1 else _BINARY_OP, op, ufunc))
+        return program
+
+def _can_write_to(array, other):
+    """returns True if the result of a ufunc of array and other can be written to array"""
+    if type(array) is not np.ndarray and type(array) is not PanelArray:
+        return False
+    if not isinstance(other, (np.ndarray, bool, int, long, float, np.number)):
+        return False
+    # writing into a plain array would lose the other value's universe
+    if isinstance(other, PanelArray) and type(array) is not PanelArray:
+        return False
+    if np.result_type(array, other) != array.dtype:
+        return False
+    return np.broadcast(array, other).shape == array.shape
+
+class _CompiledExpression(object):
+    """
+    Evaluates an expression in one pass, writing the results of operations
+    into numpy arrays created by earlier operations in the same pass
+    rather than creating a new array for each operation.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.program = expression.compile()
+        self.func_name = expression.format(short=True)
+        self.__doc__ = self.func_name
+
+    def __call__(self):
+        # the stack holds (value, owned) where owned is True if the value
+        # was created by this evaluation and so can be written to
+        stack = []
+        for opcode, arg, ufunc in self.program:
+            if opcode == _LOAD_NODE:
+                stack.append((arg(), False))
+            elif opcode == _LOAD_CONST:
+                stack.append((arg, False))
+            elif opcode == _UNARY_OP:
+                value, owned = stack.pop()
+                if owned and (type(value) is np.ndarray or type(value) is PanelArray):
+                    stack.append((ufunc(value, out=value), True))
+                else:
+                    stack.append((arg(value), True))
+            else:
+                rhs, rhs_owned = stack.pop()
+                lhs, lhs_owned = stack.pop()
+                if lhs_owned and _can_write_to(lhs, rhs):
+                    stack.append((ufunc(lhs, rhs, out=lhs), True))
+                elif rhs_owned and _can_write_to(rhs, lhs):
+                    stack.append((ufunc(lhs, rhs, out=rhs), True))
+                else:
+                    stack.append((arg(lhs, rhs), True))
+        return stack[0][0]
+
+class MDFExpressionNode(MDFEvalNode):
+    """
+    Node created by applying arithmetic operators to nodes, e.g. ``(a - b) / c``.
+
+    The node is named after the expression using the names of the nodes
+    in it, and evaluates the whole expression in one pass.
+    """
+
+    def __init__(self, expression):
+        self._expression = expression
+        func = _CompiledExpression(expression)
+        name = expression.format()
+        MDFEvalNode.__init__(self,
+                             func,
+                             name=name,
+                             short_name=func.func_name,
+                             fqname=name)
+
+    def __reduce__(self):
+        """support for pickling"""
+        return (_get_expression_node, (self._expression,))
+
+    def __get__(self, instance, owner=None):
+        # bind any nodes in the expression that belong to the class
+        if owner is None:
+            return self
+        expression = self._expression.bind(owner)
+        if expression is self._expression:
+            return self
+        return _get_expression_node(expression)
+
+    @property
+    def node_type(self):
+        return "expression"
+
+    @property
+    def expression_nodes(self):
+        """the nodes the expression is made from"""
+        return self._expression.nodes()
+
+_expression_nodes = {}
+_expression_nodes_lock = threading.Lock()
+
+def _get_expression_node(expression):
+    """returns the node for an expression, creating it if necessary"""
+    with _expression_nodes_lock:
+        node = _expression_nodes.get(expression)
+        if node is None:
+            node = _expression_nodes[expression] = MDFExpressionNode(expression)
+        return node
+
 class Op(object):
     op = cython.declare(object)
     lhs = cython.declare(object)    
@@ -1976,10 +2525,13 @@ class Op(object):
         return self.__class__(self.op, owner)
 
     def __call__(self, rhs=None):
-        args = ()
-        if rhs is not None:
-            args = (rhs,)
-        return self.lhs.applynode(func=self.op, args=args)
+        # operands that are expressions are included in the new expression
+        # rather than being evaluated as separate nodes
+        operands = [self.lhs] if rhs is None else [self.lhs, rhs]
+        for i, operand in enumerate(operands):
+            if isinstance(operand, MDFExpressionNode):
+                operands[i] = operand._expression
+        return _get_expression_node(_Expression(self.op.__name__, operands))
 
 if sys.version_info[0] <= 2:
     for op in ("__add__", "__sub__", "__mul__", "__div__", "__neg__"):
@@ -5,11 +5,15 @@ Allows contexts to be constructed and evaluated in external processes
 using Pyro4. 
 """
 from ..context import MDFContext
+from ..ctx_pickle import PartialContext
 from ..runner import run
 from . import serializer
+from collections import OrderedDict, deque
 import Pyro4
+import hashlib
 import copy
 import sys
+import os
 
 import Pyro4.util
 
@@ -94,22 +98,78 @@ class SerializedContext(object):
     """
     wraps up serializing a context so it can be done once on the client
     side and then sent to multiple subprocesses
+
+    If with_key is True the key attribute is set to a hash of the
+    serialized data, which remote servers use to cache the context.
+    Shifted contexts are left out so the key doesn't change after
+    the context has been used for a run.
     """
 
-    def __init__(self, ctx):
+    def __init__(self, ctx, with_key=False):
         self.__serializer = Pyro4.util.Serializer()
+        self.key = None
+        if with_key:
+            ctx = PartialContext(ctx, root_nodes=ctx.all_nodes())
         self.__data, self.__compressed = self.__serializer.serialize(ctx)
+        if with_key:
+            self.key = hashlib.sha1(self.__data).hexdigest()
 
     def _get_real_context(self):
         return self.__serializer.deserialize(self.__data, self.__compressed)
 
+class CachedContext(object):
+    """
+    reference to a context already cached by a remote server,
+    sent in place of a SerializedContext.
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+class _PerContextCallback(object):
+    """
+    callback that calls a separate copy of another callback for each
+    context, so the results for each context can be returned separately.
+    """
+
+    def __init__(self, callback):
+        self.__data = pickle.dumps(callback, pickle.HIGHEST_PROTOCOL)
+        self.nodes = getattr(callback, "nodes", None)
+        self.callbacks = {}
+
+    def __call__(self, date, ctx):
+        ctx_id = ctx.get_id()
+        callback = self.callbacks.get(ctx_id)
+        if callback is None:
+            callback = self.callbacks[ctx_id] = pickle.loads(self.__data)
+        return callback(date, ctx)
+
+    def pop(self, ctx_id):
+        """removes and returns the copy of the callback for a context"""
+        callback = self.callbacks.pop(ctx_id, None)
+        if callback is None:
+            # the callback wasn't called for ctx (e.g. because of a filter)
+            callback = pickle.loads(self.__data)
+        return callback
+
 class MDFRemoteAPI(object):
     """
     Pyro remote object for creating and interacting with mdf
     objects on a remote server.
+
+    The contexts cached from previous runs and the contexts returned by
+    run are kept separately for each client_id, so clients sharing a
+    server can't use or release each other's contexts.
     """
+    # maximum number of contexts kept by the context cache
+    max_cached_contexts = 4
+
     def __init__(self, pyro_daemon):
         self.pyro_daemon = pyro_daemon
+        self.__cached_contexts = OrderedDict()
+        self.__run_contexts = {}
+        self.__shift_results = {}
+        self.__last_shift_results = {}
 
     def create_context(self, now=None):
         """creates a new remote context and returns a proxy to it"""
@@ -128,19 +188,84 @@ class MDFRemoteAPI(object):
         Unregisters a remote context.
         Call when the context is no longer required.
         """
-        if isinstance(ctx, ContextProxy):
+        if isinstance(ctx, ContextProxy) and self.pyro_daemon:
             self.pyro_daemon.unregister(ctx)
 
-    def run(self, date_range, callbacks=[], values={}, shifts=None, filter=None, ctx=None, tzinfo=None):
+    def release_run_contexts(self, client_id=None):
+        """
+        Unregisters all the remote contexts returned by run for a client
+        and removes the shifted contexts from their parent contexts, along
+        with any contexts with a subset of their shifts created while
+        evaluating them.
+        Call when the results of previous runs are no longer required.
+        """
+        self.__shift_results.pop(client_id, None)
+        self.__last_shift_results.pop(client_id, None)
+        self.__release_run_contexts(self.__run_contexts.pop(client_id, []))
+
+    def __release_run_contexts(self, ctxs, keep_ctxs=[]):
+        """
+        releases the remote contexts ctxs and any contexts they're shifts of,
+        except for contexts the contexts in keep_ctxs are also shifts of.
+        """
+        shifted_ctxs = OrderedDict()
+        for ctx in ctxs:
+            self.release_context(ctx)
+            real_ctx = ctx._get_real_context()
+            parent = real_ctx.get_parent()
+            if parent is not None:
+                shifted_ctxs.setdefault(parent, []).append(real_ctx)
+
+        keep_ctxs = [ctx._get_real_context() for ctx in keep_ctxs]
+        for parent, ctxs in shifted_ctxs.items():
+            parent._release_shifted_contexts([shifted_ctx for shifted_ctx in parent.get_shifted_contexts()
+                                              if any(ctx.is_shift_of(shifted_ctx) for ctx in ctxs)
+                                              and not any(ctx.is_shift_of(shifted_ctx) for ctx in keep_ctxs)])
+
+    def ping(self):
+        """used to check the server is responding"""
+        return True
+
+    def has_cached_context(self, key, client_id=None):
+        """returns True if a context with the SerializedContext key is cached for a client"""
+        return (client_id, key) in self.__cached_contexts
+
+    def __get_cached_context(self, ctx, client_id):
+        """
+        returns the context for a CachedContext or a SerializedContext,
+        adding SerializedContexts with a key to the client's cache.
+        """
+        key = (client_id, ctx.key)
+        if isinstance(ctx, CachedContext):
+            try:
+                cached_ctx = self.__cached_contexts.pop(key)
+            except KeyError:
+                raise KeyError("Context '%s' not found in the context cache" % ctx.key)
+            self.__cached_contexts[key] = cached_ctx
+            return cached_ctx
+
+        cached_ctx = self.__cached_contexts.pop(key, None)
+        if cached_ctx is None:
+            cached_ctx = ctx._get_real_context()
+        self.__cached_contexts[key] = cached_ctx
+        while len(self.__cached_contexts) > self.max_cached_contexts:
+            self.__cached_contexts.popitem(last=False)
+        return cached_ctx
+
+    def run(self, date_range, callbacks=[], values={}, shifts=None, filter=None, ctx=None, tzinfo=None,
+            client_id=None):
         """
         Remote version of mdf.run.
         - Callbacks must be pickleable remote objects
         - ctx may be a remote context
+        - client_id identifies the client for the context cache and release_run_contexts
         - returns (remote ctxs, callbacks)
         """
         # get the real context if passed a proxy
-        if not isinstance(ctx, MDFContext):
-            # use the cache option so all the other 
+        if isinstance(ctx, (SerializedContext, CachedContext)) and ctx.key is not None:
+            # reuse the context from a previous run if it's been cached
+            ctx = self.__get_cached_context(ctx, client_id)
+        elif not isinstance(ctx, MDFContext):
             ctx = ctx._get_real_context()
         assert isinstance(ctx, MDFContext)
 
@@ -165,18 +290,75 @@ class MDFRemoteAPI(object):
             shifted_contexts = [shifted_contexts]
 
         shifted_contexts = map(self.get_remote_context, shifted_contexts)
+        self.__run_contexts.setdefault(client_id, []).extend(shifted_contexts)
         return shifted_contexts, callbacks
 
+    def run_shifts(self, date_range, callbacks=[], shifts=None, filter=None, ctx=None, tzinfo=None,
+                   client_id=None):
+        """
+        Like run, but each shifted context gets its own copy of the callbacks
+        and the results are kept until fetched one context at a time using
+        next_shift_result.
+
+        Returns the number of results.
+        """
+        per_context_callbacks = [_PerContextCallback(callback) for callback in callbacks]
+        shifted_contexts, unused = self.run(date_range,
+                                            callbacks=per_context_callbacks,
+                                            shifts=shifts,
+                                            filter=filter,
+                                            ctx=ctx,
+                                            tzinfo=tzinfo,
+                                            client_id=client_id)
+
+        results = self.__shift_results.setdefault(client_id, deque())
+        for shifted_ctx in shifted_contexts:
+            ctx_id = shifted_ctx.get_id()
+            ctx_callbacks = [callback.pop(ctx_id) for callback in per_context_callbacks]
+            for callback in ctx_callbacks:
+                finalize = getattr(callback, "finalize", None)
+                if finalize and callable(finalize):
+                    finalize()
+            results.append((shifted_ctx, ctx_callbacks))
+
+        return len(shifted_contexts)
+
+    def next_shift_result(self, client_id=None):
+        """
+        Returns (remote ctx, callbacks) for the next result of run_shifts for
+        a client, first releasing the context returned by the previous call
+        so only the results not yet fetched are kept.
+        """
+        results = self.__shift_results.get(client_id)
+        remaining_ctxs = [ctx for ctx, callbacks in results or []]
+
+        prev_ctx = self.__last_shift_results.pop(client_id, None)
+        if prev_ctx is not None:
+            self.__run_contexts[client_id].remove(prev_ctx)
+            self.__release_run_contexts([prev_ctx], keep_ctxs=remaining_ctxs)
+
+        if not results:
+            raise IndexError("No more results for client '%s'" % client_id)
+
+        ctx, callbacks = results.popleft()
+        self.__last_shift_results[client_id] = ctx
+        return ctx, callbacks
+
     def shutdown(self):
         """shuts down the parent daemon process"""
         self.pyro_daemon.shutdown()
 
+from .pool import WorkerPool, ServerPool
+
 _daemon = None
+_daemon_pid = None
 def get_daemon():
     """returns the Pyro daemon for the current process"""
-    global _daemon
-    if _daemon is None:
+    global _daemon, _daemon_pid
+    # a forked worker process mustn't use the daemon inherited from its parent
+    if _daemon is None or _daemon_pid != os.getpid():
         _daemon = Pyro4.Daemon()
+        _daemon_pid = os.getpid()
     return _daemon
 
 def start_server(name=None, pipe=None):
@@ -99,10 +99,11 @@ def send_message(subject, message):
             handler(subject, message)
         return
 
-    # otherwise send it via zmq
-    data, compressed = _serializer.serialize((subject, message))
-    _conn_details.source.send(data, flags=zmq.SNDMORE)
-    _conn_details.source.send_json(compressed)
+    # otherwise send it via zmq, with the numpy buffers as separate
+    # frames so they're not copied into a single message
+    frames, compressed = _serializer.serialize_frames((subject, message))
+    _conn_details.source.send_json(compressed, flags=zmq.SNDMORE)
+    _conn_details.source.send_multipart(frames, copy=False)
 
 @needs_zmq
 def poll_messages():
@@ -113,9 +114,9 @@ def poll_messages():
     while True:
         # get next waiting message
         try:
-            # don't block on data, but once we have the data wait for the compressed flag
-            data = _conn_details.sink.recv(flags=zmq.NOBLOCK)
-            compressed = _conn_details.sink.recv_json()
+            # don't block on the compressed flag, but once we have it wait for the frames
+            compressed = _conn_details.sink.recv_json(flags=zmq.NOBLOCK)
+            frames = _conn_details.sink.recv_multipart(copy=False)
         except zmq.ZMQError:
             # still waiting for data?
             e = sys.exc_info()[1]
@@ -124,6 +125,6 @@ def poll_messages():
             raise
 
         # deserialize and call the handlers
-        subject, message = _serializer.deserialize(data, compressed)
+        subject, message = _serializer.deserialize_frames([f.buffer for f in frames], compressed)
         for handler in _handlers.get(subject, []):
             handler(subject, message)
@@ -0,0 +1,575 @@
+"""
+Pools of Pyro servers used to process shifted contexts in parallel.
+
+WorkerPool starts its own child processes and ServerPool uses servers
+that are already running (e.g. started with bin/mdf_pyro_server.py),
+possibly on other hosts.
+"""
+from ..runner import run
+from . import messaging
+from multiprocessing import Process, Pipe
+from collections import deque
+import Pyro4
+import Pyro4.util
+import Pyro4.errors
+import logging
+import pickle
+import select
+import math
+import time
+import uuid
+import sys
+
+_log = logging.getLogger(__name__)
+
+# the most shifts sent to a worker at a time unless a chunksize is given
+_max_default_chunksize = 4
+
+# time in seconds to wait for a server to respond to a ping
+_ping_timeout = 5
+
+def _start_remote_server(argv, pipe):
+    """
+    function for use with multiprocessing.Process object for creating
+    a Pyro server
+    """
+    from . import start_server
+    start_server(pipe=pipe)
+
+def _start_worker():
+    """
+    starts a child process running a pyro server and returns
+    the process and a proxy to its MDFRemoteAPI object.
+    """
+    parent_conn, child_conn = Pipe()
+    process = Process(target=_start_remote_server, args=(sys.argv, child_conn))
+    process.daemon = True
+    process.start()
+    timeout = time.clock() + 60
+    while process.is_alive() and time.clock() < timeout:
+        if parent_conn.poll(1):
+            break
+    else:
+        raise Exception("failed to start sub-process")
+    uri = parent_conn.recv()
+    server = Pyro4.Proxy(uri)
+    server._pyroOneway.add("shutdown")
+    return process, server
+
+class _Chunk(object):
+    """
+    a date range and set of consecutive shifts (or None) run by
+    a worker in a single call
+    """
+
+    def __init__(self, index, date_range, shift_sets=None, first_shift=0, start_date=None,
+                 tzinfo=None):
+        self.index = index
+        self.date_range = date_range
+        self.tzinfo = tzinfo
+        self.shift_sets = shift_sets
+        self.first_shift = first_shift
+        self.start_date = start_date
+        self.num_attempts = 0
+        self.num_failures = 0
+        self.num_combined = 0
+        self.done = False
+
+class _Worker(object):
+    """
+    A Pyro server used by a pool, and the chunk it's currently running.
+    """
+
+    def __init__(self, remote_api, process=None):
+        self.remote_api = remote_api
+        self.process = process
+        self.chunk = None
+        self.future = None
+        self.started_time = None
+        self.timed_out = False
+        self.last_heartbeat = time.time()
+        self.__heartbeat_api = None
+        self.__ping = None
+        self.__ping_started = None
+
+    def __str__(self):
+        return str(self.remote_api._pyroUri)
+
+    def is_busy(self):
+        """True if a chunk has been started and hasn't finished yet"""
+        return self.future is not None and not self.future.ready
+
+    def is_alive(self, timeout=None):
+        """
+        checks the server is still responding, using a separate proxy
+        as the worker's proxy is in use while it's running a chunk.
+        """
+        if self.process is not None and not self.process.is_alive():
+            return False
+
+        if self.__heartbeat_api is None:
+            self.__heartbeat_api = Pyro4.Proxy(self.remote_api._pyroUri)
+        self.__heartbeat_api._pyroTimeout = timeout
+        try:
+            self.__heartbeat_api.ping()
+        except Pyro4.errors.CommunicationError:
+            return False
+        self.last_heartbeat = time.time()
+        return True
+
+    def check_heartbeat(self, interval):
+        """
+        pings the server in a background thread if it's not responded for
+        interval seconds, without waiting for the response. Returns False
+        if the process has exited or the last ping failed or took longer
+        than _ping_timeout seconds.
+        """
+        if self.process is not None and not self.process.is_alive():
+            return False
+
+        now = time.time()
+        if self.__ping is None:
+            if now - self.last_heartbeat > interval:
+                self.__ping = Pyro4.Future(self.is_alive)(_ping_timeout)
+                self.__ping_started = now
+            return True
+
+        if self.__ping.ready:
+            ping, self.__ping = self.__ping, None
+            try:
+                return ping.value
+            except Exception:
+                return False
+
+        return now - self.__ping_started < _ping_timeout
+
+    def start_chunk(self, chunk, callbacks, filter, ctx, client_id):
+        batch = Pyro4.batch(self.remote_api)
+        batch.run_shifts(chunk.date_range,
+                         callbacks=callbacks,
+                         shifts=chunk.shift_sets,
+                         filter=filter,
+                         ctx=ctx,
+                         tzinfo=chunk.tzinfo,
+                         client_id=client_id)
+        self.future = batch(async=True)
+        self.chunk = chunk
+        self.started_time = time.time()
+        self.last_heartbeat = self.started_time
+        self.timed_out = False
+        chunk.num_attempts += 1
+
+    def get_result(self):
+        """returns the number of results for the finished chunk"""
+        future, self.future, self.chunk = self.future, None, None
+        return future.value.next()
+
+    def get_shift_results(self, num_results, client_id):
+        """
+        yields (remote context, callbacks) for each of the results of the
+        finished chunk, fetching them from the server one at a time.
+        """
+        for i in range(num_results):
+            yield self.remote_api.next_shift_result(client_id)
+
+    def release(self):
+        """closes the connections to the server"""
+        self.remote_api._pyroRelease()
+        if self.__heartbeat_api is not None:
+            self.__heartbeat_api._pyroRelease()
+
+class WorkerPool(object):
+    """
+    Pool of child processes that can be used for multiple calls to
+    :py:func:`mdf.run`, avoiding the cost of starting new processes
+    for each run.
+
+    The context passed to run is sent to each worker the first time it's
+    used, and cached by the worker keyed by a hash of its serialized data.
+    Subsequent runs using an unchanged context only send the shift sets
+    and callbacks.
+
+    Shifts are sent to the workers ``chunksize`` at a time. When a chunk
+    finishes the result for each shifted context is fetched and combined
+    one at a time, and the worker frees its state for each shifted context
+    once it's been combined. Larger chunks reduce the amount of
+    work repeated for each chunk at the cost of holding more results in the
+    workers at once. By default the shifts are split evenly between the
+    processes, but with no more than a few shifts in each chunk.
+
+    If a worker stops responding it's removed from the pool and the chunk
+    it was running is sent to another worker. Chunks that take longer than
+    ``timeout`` seconds are also sent to another worker, and the results
+    from whichever worker finishes first are used.
+
+    Use with mdf.run::
+
+        with WorkerPool(8) as pool:
+            mdf.run(date_range, [builder], shifts=shifts, ctx=ctx, worker_pool=pool)
+            mdf.run(date_range, [builder], shifts=other_shifts, ctx=ctx, worker_pool=pool)
+
+    or call :py:meth:`WorkerPool.run` which takes the same arguments as mdf.run.
+    """
+
+    def __init__(self,
+                 num_processes,
+                 chunksize=None,
+                 timeout=None,
+                 heartbeat_interval=30,
+                 max_attempts=3):
+        """
+        ``num_processes`` is the number of worker processes to start
+        ``chunksize`` is the number of shifts sent to a worker at a time, or None
+                      to split the shifts evenly between the processes in
+                      chunks of at most a few shifts
+        ``timeout`` is the time in seconds before a chunk is sent to another worker
+        ``heartbeat_interval`` is how often in seconds to check busy workers are alive
+        ``max_attempts`` is the number of times a chunk can fail before giving up
+        """
+        self.num_processes = num_processes
+        self.chunksize = max(1, chunksize) if chunksize is not None else None
+        self.timeout = timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.max_attempts = max_attempts
+        self._workers = []
+
+        # identifies this pool to the servers, which may be shared with other pools
+        self._client_id = uuid.uuid4().hex
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def start(self, num_processes=None):
+        """
+        starts any worker processes that aren't already running.
+        Workers are started automatically when required by run.
+        """
+        if num_processes is None:
+            num_processes = self.num_processes
+
+        # remove any workers that have died
+        self._workers = [w for w in self._workers if w.process.is_alive()]
+
+        num_to_start = min(num_processes, self.num_processes) - len(self._workers)
+        if num_to_start <= 0:
+            return
+
+        # multiprocessing expects sys.executable to take  --multiprocessing-fork option if
+        # frozen if True, but for us it's always python.exe even if frozen is set
+        sys_frozen = getattr(sys, "frozen", False)
+        sys.frozen = False
+        try:
+            # start the processes and pyro servers
+            promises = [Pyro4.Future(_start_worker)() for _ in range(num_to_start)]
+            for promise in promises:
+                process, remote_api = promise.value
+                self._workers.append(_Worker(remote_api, process))
+        finally:
+            sys.frozen = sys_frozen
+
+    def shutdown(self):
+        """shuts down all the worker processes"""
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            try:
+                with worker.remote_api:
+                    worker.remote_api.shutdown()
+            except Pyro4.errors.CommunicationError:
+                pass
+            self._stop_worker(worker)
+
+    def _stop_worker(self, worker):
+        """called when a worker is removed from the pool"""
+        worker.release()
+        if worker.process is not None and worker.process.is_alive():
+            worker.process.terminate()
+
+    def _remove_worker(self, worker, reason):
+        _log.warning("Removing worker %s from pool: %s" % (worker, reason))
+        self._workers.remove(worker)
+        self._stop_worker(worker)
+
+    def run(self, date_range, callbacks=[], values={}, shifts=None, filter=None,
+            ctx=None, tzinfo=None, **kwargs):
+        """
+        calls :py:func:`mdf.run` using this pool to process the shifts.
+        """
+        return run(date_range,
+                   callbacks=callbacks,
+                   values=values,
+                   shifts=shifts,
+                   filter=filter,
+                   ctx=ctx,
+                   tzinfo=tzinfo,
+                   worker_pool=self,
+                   **kwargs)
+
+    def _get_chunksize(self, num_shifts):
+        """returns the number of shifts to send to a worker at a time"""
+        if self.chunksize is not None:
+            return self.chunksize
+        chunksize = int(math.ceil(num_shifts / float(self.num_processes)))
+        return max(1, min(chunksize, _max_default_chunksize))
+
+    def _run(self, date_range, callbacks, shifts, filter, unshifted_ctx):
+        """
+        process each shift using the workers in this pool - called from mdf.run
+
+        Shifts are sent to the workers in chunks of chunksize shifts and the
+        results of each chunk are combined as soon as that chunk's finished,
+        so only the results for the chunks currently being run are held by
+        the workers.
+        """
+        for callback in callbacks:
+            if not hasattr(callback, "combine_result"):
+                raise Exception("All callback objects must have a 'combine_result' method")
+
+        # split the shifts into chunks to be run by the workers
+        chunksize = self._get_chunksize(len(shifts))
+        chunks = []
+        for i in range(0, len(shifts), chunksize):
+            chunks.append(_Chunk(len(chunks),
+                                 date_range,
+                                 shift_sets=shifts[i:i+chunksize],
+                                 first_shift=i))
+
+        shifted_ctxs = [None] * len(shifts)
+
+        def combine_result(chunk, i, remote_ctx, remote_cbs):
+            local_ctx = unshifted_ctx.shift(chunk.shift_sets[i])
+            shifted_ctxs[chunk.first_shift + i] = local_ctx
+            with remote_ctx:
+                for local_cb, remote_cb in zip(callbacks, remote_cbs):
+                    local_cb.combine_result(remote_cb, remote_ctx, local_ctx)
+
+        self.__run_chunks(chunks, callbacks, filter, unshifted_ctx, combine_result)
+        return shifted_ctxs
+
+    def _run_partitions(self, partitions, callbacks, filter, ctx, tzinfo=None):
+        """
+        runs each (date_range, start_date) partition using the workers in this
+        pool and appends the results to the callbacks in date order - called
+        from mdf.run_partitioned.
+        """
+        for callback in callbacks:
+            if not hasattr(callback, "append_result"):
+                raise Exception("All callback objects must have an 'append_result' method")
+
+        # callbacks that write their results (e.g. CSVWriter) are sent to the
+        # workers as copies that keep the results for append_result instead
+        partition_callbacks = []
+        for callback in callbacks:
+            if hasattr(callback, "_buffered_copy"):
+                callback = callback._buffered_copy()
+            partition_callbacks.append(callback)
+
+        chunks = []
+        for date_range, start_date in partitions:
+            chunks.append(_Chunk(len(chunks), date_range, start_date=start_date, tzinfo=tzinfo))
+
+        # results have to be appended in order, so any that finish early are
+        # kept until the previous partitions have been appended
+        finished = {}
+        next_index = [0]
+
+        def append_results(chunk, i, remote_ctx, remote_cbs):
+            finished[chunk.index] = (chunk, remote_ctx.get_id(), remote_cbs)
+            while next_index[0] in finished:
+                chunk, remote_ctx_id, remote_cbs = finished.pop(next_index[0])
+                for local_cb, remote_cb in zip(callbacks, remote_cbs):
+                    local_cb.append_result(remote_cb, remote_ctx_id, ctx, chunk.start_date)
+                next_index[0] += 1
+
+        self.__run_chunks(chunks, partition_callbacks, filter, ctx, append_results)
+
+    def __run_chunks(self, all_chunks, callbacks, filter, unshifted_ctx, combine_result):
+        """
+        runs all the chunks using the workers in this pool, calling
+        combine_result(chunk, i, remote_ctx, remote_callbacks) for the
+        result of each context in a chunk once the chunk finishes.
+        """
+        from . import SerializedContext, CachedContext, get_daemon
+
+        try:
+            self.start(len(all_chunks))
+
+            # the local callbacks are finalized when the first results are combined
+            # so keep a copy of them in their initial state to send to the workers
+            remote_callbacks = pickle.loads(pickle.dumps(callbacks, pickle.HIGHEST_PROTOCOL))
+
+            # serialize the context once as it could be quite large
+            serialized_context = SerializedContext(unshifted_ctx, with_key=True)
+            cached_context = CachedContext(serialized_context.key)
+            workers_with_context = set()
+
+            chunks = deque(all_chunks)
+            num_remaining = len(all_chunks)
+
+            while num_remaining > 0:
+                if not self._workers:
+                    raise Exception("No workers left in the pool")
+
+                now = time.time()
+                for worker in list(self._workers):
+                    # check on any workers still running a chunk
+                    if worker.is_busy():
+                        chunk = worker.chunk
+                        if self.heartbeat_interval is not None:
+                            if not worker.check_heartbeat(self.heartbeat_interval):
+                                self._remove_worker(worker, "no heartbeat")
+                                if not chunk.done and chunk not in chunks:
+                                    self.__retry_chunk(chunk, chunks)
+                                continue
+
+                        # if it's taking too long try it on another worker, but leave it running
+                        if self.timeout is not None \
+                        and not worker.timed_out \
+                        and not chunk.done \
+                        and now - worker.started_time > self.timeout:
+                            _log.warning("Chunk timed out on worker %s, resubmitting" % worker)
+                            worker.timed_out = True
+                            if chunk not in chunks:
+                                self.__retry_chunk(chunk, chunks, failed=False)
+                        continue
+
+                    # combine the results of any chunk that's finished
+                    if worker.future is not None:
+                        chunk = worker.chunk
+                        try:
+                            num_results = worker.get_result()
+                        except Pyro4.errors.CommunicationError as e:
+                            self._remove_worker(worker, e)
+                            if not chunk.done and chunk not in chunks:
+                                self.__retry_chunk(chunk, chunks)
+                            continue
+                        except:
+                            # chunks left over from a previous run don't matter
+                            if not chunk.done:
+                                _log.error("".join(Pyro4.util.getPyroTraceback()))
+                                raise
+                            num_results = 0
+
+                        try:
+                            # the chunk may have already been completed by another worker
+                            if not chunk.done:
+                                # combine the results one context at a time, skipping any
+                                # already combined from an earlier attempt at this chunk
+                                results = worker.get_shift_results(num_results, self._client_id)
+                                for i, (remote_ctx, remote_cbs) in enumerate(results):
+                                    if i >= chunk.num_combined:
+                                        combine_result(chunk, i, remote_ctx, remote_cbs)
+                                        chunk.num_combined += 1
+                                chunk.done = True
+                                num_remaining -= 1
+
+                            # free the worker's state for any contexts still held
+                            worker.remote_api.release_run_contexts(self._client_id)
+                        except Pyro4.errors.CommunicationError as e:
+                            self._remove_worker(worker, e)
+                            if not chunk.done and chunk not in chunks:
+                                self.__retry_chunk(chunk, chunks)
+                            continue
+
+                    # start the next chunk on the idle worker
+                    while chunks and chunks[0].done:
+                        chunks.popleft()
+                    if not chunks:
+                        continue
+                    chunk = chunks.popleft()
+
+                    try:
+                        # only send the context if the worker doesn't have it already
+                        ctx = cached_context
+                        if worker not in workers_with_context:
+                            if not worker.remote_api.has_cached_context(serialized_context.key,
+                                                                        self._client_id):
+                                ctx = serialized_context
+                            workers_with_context.add(worker)
+
+                        worker.start_chunk(chunk, remote_callbacks, filter, ctx, self._client_id)
+                    except Pyro4.errors.CommunicationError as e:
+                        self._remove_worker(worker, e)
+                        chunks.appendleft(chunk)
+
+                # poll the daemon for this process while we wait for results
+                # in case anything is using it
+                daemon = get_daemon()
+                read_sockets, unused, unused = select.select(daemon.sockets, [], [], 0.02)
+                if read_sockets:
+                    daemon.events(read_sockets)
+
+                # poll the remote message loop
+                messaging.poll_messages()
+        finally:
+            # any chunks still running after an error are of no further use
+            for chunk in all_chunks:
+                chunk.done = True
+
+    def __retry_chunk(self, chunk, chunks, failed=True):
+        """
+        resubmits a chunk that failed or timed out. Timed out chunks are
+        still running so don't count as failed attempts.
+        """
+        if failed:
+            chunk.num_failures += 1
+            if chunk.num_failures >= self.max_attempts:
+                # give up unless another worker is still running the chunk
+                if any(w.chunk is chunk and w.is_busy() for w in self._workers):
+                    return
+                raise Exception("Failed to run chunk after %d attempts" % chunk.num_attempts)
+        chunks.appendleft(chunk)
+
+class ServerPool(WorkerPool):
+    """
+    Pool of already running Pyro servers, e.g. started on other hosts
+    using bin/mdf_pyro_server.py.
+
+    Servers that stop responding are removed from the pool and the shifts
+    they were running are sent to another server (see :py:class:`WorkerPool`).
+    Shutting down the pool closes the connections to the servers but
+    doesn't shut down the servers.
+    """
+
+    def __init__(self, servers, **kwargs):
+        """
+        ``servers`` is a list of Pyro URIs, or names the servers are registered
+        with in the Pyro name server (see the --service-name option of
+        mdf_pyro_server.py).
+
+        Any other keyword arguments are passed to :py:class:`WorkerPool`.
+        """
+        WorkerPool.__init__(self, len(servers), **kwargs)
+        self.servers = list(servers)
+        self.__servers = {}
+
+    def start(self, num_processes=None):
+        """connects to any servers not already in the pool"""
+        connected = set(self._workers)
+        self.__servers = dict((k, w) for (k, w) in self.__servers.items() if w in connected)
+
+        for server in self.servers:
+            if server in self.__servers:
+                continue
+            uri = server
+            if ":" not in str(server):
+                uri = "PYRONAME:" + server
+            worker = _Worker(Pyro4.Proxy(uri))
+            if not worker.is_alive(_ping_timeout):
+                _log.warning("Server %s isn't responding" % server)
+                worker.release()
+                continue
+            self.__servers[server] = worker
+            self._workers.append(worker)
+
+        if not self._workers:
+            raise Exception("None of the servers %s are responding" % self.servers)
+
+    def shutdown(self):
+        """closes the connections to the servers"""
+        workers, self._workers = self._workers, []
+        self.__servers.clear()
+        for worker in workers:
+            self._stop_worker(worker)
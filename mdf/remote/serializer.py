@@ -1,23 +1,79 @@
 """
-Subclass of the standard Pyro Serializer to support larger objects
-by compressing them on the fly rather than pickle them to a string
-and then compress that string.
-
-bz2 is used as it was found to be faster than zlib for this purpose.
-
-Disable by setting the environment variable 'MDF_PYRO_NO_BZ2=1'
+Subclass of the standard Pyro Serializer to support larger objects.
+
+Large numpy arrays (including those backing pandas objects) are
+separated from the pickle stream and sent as raw buffers after it,
+each compressed or not depending on its size. Anything else larger
+than 64Kb is compressed.
+
+Messages are built with a single copy of each buffer, and received
+buffers are used without copying them, so arrays received in a message
+that isn't writable are read-only. Serializer.serialize_frames returns
+the parts of a message as separate frames to be sent without joining
+them (e.g. as a zmq multipart message).
+
+For workers on the same machine, buffers above a size threshold can
+be passed via shared memory instead of being copied into the message
+by setting the environment variable 'MDF_PYRO_SHM_THRESHOLD' to the
+minimum size in bytes. Shared memory files are removed when they're
+loaded, or when the process that wrote them exits.
+
+Disable out of band buffers, and use the previous behaviour of
+compressing everything using bz2, by setting 'MDF_PYRO_NO_OOB=1'.
+
+Disable all custom serialization by setting the environment variable
+'MDF_PYRO_NO_BZ2=1'
 """
+from ..io.arrayfile import get_out_of_band_data
 import Pyro4.core
 import Pyro4.util
+import numpy as np
+import tempfile
 import logging
+import atexit
+import struct
+import zlib
 import bz2
 import os
 import sys
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
 if sys.version_info[0] > 2:
     from io import BytesIO
+    import pickle as _meta_pickle
+
+    def _buffer(obj, offset=0, size=None):
+        view = memoryview(obj).cast("B")
+        return view[offset:] if size is None else view[offset:offset + size]
+
+    def _readable(chunk):
+        return chunk
+
+    def _to_bytes(chunk):
+        return bytes(chunk)
 else:
     from StringIO import StringIO as BytesIO
+    import cPickle as _meta_pickle
+
+    def _buffer(obj, offset=0, size=None):
+        return buffer(obj, offset) if size is None else buffer(obj, offset, size)
+
+    def _readable(chunk):
+        # memoryviews and arrays can't be passed to functions expecting strings
+        # in python 2, but buffers of them can
+        if isinstance(chunk, memoryview):
+            chunk = np.asarray(chunk)
+        return buffer(chunk) if isinstance(chunk, np.ndarray) else chunk
+
+    def _to_bytes(chunk):
+        return chunk.tobytes() if isinstance(chunk, (memoryview, np.ndarray)) else str(chunk)
 
 try:
     _Serializer = Pyro4.util.PickleSerializer
@@ -77,62 +133,87 @@ class BZ2Writer(BytesIO):
         self.close()
 
 class BZ2Reader(object):
-    """Decompress using bz2 on the fly"""
+    """
+    Decompress using bz2 on the fly.
+
+    Only the decompressed data that hasn't been read yet is buffered, and
+    each read only copies the data being returned so reading the whole
+    stream takes time linear in its size.
+    """
     _block_size = 64 << 10 # decompress in 64kb chunks
-    _buffer_size = 16 << 20 # ~16Mb buffer for decompressed data (this can grow)
 
     def __init__(self, data):
         self.__decompressor = bz2.BZ2Decompressor()
         self.__decompress = self.__decompressor.decompress
         self.__data = data
-        self.__buffer_size = self._buffer_size
 
-        # positions in the uncompressed data
+        # positions in the compressed data
         self.__cpos = 0
         self.__cend = len(data)
 
-        # position in the decompressed data
-        self.__dbuf = BytesIO()
-        self.__dpos = 0
+        # decompressed data and the position of the next unread byte in it
+        self.__buffer = b""
+        self.__pos = 0
+
+    def __next_chunk(self):
+        """returns the next chunk of decompressed data, or an empty string if there's none left"""
+        while self.__cpos < self.__cend:
+            size = min(self._block_size, self.__cend - self.__cpos)
+            chunk = self.__decompress(_buffer(self.__data, self.__cpos, size))
+            self.__cpos += size
+            if chunk:
+                return chunk
+        return b""
 
     def read(self, size=-1):
-        if size < 0:
-            self.__dbuf.write(self.__decompress(self.__data[self.__cpos:]))
-            self.__cpos = self.__cend
-            start = self.__dpos
-            end = self.__dbuf.tell()
-            self.__dpos = end
-            return self.__dbuf.getvalue()[start:end]
-
-        # if the buffer's grown to the max buffer size then push the old data off
-        if self.__dbuf.tell() > self.__buffer_size:
-            # expand the buffer size if we've overrun when decompressing, or if
-            # a previous size was more than the buffer (pickle doesn't deal with
-            # read returning less than was asked for)
-            self.__buffer_size = max(self.__buffer_size, self.__dbuf.tell())
-
-            # move the unread data to the start of the buffer
-            data = self.__dbuf.getvalue()[self.__dpos:self.__dbuf.tell()]
-            self.__dbuf.seek(0, os.SEEK_SET)
-            self.__dpos = 0
-            self.__dbuf.write(data)
-
-        while (self.__dbuf.tell() - self.__dpos) < size and self.__cpos < self.__cend:
-            end = self.__cpos + self._block_size
-            self.__dbuf.write(self.__decompress(self.__data[self.__cpos:end]))
-            self.__cpos = end
-
-        start = self.__dpos
-        end = min(start + size, self.__dbuf.tell())
-        self.__dpos = end
-        return self.__dbuf.getvalue()[start:end]
+        buffer, pos = self.__buffer, self.__pos
+        if 0 <= size <= len(buffer) - pos:
+            self.__pos = pos + size
+            return buffer[pos:pos + size]
+
+        # collect enough decompressed chunks and join them once
+        chunks = [buffer[pos:]]
+        available = len(chunks[0])
+        while size < 0 or available < size:
+            chunk = self.__next_chunk()
+            if not chunk:
+                break
+            chunks.append(chunk)
+            available += len(chunk)
+
+        data = b"".join(chunks)
+        if 0 <= size < len(data):
+            self.__buffer = data[size:]
+            data = data[:size]
+        else:
+            self.__buffer = b""
+        self.__pos = 0
+        return data
+
+    def readinto(self, b):
+        view = memoryview(b)
+        data = self.read(len(view))
+        view[:len(data)] = data
+        return len(data)
 
     def readline(self, size=-1):
-        c = line = self.read(size=1)
-        while c and c != '\n' \
-        and (len(line) < size if size > 0 else True):
-            c = self.read(size=1)
-            line += c
+        end = self.__buffer.find(b"\n", self.__pos)
+        while end < 0:
+            chunk = self.__next_chunk()
+            if not chunk:
+                break
+            # only the unread data is kept so the buffer doesn't keep growing
+            searched = len(self.__buffer) - self.__pos
+            self.__buffer = self.__buffer[self.__pos:] + chunk
+            self.__pos = 0
+            end = self.__buffer.find(b"\n", searched)
+
+        end = len(self.__buffer) if end < 0 else end + 1
+        if size >= 0:
+            end = min(end, self.__pos + size)
+
+        line = self.__buffer[self.__pos:end]
+        self.__pos = end
         return line
 
     def readlines(self, sizehint=-1):
@@ -156,7 +237,91 @@ class BZ2Reader(object):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.__dbuf.close()
+        self.__buffer = b""
+        self.__pos = 0
+
+#
+# compression used for the pickle stream and out of band buffers
+#
+def _zlib_compress(data, level):
+    return zlib.compress(data, level)
+
+def _bz2_compress(data, level):
+    return bz2.compress(data, level)
+
+def _lzma_compress(data, level):
+    return lzma.compress(data, preset=level)
+
+def _lzma_decompress(data):
+    return lzma.decompress(data)
+
+_codecs = {
+    "none"  : (None, None),
+    "zlib"  : (_zlib_compress, zlib.decompress),
+    "bz2"   : (_bz2_compress, bz2.decompress),
+    "lzma"  : (_lzma_compress, _lzma_decompress),
+}
+
+# tags used in the frame header and persistent ids
+_FRAME_MAGIC = b"MDF\x01"
+_BUFFER_PID_TAG = "mdf.remote.buffer"
+
+# out of band buffers are aligned to this many bytes in the frame
+_ALIGNMENT = 64
+
+class _BufferCollector(object):
+    """
+    Used as a pickle persistent_id function to collect large
+    arrays to be sent out of band.
+    """
+
+    def __init__(self, threshold):
+        self.buffers = []
+        self.__threshold = threshold
+        self.__pids = {}
+
+    def persistent_id(self, obj):
+        try:
+            return self.__pids[id(obj)][1]
+        except KeyError:
+            pass
+
+        result = get_out_of_band_data(obj, self.__threshold)
+        if result is None:
+            return None
+        data, fortran_order = result
+
+        pid = (_BUFFER_PID_TAG, len(self.buffers), obj.dtype.str, obj.shape, fortran_order)
+        self.buffers.append(data)
+
+        # keep a reference to obj so its id isn't reused
+        self.__pids[id(obj)] = (obj, pid)
+        return pid
+
+class _BufferLoader(object):
+    """
+    Used as a pickle persistent_load function to reconstruct
+    arrays from the out of band buffers.
+    """
+
+    def __init__(self, buffers):
+        self.__buffers = buffers
+        self.__arrays = {}
+
+    def persistent_load(self, pid):
+        tag, index, dtype, shape, fortran_order = pid
+        if tag != _BUFFER_PID_TAG:
+            raise _meta_pickle.UnpicklingError("Unsupported persistent id '%s'" % (pid,))
+
+        try:
+            return self.__arrays[index]
+        except KeyError:
+            pass
+
+        data = self.__buffers[index].view(np.dtype(dtype))
+        array = data.reshape(shape, order="F" if fortran_order else "C")
+        self.__arrays[index] = array
+        return array
 
 class Serializer(_Serializer):
     """
@@ -168,6 +333,23 @@ class Serializer(_Serializer):
     _compression_level = 1
     _is_enabled = True
 
+    # send large arrays as out of band buffers rather than in the pickle stream
+    _out_of_band = not int(os.environ.get("MDF_PYRO_NO_OOB", 0))
+    _out_of_band_threshold = 64 << 10
+
+    # list of (max size, codec) used to choose the compression for the pickle
+    # stream and each out of band buffer. The first entry with a max size
+    # larger than the data is used, or the last entry if none are.
+    _compression = [
+        (64 << 10, "none"),
+        (256 << 20, "zlib"),
+        (None, "none"),
+    ]
+
+    # buffers at least this size are passed in shared memory (None to disable)
+    _shared_memory_threshold = int(os.environ.get("MDF_PYRO_SHM_THRESHOLD", 0)) or None
+    _shared_memory_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
     def serialize(self, data, compress=True):
         """
         Serialize the given data object, try to compress if told so.
@@ -177,7 +359,10 @@ class Serializer(_Serializer):
         """
         if not self._is_enabled:
             return _Serializer.serialize(self, data, compress)
-            
+
+        if self._out_of_band:
+            return self._serialize_out_of_band(data)
+
         # try and write the decompressed pickled data first
         try:
             with MaxSizeStringIO(self._max_uncompressed_size) as buf:
@@ -201,11 +386,238 @@ class Serializer(_Serializer):
             return _Serializer.deserialize(self, data, compressed)
 
         if compressed:
+            if data[:len(_FRAME_MAGIC)] == _FRAME_MAGIC:
+                return self._deserialize_out_of_band(data)
+
             with BZ2Reader(data) as bz_file:
                 return self.pickle.load(bz_file)
 
         return self.pickle.loads(data)
 
+    @classmethod
+    def _get_codec(cls, size):
+        """returns the name of the codec to use for data of size bytes"""
+        for max_size, codec in cls._compression:
+            if max_size is None or size < max_size:
+                return codec
+        return codec
+
+    def serialize_frames(self, data):
+        """
+        Serializes data as a list of frames to be sent as a multipart
+        message without joining them, e.g. with zmq's send_multipart.
+        Returns a tuple of the frames and a bool indicating if they need
+        to be passed to deserialize_frames with compressed set.
+        """
+        if self._is_enabled and self._out_of_band:
+            stream, buffers = self._pickle_out_of_band(data)
+            if buffers or len(stream) > self._max_uncompressed_size:
+                entries, chunks = self._encode_frame(stream, buffers)
+                return [_meta_pickle.dumps(entries, 2)] + chunks, True
+            return [stream], False
+
+        data, compressed = self.serialize(data)
+        return [data], compressed
+
+    def deserialize_frames(self, frames, compressed=False):
+        """Deserializes a list of frames returned by serialize_frames."""
+        if len(frames) == 1:
+            return self.deserialize(_to_bytes(frames[0]), compressed)
+        entries = _meta_pickle.loads(_to_bytes(frames[0]))
+        return self._load_frame(entries, frames[1:])
+
+    def _pickle_out_of_band(self, data):
+        """returns the pickle stream for data and the list of large arrays separated from it"""
+        collector = _BufferCollector(self._out_of_band_threshold)
+        buf = BytesIO()
+        pickler = self.pickle.Pickler(buf, self.pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = collector.persistent_id
+        pickler.dump(data)
+        return buf.getvalue(), collector.buffers
+
+    def _serialize_out_of_band(self, data):
+        """
+        Pickles data with any large arrays separated from the pickle stream.
+
+        If there are no large arrays and the pickle stream is small the
+        pickle stream is returned as it is. Otherwise a frame is returned
+        consisting of a header, the pickle stream and then the buffers
+        for all the large arrays.
+        """
+        stream, buffers = self._pickle_out_of_band(data)
+        if not buffers and len(stream) <= self._max_uncompressed_size:
+            return stream, False
+        return self._write_frame(stream, buffers), True
+
+    def _encode_frame(self, stream, buffers):
+        """
+        returns (entries, chunks) for the pickle stream and buffers, where
+        entries is a list of (codec, size, stored size, location) and chunks
+        is the list of data to send for each entry not in shared memory.
+        The location of those entries is the index into chunks, and for
+        entries in shared memory it's the filename.
+        """
+        total_size = len(stream) + sum([b.nbytes for b in buffers])
+        if total_size > self._warn_size:
+            _log.warn(("Transferring a very large object via Pyro (%d Mb)" % (total_size >> 20))
+                      + ", performance may be affected")
+
+        entries = []
+        chunks = []
+        try:
+            for i, data in enumerate([stream] + buffers):
+                size = len(data) if i == 0 else data.nbytes
+                if i > 0 \
+                and self._shared_memory_threshold is not None \
+                and self._shared_memory_dir is not None \
+                and size >= self._shared_memory_threshold:
+                    entries.append(("shm", size, 0, self._write_shared_memory(data)))
+                    continue
+
+                raw = data
+                codec = self._get_codec(size)
+                compress_func = _codecs[codec][0]
+                if compress_func is not None:
+                    compressed = compress_func(_buffer(data), self._compression_level)
+                    if len(compressed) < size:
+                        raw = compressed
+                    else:
+                        codec = "none"
+
+                entries.append((codec, size, size if raw is data else len(raw), len(chunks)))
+                chunks.append(raw)
+        except:
+            _remove_shared_memory([e[3] for e in entries if e[0] == "shm"])
+            raise
+
+        return entries, chunks
+
+    def _write_frame(self, stream, buffers):
+        """
+        returns a single frame containing a header followed by the
+        pickle stream and buffers, as a bytearray so the data is only
+        copied once.
+        """
+        entries, chunks = self._encode_frame(stream, buffers)
+
+        # replace the chunk indexes with offsets in the frame
+        chunks = [_as_uint8(chunk) for chunk in chunks]
+        offsets = []
+        offset = 0
+        for chunk in chunks:
+            offset += -offset % _ALIGNMENT
+            offsets.append(offset)
+            offset += len(chunk)
+        entries = [(c, size, stored, l if c == "shm" else offsets[l]) for (c, size, stored, l) in entries]
+
+        header = _meta_pickle.dumps(entries, 2)
+        header_size = len(_FRAME_MAGIC) + 4 + len(header)
+        header_size += -header_size % _ALIGNMENT
+
+        frame = bytearray(header_size + offset)
+        frame[0:len(_FRAME_MAGIC)] = _FRAME_MAGIC
+        frame[len(_FRAME_MAGIC):len(_FRAME_MAGIC) + 4] = struct.pack("<I", len(header))
+        frame[len(_FRAME_MAGIC) + 4:len(_FRAME_MAGIC) + 4 + len(header)] = header
+        view = np.frombuffer(frame, dtype=np.uint8)
+        for offset, chunk in zip(offsets, chunks):
+            view[header_size + offset:header_size + offset + len(chunk)] = chunk
+
+        return frame
+
+    def _write_shared_memory(self, data):
+        """writes data to a new file in shared memory and returns the filename"""
+        fd, filename = tempfile.mkstemp(prefix="mdf-pyro-", dir=self._shared_memory_dir)
+        _shared_memory_files.add(filename)
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                data.tofile(fh)
+        except:
+            _remove_shared_memory([filename])
+            raise
+        return filename
+
+    def _deserialize_out_of_band(self, data):
+        """unpickles a frame written by _serialize_out_of_band"""
+        # the chunks are views on the data rather than copies of it
+        view = _as_uint8(data)
+        start = len(_FRAME_MAGIC)
+        header_len, = struct.unpack("<I", _to_bytes(view[start:start + 4]))
+        entries = _meta_pickle.loads(_to_bytes(view[start + 4:start + 4 + header_len]))
+        header_size = start + 4 + header_len
+        header_size += -header_size % _ALIGNMENT
+
+        chunks = []
+        for i, (codec, size, stored_size, location) in enumerate(entries):
+            if codec != "shm":
+                offset = header_size + location
+                entries[i] = (codec, size, stored_size, len(chunks))
+                chunks.append(view[offset:offset + stored_size])
+
+        return self._load_frame(entries, chunks)
+
+    def _load_frame(self, entries, chunks):
+        """
+        unpickles the pickle stream and buffers from the entries and
+        chunks returned by _encode_frame.
+
+        Uncompressed buffers are used without copying them, so the arrays
+        are only writable if the chunks are. Any shared memory files are
+        removed once loaded, or if loading fails.
+        """
+        try:
+            stream = None
+            buffers = []
+            for i, (codec, size, stored_size, location) in enumerate(entries):
+                if codec == "shm":
+                    buffers.append(np.memmap(location, dtype=np.uint8, mode="c"))
+                    _remove_shared_memory([location])
+                    continue
+
+                chunk = chunks[location]
+                if i == 0:
+                    stream = _to_bytes(chunk) if codec == "none" else _codecs[codec][1](_readable(chunk))
+                    continue
+
+                if codec == "none":
+                    buffers.append(_as_uint8(chunk)[:size])
+                else:
+                    decompressed = _codecs[codec][1](_readable(chunk))
+                    buffers.append(np.frombuffer(bytearray(decompressed), dtype=np.uint8))
+        finally:
+            _remove_shared_memory([e[3] for e in entries if e[0] == "shm"])
+
+        loader = _BufferLoader(buffers)
+        unpickler = self.pickle.Unpickler(BytesIO(stream))
+        unpickler.persistent_load = loader.persistent_load
+        return unpickler.load()
+
+def _as_uint8(chunk):
+    """returns a 1d uint8 array of the bytes of an array, string or memoryview without copying"""
+    if isinstance(chunk, memoryview):
+        chunk = np.asarray(chunk)
+    if isinstance(chunk, np.ndarray):
+        return chunk.reshape(-1).view(np.uint8)
+    return np.frombuffer(chunk, dtype=np.uint8)
+
+#
+# shared memory files written by this process are removed when they're
+# loaded, or when the process exits if they never are.
+#
+_shared_memory_files = set()
+
+def _remove_shared_memory(filenames):
+    for filename in filenames:
+        _shared_memory_files.discard(filename)
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
+
+def _remove_all_shared_memory():
+    _remove_shared_memory(list(_shared_memory_files))
+
+atexit.register(_remove_all_shared_memory)
+
 def disable_custom_pyro_serialization(enable=False):
     """
     Disables the custom pyro serialization.
@@ -0,0 +1,127 @@
+"""
+Support for repeating a run after changing some of its inputs by only
+re-evaluating the nodes affected by the change.
+"""
+from .context import MDFContext
+from .nodes import MDFVarNode, now, _get_all_callers
+import pandas as pa
+import itertools
+import copy
+
+# used to give the nodes created for each replay unique names
+_replay_counter = itertools.count()
+
+def _copy_value(value):
+    # some nodes update their values in place (e.g. queuenodes)
+    # so the recorded values have to be copies
+    try:
+        return copy.copy(value)
+    except (TypeError, copy.Error):
+        return value
+
+class ReplayRecorder(object):
+    """
+    Callback for :py:func:`run` that records the values of all the nodes
+    evaluated in the context for each date, so that the run can be repeated
+    after changing some nodes using :py:func:`replay`.
+
+    This should be the last callback passed to run so the values of the
+    nodes evaluated by the other callbacks are recorded.
+    """
+
+    def __init__(self):
+        self.ctx = None
+        self.dates = []
+        self.values = []
+        self._changes = {}
+
+    def __call__(self, date, ctx):
+        if self.ctx is None:
+            self.ctx = ctx
+        assert ctx is self.ctx, "ReplayRecorder can only record a single context"
+
+        # nodes that are still dirty weren't evaluated for this date
+        values = {}
+        for node in ctx.all_nodes():
+            if node is now or node.is_dirty(ctx) or not node.has_value(ctx):
+                continue
+            values[node] = _copy_value(node._get_cached_value(ctx))
+
+        self.dates.append(date)
+        self.values.append(values)
+
+    def get_values(self, node):
+        """returns a pandas Series of the values recorded for node"""
+        dates, values = [], []
+        for date, recorded in zip(self.dates, self.values):
+            if node in recorded:
+                dates.append(date)
+                values.append(recorded[node])
+        return pa.Series(values, index=dates)
+
+def replay(recorder, values):
+    """
+    Repeats a run recorded by a :py:class:`ReplayRecorder` with the nodes in
+    values set to new values.
+
+    Only the recorded nodes that depend on the changed nodes are re-evaluated
+    for each date. The other nodes they depend on aren't evaluated again,
+    instead they're set to their recorded values for each date.
+
+    Returns a new ReplayRecorder with the replayed values, which can also be
+    replayed.
+    """
+    ctx = recorder.ctx
+    assert ctx is not None, "Nothing has been recorded"
+
+    changes = dict(recorder._changes)
+    changes.update(values)
+    affected = _get_all_callers(changes.keys())
+
+    # the recorded nodes the affected nodes depend on in the original context
+    # are set from the recorded values for each date
+    evaluated_nodes = ctx.all_nodes()
+    inputs = set()
+    for node in affected:
+        if node in changes or node not in evaluated_nodes:
+            continue
+        for dependency, dependency_ctx in node.get_dependencies(ctx):
+            if dependency_ctx is ctx \
+            and dependency is not now \
+            and dependency not in affected:
+                inputs.add(dependency)
+
+    replay_ctx = MDFContext(recorder.dates[0])
+    for node, value in changes.items():
+        replay_ctx[node] = value
+
+    # each input is overridden with a varnode so it's not evaluated in the replay context
+    replay_id = _replay_counter.next()
+    input_overrides = {}
+    for node in inputs:
+        override = MDFVarNode("%s.__replay_%d__" % (node.name, replay_id))
+        MDFContext.unregister_node(override)
+        replay_ctx.set_override(node, override)
+        input_overrides[node] = override
+
+    result = ReplayRecorder()
+    result.ctx = ctx
+    result._changes = changes
+
+    for date, recorded in zip(recorder.dates, recorder.values):
+        # set the inputs before changing the date so any incrementally
+        # updated nodes are updated using this date's values
+        for node, override in input_overrides.iteritems():
+            if node in recorded:
+                replay_ctx[override] = recorded[node]
+        replay_ctx.set_date(date)
+
+        replayed = dict(recorded)
+        for node in affected:
+            if node in recorded:
+                replayed[node] = _copy_value(replay_ctx[node])
+
+        result.dates.append(date)
+        result.values.append(replayed)
+
+    return result
@@ -3,17 +3,22 @@ Convenience functions for creating a context and evaluating nodes
 for a range of dates and collecting the results.
 """
 from .context import MDFContext, NodeOrBuilderTimer, _profiling_is_enabled
-from .nodes import MDFNode
+from .nodes import MDFNode, MDFCallable
+from .nodetypes import MDFCustomNode, MDFAsyncDataNode
+from multiprocessing.pool import ThreadPool
+from .vectorize import _make_scenario_contexts, _release_scenario_contexts
+from .cache import flush_node_caches
 from datetime import datetime
 import numpy as np
 import pandas as pa
 import logging
 import inspect
+import types
 import sys
+import cPickle
 import atexit
 import time
 import multiprocessing.util
-from multiprocessing import Process, Pipe
 
 from matplotlib import cm
 import matplotlib.pyplot as pp
@@ -27,6 +32,9 @@ except ImportError:
 
 _logger = logging.getLogger(__name__)
 
+# maximum number of threads used to prefetch async data
+_max_prefetch_threads = 8
+
 def _create_context(date, values={}, ctx=None, **kwargs):
     if ctx is None:
         ctx = MDFContext(date)
@@ -59,6 +67,9 @@ def run(date_range,
         ctx=None,
         num_processes=0,
         tzinfo=None,
+        worker_pool=None,
+        vectorize=False,
+        prefetch=True,
         **kwargs):
     """
     creates a context and iterates through the dates in the
@@ -75,16 +86,155 @@ def run(date_range,
     If shifts is not None and num_processes is greater than 0 then that many
     child processes will be spawned and the shifts will be processed in parallel.
 
+    Alternatively worker_pool may be an :py:class:`mdf.remote.WorkerPool` whose
+    processes are kept alive and reused across multiple runs.
+
+    If vectorize is True the shifts are evaluated together in a single context
+    with each shifted node set to an array of its shifted values, indexed by
+    shift along the first axis. All the shifts must shift the same nodes.
+    Nodes that can't be evaluated with array values should be marked with
+    :py:func:`mdf.non_vectorizable` and are evaluated for each shift separately.
+    The callbacks are still called once per shift, with a shifted context for
+    each shift. The stacked values are released at the end of the run, so
+    any nodes evaluated in the returned contexts after that are evaluated in
+    them as usual.
+
     Any time-dependent nodes are reset before starting by setting the context's
     date to datetime.min (after applying time zone information if available).
+
+    If prefetch is True any async data nodes (see :py:func:`mdf.asyncdatanode`)
+    referenced by the nodes of the callbacks start loading concurrently before
+    the first timestep.
     """
+    if prefetch:
+        _prefetch_async_data(callbacks, filter)
+
     unshifted_ctx = _create_context(date_range[0], values, ctx, **kwargs)
     contexts = [unshifted_ctx]
     callbacks_per_ctx = {}
     generators_per_ctx = {}
 
-    profiling_enabled = _profiling_is_enabled()
+    _reset_date(unshifted_ctx, date_range, tzinfo)
+
+    if shifts:
+        if num_processes > 0 or worker_pool is not None:
+            return _run_multiprocess(date_range, callbacks, shifts, filter, num_processes,
+                                     unshifted_ctx, worker_pool)
+
+        # get each shift set as a sorted list so when the shifts are
+        # applied they're always done in the same order
+        shift_sets = [sorted(x.items()) for x in shifts]
+
+        if vectorize:
+            contexts = _make_scenario_contexts(unshifted_ctx, shift_sets)
+        else:
+            contexts = []
+            for shift_set in shift_sets:
+                # create the shifted context and add it to the list
+                shifted_ctx = unshifted_ctx.shift(shift_set)
+                contexts.append(shifted_ctx)
+
+    for ctx in contexts:
+        callbacks_per_ctx[ctx.get_id()] = list(callbacks)
+
+    try:
+        _run_dates(date_range, unshifted_ctx, contexts, filter, callbacks_per_ctx, generators_per_ctx)
+    finally:
+        if shifts and vectorize:
+            _release_scenario_contexts(contexts)
+        flush_node_caches()
+
+    if shifts:
+        return contexts
+    return unshifted_ctx
+
+def _get_references(obj):
+    """
+    returns the nodes and functions referenced by a node or function
+    that could be evaluated or called when it's evaluated or called.
+    """
+    if isinstance(obj, MDFNode):
+        refs = [getattr(obj, "func", None)]
+        if isinstance(obj, MDFCustomNode):
+            refs.append(obj.base_node)
+            refs.extend(obj.kwnodes.values())
+        get_filter = getattr(obj, "get_filter", None)
+        if get_filter is not None:
+            refs.append(get_filter())
+        return refs
+
+    if isinstance(obj, MDFCallable):
+        return [obj.callable] + list(obj.func_chain)
+
+    if isinstance(obj, (staticmethod, classmethod, types.MethodType)):
+        return [obj.__func__]
+
+    if isinstance(obj, types.FunctionType):
+        refs = list(obj.__defaults__ or [])
+        for cell in obj.__closure__ or []:
+            try:
+                refs.append(cell.cell_contents)
+            except ValueError:
+                # the cell's variable hasn't been assigned yet
+                pass
+
+        # globals referenced by the function or any functions defined in it
+        func_globals = obj.__globals__
+        codes = [obj.__code__]
+        while codes:
+            code = codes.pop()
+            refs.extend(func_globals[name] for name in code.co_names if name in func_globals)
+            codes.extend(c for c in code.co_consts if isinstance(c, types.CodeType))
+        return refs
+
+    return []
+
+def _find_async_data_nodes(nodes):
+    """
+    returns the async data nodes reachable from nodes, found by looking
+    at the nodes and functions each node's function refers to without
+    evaluating anything.
+    """
+    found = []
+    seen = set()
+    remaining = list(nodes)
+    while remaining:
+        obj = remaining.pop()
+        if obj is None or id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, MDFAsyncDataNode):
+            found.append(obj)
+        remaining.extend(_get_references(obj))
+    return found
+
+def _prefetch_async_data(callbacks, filter=None):
+    """
+    starts loading the data for any async data nodes referenced by the
+    nodes of the callbacks or the filter in a pool of threads.
+    """
+    nodes = [filter]
+    for callback in callbacks:
+        nodes.extend(getattr(callback, "nodes", None) or [])
+
+    # only nodes that aren't already loaded or loading need a thread
+    async_nodes = [n for n in _find_async_data_nodes(nodes) if n.pending]
+    if not async_nodes:
+        return
 
+    _logger.debug("Prefetching %d async data nodes" % len(async_nodes))
+    pool = ThreadPool(min(len(async_nodes), _max_prefetch_threads))
+    for node in async_nodes:
+        node.prefetch(pool)
+
+    # the threads exit once all the loads have completed
+    pool.close()
+
+def _reset_date(unshifted_ctx, date_range, tzinfo=None):
+    """
+    resets any time-dependent nodes before running through date_range
+    by setting the date on unshifted_ctx to the default.
+    """
     # The time to use for resetting time dependent nodes. 
     # Note: strftime() methods requires year >= 1900 
     adj_datetime_min = datetime(1900, 1, 1)
@@ -98,27 +248,14 @@ def run(date_range,
             # In a list of dates, look at the first item
             tzinfo = date_range[0].tzinfo
 
-    # ensure that any time-dependent nodes are reset before running through
-    # the date range by setting the current date on the context to the default.
     unshifted_ctx.set_date(adj_datetime_min if tzinfo is None else _localize(adj_datetime_min, tzinfo))
 
-    if shifts:
-        if num_processes > 0:
-            return _run_multiprocess(date_range, callbacks, shifts, filter, num_processes, unshifted_ctx)
-
-        # get each shift set as a sorted list so when the shifts are
-        # applied they're always done in the same order
-        shift_sets = [sorted(x.items()) for x in shifts]
-
-        contexts = []
-        for shift_set in shift_sets:
-            # create the shifted context and add it to the list
-            shifted_ctx = unshifted_ctx.shift(shift_set)
-            contexts.append(shifted_ctx)
-
-    for ctx in contexts:
-        callbacks_per_ctx[ctx.get_id()] = list(callbacks)
-
+def _run_dates(date_range, unshifted_ctx, contexts, filter, callbacks_per_ctx, generators_per_ctx):
+    """
+    advances unshifted_ctx through date_range calling the callbacks
+    for each of contexts. callbacks_per_ctx and generators_per_ctx are
+    updated so the same contexts can be continued by a later call.
+    """
     for date in date_range:
         unshifted_ctx.set_date(date)
 
@@ -161,137 +298,197 @@ def run(date_range,
             if found_generator:
                 callbacks_per_ctx[ctx_id] = [x for x in callbacks if x is not None]
 
-    if shifts:
-        return contexts
-    return unshifted_ctx
-
-def _start_remote_server(argv, pipe):
+def _run_multiprocess(date_range, callbacks, shifts, filter, num_processes, unshifted_ctx, worker_pool=None):
     """
-    function for use with multiprocessing.Process object for creating
-    a Pyro server
+    process each context in a pool of processes - called from run
     """
-    from .remote import start_server
-    start_server(pipe=pipe)
-
-def _run_multiprocess(date_range, callbacks, shifts, filter, num_processes, unshifted_ctx):
+    from .remote import WorkerPool
+
+    if worker_pool is not None:
+        return worker_pool._run(date_range, callbacks, shifts, filter, unshifted_ctx)
+
+    with WorkerPool(min(num_processes, len(shifts))) as worker_pool:
+        return worker_pool._run(date_range, callbacks, shifts, filter, unshifted_ctx)
+
+def run_partitioned(date_range,
+                    callbacks=[],
+                    values={},
+                    filter=None,
+                    ctx=None,
+                    num_partitions=None,
+                    warmup=0,
+                    num_processes=0,
+                    worker_pool=None,
+                    verify_nodes=None,
+                    tzinfo=None,
+                    **kwargs):
     """
-    process each context in a pool of processes - called from run
+    Like run, but splits date_range into num_partitions consecutive
+    partitions and runs them in parallel, either in a new pool of
+    num_processes child processes or using worker_pool.
+
+    Each partition is started warmup dates early so that nodes that only
+    depend on a bounded history (rolling windows, delays etc.) have the same
+    values they would have had in a single run by the start of the partition.
+    Callback results for the warm-up dates are discarded and the results for
+    each partition are stitched together using the callbacks' append_result
+    method (see DataFrameBuilder, CSVWriter and FinalValueCollector).
+
+    If verify_nodes is not None the values of those nodes are checked
+    against a serial run of the first two partitions, and an exception
+    is raised if they differ (e.g. because warmup is too small).
+
+    Returns the context.
     """
-    from .remote import Pyro4, SerializedContext, get_daemon, messaging
-    import select
+    from .remote import WorkerPool
+
+    ctx = _create_context(date_range[0], values, ctx, **kwargs)
+
+    if num_partitions is None:
+        num_partitions = worker_pool.num_processes if worker_pool is not None else num_processes
+    num_partitions = max(1, min(num_partitions, len(date_range)))
+
+    # split the dates into partitions, each starting warmup dates early
+    num_dates = len(date_range)
+    bounds = [num_dates * i // num_partitions for i in range(num_partitions + 1)]
+    partitions = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        start_date = date_range[start] if start > 0 else None
+        partitions.append((date_range[max(0, start - warmup):end], start_date))
+
+    verify_builder = None
+    if verify_nodes is not None:
+        verify_builder = DataFrameBuilder(verify_nodes)
+        callbacks = list(callbacks) + [verify_builder]
+
+        # the serial run is done on a copy of the context so ctx is left
+        # as it would be after the partitioned run alone
+        verify_ctx = cPickle.loads(cPickle.dumps(ctx, cPickle.HIGHEST_PROTOCOL))
+
+    if worker_pool is not None:
+        worker_pool._run_partitions(partitions, callbacks, filter, ctx, tzinfo)
+    else:
+        num_processes = min(num_processes or num_partitions, num_partitions)
+        with WorkerPool(num_processes) as worker_pool:
+            worker_pool._run_partitions(partitions, callbacks, filter, ctx, tzinfo)
+
+    if verify_builder is not None:
+        # compare with a serial run over the first partition boundary
+        sample_end = bounds[min(2, num_partitions)]
+        serial_builder = DataFrameBuilder(verify_nodes)
+        run(date_range[:sample_end], [serial_builder], filter=filter, ctx=verify_ctx, tzinfo=tzinfo)
+
+        expected = serial_builder.get_dataframe(verify_ctx)
+        actual = verify_builder.get_dataframe(ctx)
+        actual = actual[actual.index.isin(expected.index)]
+        if not actual.equals(expected):
+            first_mismatch = None
+            for date in expected.index:
+                if not actual.loc[[date]].equals(expected.loc[[date]]):
+                    first_mismatch = date
+                    break
+            raise Exception("Partitioned run differs from the serial run (first difference at %s). "
+                            "Try increasing warmup." % first_mismatch)
 
-    for callback in callbacks:
-        if not hasattr(callback, "combine_result"):
-            raise Exception("All callback objects must have a 'combine_result' method")
-
-    num_shifts = len(shifts)
-    num_processes = min(num_processes, num_shifts)
-
-    # batch the shifts into a set per-process
-    i = 0
-    shifts_per_process = {}
-    for shift_set in shifts:
-        shifts_per_process.setdefault(i, []).append(shift_set)
-        i = (i + 1) % num_processes
-
-    def start_proc_thread_func():
-        # start a child process running a pyro server and get the uri
-        parent_conn, child_conn = Pipe()
-        process = Process(target=_start_remote_server, args=(sys.argv, child_conn))
-        process.daemon = True
-        process.start()
-        timeout = time.clock() + 60
-        while process.is_alive() and time.clock() < timeout:
-            if parent_conn.poll(1):
-                break
-        else:
-            raise Exception("failed to start sub-process")
-        uri = parent_conn.recv()
-        server = Pyro4.Proxy(uri)
-        server._pyroOneway.add("shutdown")
-        return process, server
-
-    # multiprocessing expects sys.executable to take  --multiprocessing-fork option if
-    # frozen if True, but for us it's always python.exe even if frozen is set
-    sys_frozen = getattr(sys, "frozen", False)
-    sys.frozen = False
-    try:
-        # create the pool of processes and pyro servers
-        promises = [Pyro4.Future(start_proc_thread_func)() for _ in range(num_processes)]
-        processes = map(lambda promise: promise.value, promises)
+    return ctx
 
-    finally:
-        sys.frozen = sys_frozen
+def sweep(date_range,
+          metric_node,
+          shifts,
+          callbacks=[],
+          values={},
+          filter=None,
+          ctx=None,
+          num_rounds=None,
+          eta=2,
+          maximize=True,
+          min_survivors=1,
+          tzinfo=None,
+          **kwargs):
+    """
+    Evaluates shifts over date_range using successive halving to drop the
+    worst performing shifts early.
 
-    try:
-        # serialize the context once as it could be quite large
-        serialized_context = SerializedContext(unshifted_ctx)
-
-        # start running in each process
-        batches = []
-        for i, (process, remote_api) in enumerate(processes):
-            shift_set = shifts_per_process[i]
-            batch = Pyro4.batch(remote_api)
-            batch.run(date_range,
-                      callbacks=callbacks,
-                      shifts=shift_set,
-                      filter=filter,
-                      ctx=serialized_context)
-            batches.append(batch)
-
-        # kick off all the asynchronous runs
-        future_results = []
-        for batch in batches:
-            future_results.append(batch(async=True))
-
-        # poll the daemon for this process in case anything is using it while
-        # waiting for the results
-        while True:
-            for batch in future_results:
-                if not batch.ready:
-                    break
-            else:
-                break
-
-            # poll the daemon for this process while we wait for results
-            daemon = get_daemon()
-            read_sockets, unused, unused = select.select(daemon.sockets, [], [], 0.02)
-            if read_sockets:
-                daemon.events(read_sockets)
-
-            # poll the remote message loop 
-            messaging.poll_messages()
-
-        # everything's done, get the results
-        try:
-            results = [x.value.next() for x in future_results]
-        except:
-            _logger.error("".join(Pyro4.util.getPyroTraceback()))
-            raise
-
-        # re-order the results into the order as the original shifts
-        ordered_results = []
-        for i, shift_set in enumerate(shifts):
-            proc_index = i % num_processes
-            remote_ctxs, remote_cbs = results[proc_index]
-            ordered_results.append((remote_ctxs.pop(0), remote_cbs, shift_set))
-
-        # combine the results into the local callback objects
-        shifted_ctxs = []
-        for remote_ctx, remote_callbacks, shift_set in ordered_results:
-            local_ctx = unshifted_ctx.shift(shift_set)
-            shifted_ctxs.append(local_ctx)
-            with remote_ctx:
-                for local_cb, remote_cb in zip(callbacks, remote_callbacks):
-                    local_cb.combine_result(remote_cb, remote_ctx, local_ctx)
-
-        return shifted_ctxs
+    date_range is split into num_rounds rounds of geometrically increasing
+    length. All the shifts are run for the first round, then the shifts are
+    scored using the value of metric_node in each shifted context and only
+    the best 1/eta of them (but at least min_survivors) continue to the next
+    round. The surviving shifted contexts carry on from where they were
+    rather than being restarted, and the contexts for the dropped shifts are
+    cleared. By default num_rounds is enough rounds to leave a single shift
+    for the last round.
 
-    finally:
-        # shutdown the child processes
-        for process, remote_api in processes:
-            with remote_api:
-                remote_api.shutdown()
+    If maximize is False lower values of metric_node are considered better.
+    NaN values are always considered worst.
+
+    The callbacks are only called for the shifts still being evaluated.
+
+    Returns the shifted contexts that were evaluated over the whole
+    date range, ordered best first.
+    """
+    assert eta > 1, "eta must be greater than 1"
+    unshifted_ctx = _create_context(date_range[0], values, ctx, **kwargs)
+    _reset_date(unshifted_ctx, date_range, tzinfo)
+
+    if num_rounds is None:
+        num_rounds = int(np.ceil(np.log(max(len(shifts), 1)) / np.log(eta))) + 1
+
+    # each round ends eta times later than the previous one
+    num_dates = len(date_range)
+    round_ends = []
+    for i in range(num_rounds):
+        end = int(np.ceil(num_dates * float(eta) ** (i + 1 - num_rounds)))
+        if round_ends and end <= round_ends[-1]:
+            continue
+        round_ends.append(end)
+
+    # the metric is evaluated for every date, not just at the end of each
+    # round, so that any time-dependent nodes it depends on are kept updated
+    def evaluate_metric(date, ctx):
+        ctx.get_value(metric_node)
+    callbacks = [evaluate_metric] + list(callbacks)
+
+    contexts = [unshifted_ctx.shift(sorted(x.items())) for x in shifts]
+    callbacks_per_ctx = dict((c.get_id(), list(callbacks)) for c in contexts)
+    generators_per_ctx = {}
+
+    def sort_key(ctx):
+        value = ctx.get_value(metric_node)
+        if np.isnan(value):
+            return (1, 0)
+        return (0, -value if maximize else value)
+
+    start = 0
+    for i, end in enumerate(round_ends):
+        _run_dates(date_range[start:end],
+                   unshifted_ctx,
+                   contexts,
+                   filter,
+                   callbacks_per_ctx,
+                   generators_per_ctx)
+        start = end
+
+        contexts = sorted(contexts, key=sort_key)
+        if i == len(round_ends) - 1:
+            break
+
+        num_survivors = max(min_survivors, int(np.ceil(len(contexts) / float(eta))))
+        dropped = contexts[num_survivors:]
+        contexts = contexts[:num_survivors]
+
+        _logger.debug("Dropping %d of %d shifts after %s" % (len(dropped),
+                                                              len(dropped) + len(contexts),
+                                                              date_range[end - 1]))
+
+        # stop the dropped contexts from being updated, unless a surviving
+        # context is a shift of the dropped context and so may depend on it
+        for dropped_ctx in dropped:
+            callbacks_per_ctx.pop(dropped_ctx.get_id(), None)
+            generators_per_ctx.pop(dropped_ctx.get_id(), None)
+            if not any(c.is_shift_of(dropped_ctx) for c in contexts):
+                dropped_ctx.clear()
+
+    return contexts
 
 @atexit.register
 def _multprocessing_exit():
@@ -358,7 +555,8 @@ def scenario(date_range,
                 result_node,
                 x_node, x_shifts,
                 y_node, y_shifts,
-                values={}, filter=None, ctx=None, dtype=float, tzinfo=None, **kwargs):
+                values={}, filter=None, ctx=None, dtype=float, tzinfo=None,
+                vectorize=False, **kwargs):
     """
     evaluates a single result_node for each date in date_range and gets
     its final value for each shift in x_shifts and y_shifts.
@@ -366,6 +564,8 @@ def scenario(date_range,
     x_shifts and y_shifts are values for x_node and y_node respectively.
 
     result_node should evaluate to a single float, and the result is a 2d nparray
+
+    If vectorize is True all the shifts are evaluated together (see :py:func:`run`).
     """
     collector = FinalValueCollector([result_node])
 
@@ -386,6 +586,7 @@ def scenario(date_range,
                     filter=filter,
                     ctx=ctx,
                     tzinfo=tzinfo,
+                    vectorize=vectorize,
                     **kwargs)
 
     # build a numpy array of the results
@@ -0,0 +1,131 @@
+"""
+Tests for async data nodes
+"""
+from mdf import (
+    MDFContext,
+    evalnode,
+    asyncdatanode,
+    run,
+    DataFrameBuilder,
+)
+import mdf.runner
+
+from numpy.testing.utils import assert_almost_equal
+import pandas as pa
+import numpy as np
+import unittest
+import threading
+
+# this is necessary to stop namespace from looking
+# too far up the stack as it looks for the first frame
+# not in the mdf package
+__package__ = None
+
+_daterange = pa.bdate_range("2014-01-01", periods=10)
+
+# timeout so a failing test doesn't block forever
+_timeout = 10.0
+
+_lock = threading.Lock()
+_all_started = threading.Event()
+num_loads = 0
+num_active = 0
+max_active = 0
+
+def _load(value):
+    global num_loads, num_active, max_active
+    with _lock:
+        num_loads += 1
+        num_active += 1
+        max_active = max(max_active, num_active)
+        if num_active == 3:
+            _all_started.set()
+    try:
+        # when prefetching each load waits until all three are running
+        if _wait_for_all:
+            _all_started.wait(_timeout)
+        return pa.Series(value, index=_daterange)
+    finally:
+        with _lock:
+            num_active -= 1
+
+_wait_for_all = False
+
+@asyncdatanode
+def data_a():
+    return _load(1.0)
+
+@asyncdatanode
+def data_b():
+    return _load(2.0)
+
+data_c = asyncdatanode(lambda: _load(3.0), name="data_c", ffill=True)
+
+def _total():
+    return data_a() + data_b()
+
+@evalnode
+def total():
+    return _total() + data_c.delaynode(periods=1, initial_value=0.0)()
+
+class AsyncDataTest(unittest.TestCase):
+
+    def setUp(self):
+        global num_loads, max_active, _wait_for_all
+        num_loads = 0
+        max_active = 0
+        _wait_for_all = False
+        _all_started.clear()
+        for node in (data_a, data_b, data_c):
+            node.reload()
+        self._max_prefetch_threads = mdf.runner._max_prefetch_threads
+
+    def tearDown(self):
+        global _wait_for_all
+        _wait_for_all = False
+        mdf.runner._max_prefetch_threads = self._max_prefetch_threads
+
+    def test_prefetch(self):
+        global _wait_for_all
+        _wait_for_all = True
+
+        builder = DataFrameBuilder([total])
+        ctx = run(_daterange, [builder], ctx=MDFContext())
+
+        df = builder.get_dataframe(ctx)
+        assert_almost_equal(df["total"].values, [3.0] + [6.0] * (len(_daterange) - 1))
+
+        # the three loads should have run at the same time
+        self.assertEqual(num_loads, 3)
+        self.assertTrue(_all_started.is_set())
+        self.assertEqual(max_active, 3)
+
+        # the data should only be loaded once and no more threads are needed
+        for node in (data_a, data_b, data_c):
+            self.assertFalse(node.pending)
+        run(_daterange, [builder], ctx=MDFContext())
+        self.assertEqual(num_loads, 3)
+
+    def test_prefetch_max_threads(self):
+        # with a single prefetch thread the loads run one at a time
+        mdf.runner._max_prefetch_threads = 1
+        builder = DataFrameBuilder([total])
+        run(_daterange, [builder], ctx=MDFContext())
+
+        self.assertEqual(num_loads, 3)
+        self.assertEqual(max_active, 1)
+
+    def test_no_prefetch(self):
+        builder = DataFrameBuilder([total])
+        run(_daterange, [builder], ctx=MDFContext(), prefetch=False)
+
+        # the loads should have run one after another when needed
+        self.assertEqual(num_loads, 3)
+        self.assertEqual(max_active, 1)
+        self.assertFalse(_all_started.is_set())
+
+    def test_evaluate(self):
+        # async data nodes work without run as well
+        ctx = MDFContext(_daterange[0])
+        self.assertEqual(ctx[data_a], 1.0)
+        self.assertEqual(num_loads, 1)
@@ -0,0 +1,194 @@
+"""
+Tests for caching node values on disk
+"""
+from mdf import (
+    MDFContext,
+    varnode,
+    evalnode,
+    now,
+    run,
+    NodeCache,
+    set_default_node_cache,
+    DataFrameBuilder,
+    allow_duplicate_nodes,
+)
+
+from numpy.testing.utils import assert_almost_equal
+import pandas as pa
+import numpy as np
+from multiprocessing.pool import ThreadPool
+import unittest
+import tempfile
+import sqlite3
+import shutil
+import os
+
+# this is necessary to stop namespace from looking
+# too far up the stack as it looks for the first frame
+# not in the mdf package
+__package__ = None
+
+X = varnode(default=1.0)
+
+num_calls = 0
+
+@evalnode(cache=True)
+def cached():
+    global num_calls
+    num_calls += 1
+    return X() * now().day
+
+@evalnode
+def not_cached():
+    return cached() + 1.0
+
+# nodes created from source so the code of the upstream node can be changed
+_upstream_source = """
+@evalnode
+def cached_upstream():
+    return X() * %s
+
+@evalnode(cache=True)
+def cached_top():
+    return cached_upstream() + 1.0
+"""
+
+def _make_nodes(scale):
+    namespace = {"evalnode" : evalnode, "X" : X, "__name__" : __name__}
+    exec _upstream_source % scale in namespace
+    return namespace["cached_top"]
+
+def _generator():
+    while True:
+        yield 1.0
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        global num_calls
+        num_calls = 0
+        self.daterange = pa.bdate_range("2014-01-01", periods=10)
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = NodeCache(os.path.join(self.tmpdir, "cache.sqlite"))
+        set_default_node_cache(self.cache)
+
+    def tearDown(self):
+        set_default_node_cache(None)
+        shutil.rmtree(self.tmpdir)
+
+    def _run(self, **kwargs):
+        builder = DataFrameBuilder([cached, not_cached])
+        ctx = run(self.daterange, [builder], ctx=MDFContext(), **kwargs)
+        if isinstance(ctx, list):
+            return [builder.get_dataframe(c) for c in ctx]
+        return builder.get_dataframe(ctx)
+
+    def test_cache(self):
+        expected = [float(d.day) for d in self.daterange]
+
+        df = self._run()
+        assert_almost_equal(df["cached"].values, expected)
+        self.assertEqual(num_calls, len(self.daterange))
+        self.assertEqual(len(self.cache), len(self.daterange))
+
+        # running again should get all the values from the cache
+        df = self._run()
+        assert_almost_equal(df["cached"].values, expected)
+        assert_almost_equal(df["not_cached"].values, np.array(expected) + 1.0)
+        self.assertEqual(num_calls, len(self.daterange))
+
+        # changing an input should cause the node to be re-evaluated
+        df = self._run(values={X: 3.0})
+        assert_almost_equal(df["cached"].values, np.array(expected) * 3.0)
+        self.assertEqual(num_calls, len(self.daterange) * 2)
+
+        # and a new instance of the cache should find the same values
+        set_default_node_cache(NodeCache(self.cache.path))
+        self._run(values={X: 3.0})
+        self.assertEqual(num_calls, len(self.daterange) * 2)
+
+    def test_shifts(self):
+        expected = [float(d.day) for d in self.daterange]
+        dfs = self._run(shifts=[{X: 1.0}, {X: 2.0}])
+        self.assertEqual(num_calls, len(self.daterange) * 2)
+
+        dfs = self._run(shifts=[{X: 1.0}, {X: 2.0}])
+        self.assertEqual(num_calls, len(self.daterange) * 2)
+        assert_almost_equal(dfs[0]["cached"].values, expected)
+        assert_almost_equal(dfs[1]["cached"].values, np.array(expected) * 2.0)
+
+    def test_dependencies(self):
+        self._run()
+
+        # values from the cache should still be updated when their inputs change
+        ctx = MDFContext(self.daterange[0])
+        self.assertEqual(ctx[cached], self.daterange[0].day)
+        ctx[X] = 2.0
+        self.assertEqual(ctx[cached], self.daterange[0].day * 2.0)
+
+        shifted_ctx = ctx.shift({X: 3.0})
+        self.assertEqual(shifted_ctx[cached], self.daterange[0].day * 3.0)
+
+        ctx.set_date(self.daterange[1])
+        self.assertEqual(ctx[cached], self.daterange[1].day * 2.0)
+        self.assertEqual(num_calls, len(self.daterange) + 3)
+
+    def test_eviction(self):
+        self.cache.max_size = 100
+        self._run()
+        self.assertTrue(self.cache.size() <= 100)
+        self.assertTrue(0 < len(self.cache) < len(self.daterange))
+
+    def test_upstream_code_changes(self):
+        allow_duplicate_nodes(True)
+        try:
+            ctx = MDFContext(self.daterange[0])
+            ctx[X] = 2.0
+            self.assertEqual(ctx[_make_nodes(1)], 3.0)
+            self.cache.flush()
+
+            # a new cache with the same file, as if the code changed between runs
+            set_default_node_cache(NodeCache(self.cache.path))
+            ctx = MDFContext(self.daterange[0])
+            ctx[X] = 2.0
+            self.assertEqual(ctx[_make_nodes(2)], 5.0)
+        finally:
+            allow_duplicate_nodes(False)
+
+    def test_batched_writes(self):
+        ctx = MDFContext(self.daterange[0])
+        ctx[cached]
+
+        # the value isn't written until the cache is flushed
+        conn = sqlite3.connect(self.cache.path)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0], 0)
+        self.cache.flush()
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0], 1)
+        conn.close()
+
+    def test_threads(self):
+        # the cache was connected to in this thread
+        ctx = MDFContext(self.daterange[0])
+        self.assertEqual(ctx[cached], self.daterange[0].day)
+        self.cache.flush()
+
+        # and is used from other threads with different inputs
+        pool = ThreadPool(4)
+        try:
+            contexts = []
+            for i in range(8):
+                shifted_ctx = MDFContext(self.daterange[0])
+                shifted_ctx[X] = float(i + 2)
+                contexts.append(shifted_ctx)
+            results = [c.get_value_async(cached, pool) for c in contexts]
+            values = [r.get() for r in results]
+        finally:
+            pool.close()
+            pool.join()
+
+        assert_almost_equal(values, [(i + 2.0) * self.daterange[0].day for i in range(8)])
+        self.assertEqual(num_calls, 9)
+        self.assertEqual(len(self.cache), 9)
+
+    def test_generator(self):
+        self.assertRaises(AssertionError, evalnode, _generator, cache=True)
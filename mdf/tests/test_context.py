@@ -7,11 +7,15 @@ from mdf import (
     now,
     shift,
 )
+from mdf.context import DependenciesFrozenError
 from numpy.testing.utils import assert_array_almost_equal
 from pandas.core import datetools
 
 import pandas as pd
 import unittest
+from multiprocessing.pool import ThreadPool
+import threading
+import time
 
 A = varnode()
 
@@ -29,6 +33,104 @@ def D():
     while True:
         yield shift(B, shift_sets=[{A : 1}, {A : 2}, {A : 3}])
 
+X = varnode(default=1)
+Y = varnode(default=2)
+
+num_calls = {}
+
+@evalnode
+def X2():
+    num_calls["X2"] = num_calls.get("X2", 0) + 1
+    return X() * 2
+
+@evalnode
+def Y2():
+    num_calls["Y2"] = num_calls.get("Y2", 0) + 1
+    return Y() * 2
+
+@evalnode
+def XY():
+    return X2() + Y2()
+
+@evalnode
+def X3():
+    return X() * 3
+
+@evalnode
+def conditional():
+    if now().year > 1970:
+        return X3()
+    return X2()
+
+@evalnode
+def slow():
+    # sleeping releases the GIL so unrelated contexts can be evaluated concurrently
+    time.sleep(0.2)
+    return X() * 10
+
+slow_started = threading.Event()
+
+@evalnode
+def slow_2():
+    slow_started.set()
+    time.sleep(0.2)
+    return X() * 10
+
+timestep_threads = set()
+
+@evalnode
+def day():
+    return now().day
+
+def _slow_add(total, scale):
+    # sleeping releases the GIL so independent nodes can be updated concurrently
+    time.sleep(0.1)
+    timestep_threads.add(threading.current_thread().ident)
+    return total + day() * X() * scale
+
+@evalnode
+def slow_sum_1():
+    total = 0
+    while True:
+        total = _slow_add(total, 1)
+        yield total
+
+@evalnode
+def slow_sum_2():
+    total = 0
+    while True:
+        total = _slow_add(total, 2)
+        yield total
+
+@evalnode
+def slow_sum_3():
+    total = 0
+    while True:
+        total = _slow_add(total, 3)
+        yield total
+
+@evalnode
+def sum_of_sums():
+    while True:
+        yield slow_sum_1() + slow_sum_2() + slow_sum_3()
+
+@nansumnode
+def day_total():
+    return day()
+
+@evalnode
+def nested_day_total():
+    # advances a separate context with nodes needing on_set_date callbacks
+    nested_ctx = MDFContext(now())
+    while True:
+        nested_ctx.set_date(now())
+        yield nested_ctx[day_total]
+
+@evalnode
+def nested_sums():
+    while True:
+        yield nested_day_total() + slow_sum_1()
+
 class ContextTest(unittest.TestCase):
     def setUp(self):
         self.daterange = pd.bdate_range(datetime(1970, 1, 1), periods=3, freq=datetools.yearEnd)
@@ -51,3 +153,200 @@ class ContextTest(unittest.TestCase):
             res.append(self.ctx[D])
 
         assert_array_almost_equal(res, [(1,2,3), (3,5,7), (6,9,12)])
+
+    def test_clear(self):
+        self.ctx.set_date(self.daterange[0])
+        self.ctx[C]
+        self.assertTrue(C in self.ctx.all_nodes())
+
+        # B is only evaluated in the shifted contexts
+        shifted_ctx = self.ctx.shift({A : 1})
+        self.assertTrue(B in shifted_ctx.all_nodes())
+        self.assertTrue(C not in shifted_ctx.all_nodes())
+
+        self.ctx.clear()
+        self.assertEqual(self.ctx.all_nodes(), set())
+        self.assertEqual(shifted_ctx.all_nodes(), set())
+        self.assertTrue(B.get_state(self.ctx) is None)
+        self.assertTrue(B.get_state(shifted_ctx) is None)
+
+    def test_shift_affected_nodes(self):
+        num_calls.clear()
+        self.assertEqual(self.ctx[XY], 6)
+
+        # only the nodes that call X need evaluating in the shifted context
+        shifted_ctx = self.ctx.shift({X : 10})
+        self.assertEqual(shifted_ctx[XY], 24)
+        self.assertEqual(num_calls, {"X2" : 2, "Y2" : 1})
+        self.assertEqual(shifted_ctx[Y2], 4)
+        self.assertEqual(num_calls["Y2"], 1)
+
+        # nodes first evaluated in the parent after the shift was
+        # created still pick up the shift
+        self.assertEqual(self.ctx[X3], 3)
+        self.assertEqual(shifted_ctx[X3], 30)
+
+    def test_freeze_dependencies(self):
+        res = []
+        for i, t in enumerate(self.daterange):
+            self.ctx.set_date(t)
+            res.append(self.ctx[C])
+            if i == 0:
+                self.assertEqual(self.ctx[XY], 6)
+                self.ctx.freeze_dependencies()
+                self.assertTrue(self.ctx.dependencies_frozen)
+
+        assert_array_almost_equal(res, [(1,2,3), (3,5,7), (6,9,12)])
+
+        # changes still propagate through the frozen dependencies
+        self.assertEqual(self.ctx[XY], 6)
+        self.ctx[X] = 5
+        self.assertEqual(self.ctx[XY], 14)
+
+        # setting the date back unfreezes the dependencies
+        self.ctx.set_date(self.daterange[0])
+        self.assertFalse(self.ctx.dependencies_frozen)
+
+    def test_freeze_dependencies_stable_steps(self):
+        self.ctx.freeze_dependencies(stable_steps=1)
+        res = []
+        frozen = []
+        for t in self.daterange:
+            self.ctx.set_date(t)
+            frozen.append(self.ctx.dependencies_frozen)
+            res.append(self.ctx[C])
+
+        assert_array_almost_equal(res, [(1,2,3), (3,5,7), (6,9,12)])
+        self.assertEqual(frozen, [False, False, True])
+
+    def test_freeze_dependencies_shifted(self):
+        # contexts shifted after freezing inherit the freeze settings
+        self.ctx.freeze_dependencies(stable_steps=1)
+        shifted_ctx = self.ctx.shift({X : 10})
+        frozen = []
+        for t in self.daterange:
+            self.ctx.set_date(t)
+            shifted_ctx[C]
+            frozen.append(shifted_ctx.dependencies_frozen)
+
+        self.assertEqual(frozen, [False, False, True])
+
+    def test_freeze_dependencies_verify(self):
+        self.ctx.set_date(self.daterange[0])
+        self.assertEqual(self.ctx[conditional], 2)
+        self.ctx.freeze_dependencies(verify=True)
+
+        # conditional depends on X3 instead of X2 after the first date
+        self.ctx.set_date(self.daterange[1])
+        self.assertRaises(DependenciesFrozenError, self.ctx.get_value, conditional)
+
+    def test_threads(self):
+        # each thread has its own current context
+        results = {}
+        def evaluate(i):
+            ctx = MDFContext(self.daterange[0])
+            ctx[X] = i
+            results[i] = [ctx[XY] for j in range(100)]
+
+        threads = [threading.Thread(target=evaluate, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, dict((i, [i * 2 + 4] * 100) for i in range(4)))
+
+    def test_get_value_async(self):
+        contexts = []
+        for i in range(4):
+            ctx = MDFContext(self.daterange[0])
+            ctx[X] = i
+            contexts.append(ctx)
+
+        # shifted contexts share node state with their parent so are evaluated in turn
+        shifted_ctx = contexts[0].shift({X : 10})
+
+        pool = ThreadPool(5)
+        try:
+            start = time.time()
+            results = [ctx.get_value_async(slow, pool) for ctx in contexts + [shifted_ctx]]
+            values = [result.get(10) for result in results]
+            elapsed = time.time() - start
+        finally:
+            pool.close()
+
+        self.assertEqual(values, [0, 10, 20, 30, 100])
+        self.assertTrue(elapsed < 0.2 * len(results))
+
+    def test_get_value_async_set_value(self):
+        ctx = MDFContext(self.daterange[0])
+        slow_started.clear()
+
+        pool = ThreadPool(1)
+        try:
+            result = ctx.get_value_async(slow_2, pool)
+            self.assertTrue(slow_started.wait(10))
+
+            # setting X should wait for the pending evaluation to finish
+            ctx[X] = 5
+            self.assertEqual(result.get(10), 10)
+            self.assertEqual(ctx[slow_2], 50)
+        finally:
+            pool.close()
+
+    def test_timestep_pool(self):
+        dates = pd.bdate_range(datetime(2000, 1, 1), periods=5)
+
+        expected = []
+        ctx = MDFContext(dates[0])
+        for date in dates:
+            ctx.set_date(date)
+            expected.append(ctx[sum_of_sums])
+
+        timestep_threads.clear()
+        pool = ThreadPool(3)
+        try:
+            parallel_ctx = MDFContext(dates[0])
+            parallel_ctx.set_timestep_pool(pool)
+            start = time.time()
+            values = []
+            for date in dates:
+                parallel_ctx.set_date(date)
+                values.append(parallel_ctx[sum_of_sums])
+            elapsed = time.time() - start
+        finally:
+            pool.close()
+
+        self.assertEqual(values, expected)
+
+        # the slow nodes should have been evaluated at the same time after the first date
+        self.assertTrue(len(timestep_threads) > 1)
+        self.assertTrue(elapsed < 0.3 + 0.2 * (len(dates) - 1), elapsed)
+
+        # and the dependencies should be the same as when evaluated in one thread
+        for node in (sum_of_sums, slow_sum_1, day):
+            self.assertEqual(sorted(n.name for n, c in node.get_dependencies(parallel_ctx)),
+                             sorted(n.name for n, c in node.get_dependencies(ctx)))
+
+    def test_timestep_pool_other_context(self):
+        # nodes using a separate context are evaluated one at a time
+        dates = pd.bdate_range(datetime(2000, 1, 1), periods=5)
+
+        expected = []
+        ctx = MDFContext(dates[0])
+        for date in dates:
+            ctx.set_date(date)
+            expected.append(ctx[nested_sums])
+
+        pool = ThreadPool(2)
+        try:
+            parallel_ctx = MDFContext(dates[0])
+            parallel_ctx.set_timestep_pool(pool)
+            values = []
+            for date in dates:
+                parallel_ctx.set_date(date)
+                values.append(parallel_ctx[nested_sums])
+        finally:
+            pool.close()
+
+        self.assertEqual(values, expected)
@@ -0,0 +1,126 @@
+"""
+Tests for keeping the history of node values
+"""
+from mdf import (
+    MDFContext,
+    varnode,
+    evalnode,
+    run,
+    keep_history,
+    set_history_options,
+    DataFrameBuilder,
+)
+
+from numpy.testing.utils import assert_almost_equal
+import pandas as pa
+import numpy as np
+import unittest
+import tempfile
+import shutil
+import os
+
+# this is necessary to stop namespace from looking
+# too far up the stack as it looks for the first frame
+# not in the mdf package
+__package__ = None
+
+X = varnode(default=1.0)
+
+@keep_history
+@evalnode
+def total():
+    t = 0.0
+    while True:
+        t += X()
+        yield t
+
+@evalnode(category="history_test")
+def series():
+    return pa.Series([total(), -total()], index=["a", "b"])
+
+keep_history(category="history_test")
+
+@evalnode(category="history_test")
+def name():
+    return "total=%d" % total()
+
+@evalnode
+def no_history():
+    return total()
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.daterange = pa.bdate_range("2014-01-01", periods=20)
+        self.ctx = MDFContext()
+
+    def tearDown(self):
+        set_history_options(chunk_size=1024)
+
+    def _run(self, ctx=None, nodes=[total, series, name]):
+        builder = DataFrameBuilder(nodes)
+        run(self.daterange, [builder], ctx=ctx or self.ctx)
+        return builder
+
+    def test_history(self):
+        builder = self._run()
+        expected = builder.get_dataframe(self.ctx)
+
+        history = self.ctx.history(total)
+        self.assertEqual(list(history.index), list(self.daterange))
+        assert_almost_equal(history.values, expected["total"].values)
+
+        # values between two dates
+        history = self.ctx.history(total, self.daterange[5], self.daterange[9])
+        self.assertEqual(list(history.index), list(self.daterange[5:10]))
+        assert_almost_equal(history.values, expected["total"].values[5:10])
+
+        # running again should replace the history rather than appending to it
+        self._run()
+        self.assertEqual(len(self.ctx.history(total)), len(self.daterange))
+
+        self.assertRaises(AttributeError, self.ctx.history, no_history)
+
+    def test_categories(self):
+        self._run()
+
+        df = self.ctx.history(series)
+        self.assertEqual(list(df.columns), ["a", "b"])
+        self.assertEqual(list(df.index), list(self.daterange))
+        assert_almost_equal(df["a"].values, self.ctx.history(total).values)
+        assert_almost_equal(df["b"].values, -self.ctx.history(total).values)
+
+        names = self.ctx.history(name)
+        self.assertEqual(list(names), ["total=%d" % (i + 1) for i in range(len(self.daterange))])
+
+    def test_shifted(self):
+        builder = DataFrameBuilder([total, series])
+        ctx, shifted_ctx = run(self.daterange, [builder], shifts=[{}, {X: 2.0}], ctx=self.ctx)
+
+        history = shifted_ctx.history(total)
+        assert_almost_equal(history.values, [2.0 * (i + 1) for i in range(len(self.daterange))])
+        history = ctx.history(total)
+        assert_almost_equal(history.values, [1.0 * (i + 1) for i in range(len(self.daterange))])
+
+    def test_spill(self):
+        spill_dir = tempfile.mkdtemp()
+        try:
+            set_history_options(chunk_size=4, max_chunks_in_memory=1, spill_dir=spill_dir)
+            self._run()
+
+            self.assertTrue(len(os.listdir(spill_dir)) > 0)
+            history = self.ctx.history(total)
+            self.assertEqual(list(history.index), list(self.daterange))
+            assert_almost_equal(history.values, [float(i + 1) for i in range(len(self.daterange))])
+
+            history = self.ctx.history(series, self.daterange[2], self.daterange[10])
+            self.assertEqual(list(history.index), list(self.daterange[2:11]))
+
+            # re-running from the start should replace the spilled values
+            self._run()
+            self.assertEqual(len(self.ctx.history(total)), len(self.daterange))
+
+            self.ctx.clear()
+            self.assertEqual(os.listdir(spill_dir), [])
+        finally:
+            shutil.rmtree(spill_dir)
@@ -0,0 +1,63 @@
+from datetime import datetime
+from mdf import (
+    MDFContext,
+    MemorySampler,
+    varnode,
+    evalnode,
+    queuenode,
+    run,
+    shift,
+)
+from pandas.core import datetools
+
+import numpy as np
+import pandas as pd
+import unittest
+
+size = varnode(default=1000)
+
+@evalnode
+def big_array():
+    return np.ones(size(), dtype=np.float64)
+
+@queuenode
+def array_queue():
+    return big_array().sum()
+
+@evalnode
+def shifted_sum():
+    return shift(big_array, size, [2000])[0].sum()
+
+class MemoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.daterange = pd.bdate_range(datetime(1970, 1, 1), periods=5)
+        self.ctx = MDFContext(self.daterange[0])
+
+    def test_memory_report(self):
+        self.ctx[shifted_sum]
+        self.ctx[array_queue]
+
+        report = self.ctx.memory_report()
+        by_node = report.by_node()
+
+        self.assertTrue(by_node.loc[big_array.name, "value"] >= 3000 * 8)
+        self.assertTrue(by_node.loc[array_queue.name, "iterator"] > 0)
+
+        # the shifted context should show up separately
+        by_ctx = report.by_context()
+        self.assertEqual(len(by_ctx), 2)
+        self.assertEqual(report.total, by_node["total"].sum())
+
+        # excluding shifted contexts only counts the root context
+        report = self.ctx.memory_report(include_shifted=False)
+        self.assertEqual(len(report.by_context()), 1)
+
+    def test_memory_sampler(self):
+        sampler = MemorySampler(period=2)
+        run(self.daterange, [sampler], ctx=self.ctx)
+
+        series = sampler.get_series(self.ctx)
+        self.assertEqual(list(series.index), list(self.daterange[::2]))
+        self.assertTrue((series > 0).all())
+        self.assertTrue(sampler.last_report.total > 0)
@@ -3,6 +3,7 @@ from mdf import (
     evalnode,
     queuenode,
     nansumnode,
+    returnsnode,
     cumprodnode,
     delaynode,
     ffillnode,
@@ -55,6 +56,38 @@ def queue_filter_test():
 def nansum_output():
     return A() + sometimes_nan_B()
 
+@evalnode
+def prices():
+    b = sometimes_nan_B()
+    return np.array([1.0 + b, 10.0 + b, np.nan])
+
+@nansumnode
+def nansum_array():
+    return prices()
+
+@nansumnode
+def nansum_growing():
+    return np.ones(2 + B() * 100000)
+
+@nansumnode
+def nansum_reordered():
+    series = pd.Series([1.0, 2.0], index=["a", "b"])
+    if B() % 2:
+        series = series[["b", "a"]]
+    return series
+
+@returnsnode
+def returns_float():
+    return prices()[0]
+
+@returnsnode
+def returns_array():
+    return prices()
+
+@returnsnode
+def returns_series():
+    return pd.Series(prices(), index=["a", "b", "c"])
+
 @cumprodnode()
 def cumprod_output():
     return A() + B()
@@ -80,6 +113,10 @@ def B():
 def A_plus_B():
     return A() + B()
 
+@evalnode
+def weights():
+    return np.array([1.0, 2.0, 4.0]) + B()
+
 @evalnode
 def Counter():
     accum = -2.0
@@ -176,6 +213,45 @@ class NodeTest(unittest.TestCase):
         nansum = self.ctx[nansum_output]
         self.assertEqual(nansum, 812)
 
+    def _get_prices(self):
+        b = [np.nan if i % 2 else float(i) for i in range(len(self.daterange))]
+        return pd.DataFrame({"a" : np.array(b) + 1.0,
+                             "b" : np.array(b) + 10.0,
+                             "c" : np.nan},
+                            columns=["a", "b", "c"])
+
+    def test_nansumnode_array(self):
+        node = nansum_array.queuenode()
+        self._run(node)
+        expected = self._get_prices().cumsum().ffill()
+        assert_almost_equal(np.array(list(self.ctx[node])), expected.values)
+
+    def test_nansumnode_size_changes(self):
+        self.ctx.set_date(self.daterange[0])
+        assert_almost_equal(self.ctx[nansum_growing], [1.0, 1.0])
+        # nansumnodes are updated when the date changes
+        self.assertRaises(ValueError, self.ctx.set_date, self.daterange[1])
+
+    def test_nansumnode_series_alignment(self):
+        self._run(nansum_reordered)
+        value = self.ctx[nansum_reordered]
+        n = len(self.daterange)
+        self.assertEqual(dict(value), {"a" : 1.0 * n, "b" : 2.0 * n})
+
+    def test_returnsnode(self):
+        nodes = [returns_float.queuenode(),
+                 returns_array.queuenode(),
+                 returns_series.queuenode()]
+        self._run(*nodes)
+
+        expected = self._get_prices().ffill().pct_change().fillna(0.0)
+        assert_almost_equal(np.array(list(self.ctx[nodes[0]])), expected["a"].values)
+        assert_almost_equal(np.array(list(self.ctx[nodes[1]])), expected.values)
+
+        series = list(self.ctx[nodes[2]])
+        self.assertEqual(list(series[-1].index), ["a", "b", "c"])
+        assert_almost_equal(np.array([s.values for s in series]), expected.values)
+
     def test_cumprodnode(self):
         self._run(cumprod_output)
         cumprod = self.ctx[cumprod_output]
@@ -256,6 +332,28 @@ class NodeTest(unittest.TestCase):
         self._test(Counter - Counter,  [ 0.0,  0.0,  0.0,  0.0,  0.0,  0.0,  0.0])
         self._test(Counter * Counter,  [ 4.0,  2.25, 1.0,  0.25, 0.25, 1.0,  2.25])
         self._test(Counter / Counter,  [ 1.0,  1.0,  1.0,  1.0,  1.0,  1.0,  1.0])
+
+    def test_fused_operators(self):
+        node = (prices - weights) / weights * 2.0 + 1.0
+        self.assertEqual(node.short_name, "(((prices - weights) / weights) * 2.0) + 1.0")
+        self.assertEqual([n.short_name for n in node.expression_nodes], ["prices", "weights", "weights"])
+
+        # the same expression should always give the same node
+        self.assertTrue(node is (prices - weights) / weights * 2.0 + 1.0)
+
+        for t in self.daterange:
+            self.ctx.set_date(t)
+            p = self.ctx[prices].copy()
+            w = self.ctx[weights].copy()
+            assert_almost_equal(self.ctx[node], (p - w) / w * 2.0 + 1.0)
+
+            # the inputs shouldn't have been modified
+            assert_almost_equal(self.ctx[prices], p)
+            assert_almost_equal(self.ctx[weights], w)
+
+        # only the nodes in the expression should be dependencies
+        dependencies = set(n for n, ctx in node.get_dependencies(self.ctx))
+        self.assertEqual(dependencies, set([prices, weights]))
         
     def _test(self, node, expected_values):
         values = node.queuenode()
@@ -15,6 +15,7 @@ import shutil
 import os
 import random
 import pickle
+import zipfile
 
 A = varnode()
 
@@ -30,6 +31,27 @@ def B():
 def C():
     return B()
 
+D = varnode()
+E = varnode()
+
+@evalnode(category="pickle_test")
+def F():
+    return A() * 3
+
+_num_pickled = 0
+_num_unpickled = 0
+
+class _CountUnpickled(object):
+    """counts how many times instances are pickled and unpickled"""
+    def __getstate__(self):
+        global _num_pickled
+        _num_pickled += 1
+        return {}
+
+    def __setstate__(self, state):
+        global _num_unpickled
+        _num_unpickled += 1
+
 # this is necessary to stop namespace from looking
 # too far up the stack as it looks for the first frame
 # not in the mdf package
@@ -136,3 +158,163 @@ class PickleTest(unittest.TestCase):
                 os.unlink(filename)
         finally:
             shutil.rmtree(tmpdir, True)
+
+    def test_save_compression(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            a = self.ctx[A] = random.randint(0, 100)
+            filename = os.path.join(tmpdir, "ctx.dat")
+            for compression, compresslevel in (("zip", 0),
+                                               ("zip", 1),
+                                               ("gzip", 1),
+                                               ("none", None)):
+                self.ctx.save(filename, compression=compression, compresslevel=compresslevel)
+                new_ctx = MDFContext.load(filename, compression=compression)
+                self.assertEquals(new_ctx[A], a)
+
+                if compression == "zip":
+                    zip_fh = zipfile.ZipFile(filename)
+                    try:
+                        self.assertEquals(zip_fh.testzip(), None)
+                        self.assertEquals(zip_fh.namelist(), ["ctx.dag"])
+                    finally:
+                        zip_fh.close()
+
+                os.unlink(filename)
+
+            self.assertRaises(ValueError, self.ctx.save, filename, compression="rar")
+        finally:
+            shutil.rmtree(tmpdir, True)
+
+    def test_save_out_of_band(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "ctx.dag")
+            array = np.arange(100000, dtype=np.float64)
+            df = pa.DataFrame({"x" : array, "y" : array * 2})
+            self.ctx[A] = array
+            self.ctx[D] = df
+
+            self.ctx.save(filename, out_of_band=True)
+            self.assertTrue(os.path.exists(filename + ".arrays"))
+            self.assertTrue(os.stat(filename).st_size < array.nbytes)
+
+            for mmap in (False, True):
+                new_ctx = MDFContext.load(filename, mmap=mmap)
+                self.assertTrue((new_ctx[A] == array).all())
+                self.assertTrue((new_ctx[D] == df).all().all())
+                self.assertEquals(isinstance(new_ctx[A], np.memmap), mmap)
+                del new_ctx
+        finally:
+            shutil.rmtree(tmpdir, True)
+
+    def test_save_out_of_band_lazy(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "ctx.dag")
+            array = np.arange(100000, dtype=np.float64)
+            self.ctx[E] = [array, _CountUnpickled()]
+            num_pickled = _num_pickled
+            self.ctx.save(filename, out_of_band=True)
+            self.assertEquals(_num_pickled, num_pickled + 1)
+
+            # values are only unpickled when accessed if memory mapped
+            num_unpickled = _num_unpickled
+            new_ctx = MDFContext.load(filename, mmap=True)
+            self.assertEquals(_num_unpickled, num_unpickled)
+            self.assertTrue((new_ctx[E][0] == array).all())
+            self.assertEquals(_num_unpickled, num_unpickled + 1)
+
+            new_ctx = MDFContext.load(filename, mmap=False)
+            self.assertEquals(_num_unpickled, num_unpickled + 2)
+            self.assertTrue((new_ctx[E][0] == array).all())
+
+            # small values are only pickled once, inline
+            self.ctx[E] = [1, _CountUnpickled()]
+            num_pickled = _num_pickled
+            self.ctx.save(filename, out_of_band=True)
+            self.assertEquals(_num_pickled, num_pickled + 1)
+            new_ctx = MDFContext.load(filename, mmap=True)
+            self.assertEquals(_num_unpickled, num_unpickled + 3)
+            self.assertEquals(new_ctx[E][0], 1)
+        finally:
+            shutil.rmtree(tmpdir, True)
+
+    def test_save_out_of_band_replace(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "ctx.dag")
+            array = np.arange(100000, dtype=np.float64)
+            self.ctx[A] = array
+            self.ctx.save(filename, out_of_band=True)
+            stale_filename = os.path.join(tmpdir, "stale.arrays")
+            shutil.copy(filename + ".arrays", stale_filename)
+
+            # re-saving mustn't change the arrays of a context mapping the file
+            mapped_ctx = MDFContext.load(filename, mmap=True)
+            self.assertTrue((mapped_ctx[A] == array).all())
+            self.ctx[A] = array * 2
+            self.ctx.save(filename, out_of_band=True)
+            self.assertTrue((mapped_ctx[A] == array).all())
+            self.assertTrue((MDFContext.load(filename, mmap=True)[A] == array * 2).all())
+            self.assertEquals(sorted(os.listdir(tmpdir)), ["ctx.dag", "ctx.dag.arrays", "stale.arrays"])
+
+            # the array file is ignored if the context's saved without it
+            self.ctx[A] = 10
+            self.ctx.save(filename)
+            self.assertEquals(MDFContext.load(filename, mmap=True)[A], 10)
+
+            # and an array file from a different save isn't used
+            self.ctx[A] = array
+            self.ctx.save(filename, out_of_band=True)
+            shutil.copy(stale_filename, filename + ".arrays")
+            self.assertRaises(pickle.UnpicklingError, MDFContext.load, filename)
+        finally:
+            shutil.rmtree(tmpdir, True)
+
+    def test_save_root_nodes(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "ctx.dag")
+            a = self.ctx[A] = 10
+            b = self.ctx[B]
+            c = self.ctx[C]
+
+            # C isn't required by B so shouldn't be saved, and neither
+            # should the shifted context
+            shifted_ctx = self.ctx.shift({A : 100})
+            shifted_ctx[B]
+            num_calls = _b_num_calls
+
+            self.ctx.save(filename, root_nodes=[B])
+            new_ctx = MDFContext.load(filename)
+
+            self.assertEquals(new_ctx[B], b)
+            self.assertEquals(num_calls, _b_num_calls)
+            self.assertEquals(C.get_state(new_ctx), None)
+            self.assertEquals(new_ctx.get_shifted_contexts(), [])
+            self.assertEquals(new_ctx[C], c)
+        finally:
+            shutil.rmtree(tmpdir, True)
+
+    def test_save_categories_shifted(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "ctx.dag")
+            self.ctx[A] = 10
+            self.ctx[B]
+
+            # F is only evaluated in the shifted context
+            shifted_ctx = self.ctx.shift({A : 100})
+            self.assertEquals(shifted_ctx[F], 300)
+
+            self.ctx.save(filename, categories=["pickle_test"])
+            new_ctx = MDFContext.load(filename)
+
+            self.assertEquals(B.get_state(new_ctx), None)
+            new_shifted_ctxs = new_ctx.get_shifted_contexts()
+            self.assertEquals(len(new_shifted_ctxs), 1)
+            self.assertNotEquals(F.get_state(new_shifted_ctxs[0]), None)
+            self.assertEquals(new_shifted_ctxs[0][F], 300)
+        finally:
+            shutil.rmtree(tmpdir, True)
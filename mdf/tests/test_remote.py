@@ -2,10 +2,18 @@
 Tests for scenario analysis using multprocessing
 """
 import unittest
-from mdf.builders.basic import DataFrameBuilder
-from mdf import MDFContext, run, varnode, evalnode, now
+from mdf.builders.basic import DataFrameBuilder, FinalValueCollector, CSVWriter
+from mdf import MDFContext, run, run_partitioned, varnode, evalnode, queuenode, now
+from mdf.remote import WorkerPool, ServerPool, SerializedContext, MDFRemoteAPI
+from mdf.remote.pool import _start_worker, _Worker
+import mdf.remote.pool
+import Pyro4
 import pandas as pd
 from datetime import datetime
+import pytz
+from StringIO import StringIO
+import threading
+import socket
 import time
 
 A = varnode()
@@ -15,6 +23,19 @@ B = varnode()
 def X():
     return A() + B() + now().day
 
+@queuenode(size=3)
+def QueueX():
+    return X()
+
+@evalnode
+def RollingX():
+    return sum(QueueX())
+
+@evalnode
+def SlowX():
+    time.sleep(0.05)
+    return X()
+
 
 class RemoteTest(unittest.TestCase):
 
@@ -57,3 +78,265 @@ class RemoteTest(unittest.TestCase):
 
         print ("Took %fs using %d processes" % ((end_time - start_time), num_processes))
         print ("Took %fs using 1 process" % (sync_end_time - sync_start_time))
+
+    def test_worker_pool(self):
+        date_range = pd.bdate_range(datetime(1970, 1, 1), periods=5)
+        shifts = [{A: i, B: i * 2} for i in range(6)]
+        other_shifts = [{A: i * 10, B: i} for i in range(6)]
+
+        with WorkerPool(2) as pool:
+            results = []
+            for shift_sets in (shifts, other_shifts):
+                df_builder = DataFrameBuilder([X])
+                shifted_ctxs = pool.run(date_range, [df_builder], shifts=shift_sets, ctx=self.ctx)
+                results.append((shift_sets, shifted_ctxs, df_builder))
+
+                # each worker should have cached the context
+                key = SerializedContext(self.ctx, with_key=True).key
+                workers = pool._workers
+                self.assertEquals(len(workers), 2)
+                for worker in workers:
+                    self.assertTrue(worker.remote_api.has_cached_context(key, pool._client_id))
+                    self.assertFalse(worker.remote_api.has_cached_context(key))
+
+        # compare with the same thing in a single process
+        for shift_sets, shifted_ctxs, df_builder in results:
+            sync_df_builder = DataFrameBuilder([X])
+            sync_shifted_ctxs = run(date_range, [sync_df_builder], shifts=shift_sets, ctx=self.ctx)
+            self.assertEquals(shifted_ctxs, sync_shifted_ctxs)
+
+            for ctx in shifted_ctxs:
+                df = df_builder.get_dataframe(ctx)
+                sync_df = sync_df_builder.get_dataframe(ctx)
+                assert df.equals(sync_df)
+
+    def test_worker_pool_chunksize(self):
+        date_range = pd.bdate_range(datetime(1970, 1, 1), periods=5)
+        shifts = [{A: i, B: i * 3} for i in range(7)]
+
+        # results are combined as each chunk finishes, but should be
+        # the same as running all the shifts at once
+        with WorkerPool(2, chunksize=2) as pool:
+            df_builder = DataFrameBuilder([X])
+            shifted_ctxs = pool.run(date_range, [df_builder], shifts=shifts, ctx=self.ctx)
+
+        sync_df_builder = DataFrameBuilder([X])
+        sync_shifted_ctxs = run(date_range, [sync_df_builder], shifts=shifts, ctx=self.ctx)
+        self.assertEquals(shifted_ctxs, sync_shifted_ctxs)
+
+        for ctx in shifted_ctxs:
+            df = df_builder.get_dataframe(ctx)
+            sync_df = sync_df_builder.get_dataframe(ctx)
+            assert df.equals(sync_df)
+
+    def test_release_run_contexts(self):
+        date_range = pd.bdate_range(datetime(1970, 1, 1), periods=5)
+        shifts = [{A: i, B: i * 2} for i in range(3)]
+        api = MDFRemoteAPI(None)
+
+        # each client gets its own copy of the cached context
+        serialized_context = SerializedContext(self.ctx, with_key=True)
+        parents = {}
+        for client_id in ("a", "b"):
+            remote_ctxs, _ = api.run(date_range, [DataFrameBuilder([X])], shifts=shifts,
+                                     ctx=serialized_context, client_id=client_id)
+            self.assertTrue(api.has_cached_context(serialized_context.key, client_id))
+            parents[client_id] = remote_ctxs[0]._get_real_context().get_parent()
+        released_ctx = parents["a"].shift(shifts[0])
+        self.assertFalse(parents["a"] is parents["b"])
+        num_shifted_ctxs = len(parents["b"].get_shifted_contexts())
+        self.assertTrue(num_shifted_ctxs >= len(shifts))
+
+        # releasing one client's contexts removes them from the cached context
+        # without affecting the other client
+        api.release_run_contexts("a")
+        self.assertEquals(parents["a"].get_shifted_contexts(), [])
+        self.assertEquals(len(parents["b"].get_shifted_contexts()), num_shifted_ctxs)
+        self.assertFalse(parents["a"].shift(shifts[0]) is released_ctx)
+
+    def test_shift_results(self):
+        date_range = pd.bdate_range(datetime(1970, 1, 1), periods=5)
+        shifts = [{A: i, B: i * 2} for i in range(3)]
+        api = MDFRemoteAPI(None)
+
+        serialized_context = SerializedContext(self.ctx, with_key=True)
+        num_results = api.run_shifts(date_range, [DataFrameBuilder([X])], shifts=shifts,
+                                     ctx=serialized_context, client_id="a")
+        self.assertEquals(num_results, len(shifts))
+
+        sync_df_builder = DataFrameBuilder([X])
+        sync_shifted_ctxs = run(date_range, [sync_df_builder], shifts=shifts, ctx=self.ctx)
+
+        # each result only has the callbacks' data for its own context, and
+        # each context is released once the next result is fetched
+        parent = None
+        for i, sync_ctx in enumerate(sync_shifted_ctxs):
+            remote_ctx, remote_cbs = api.next_shift_result("a")
+            real_ctx = remote_ctx._get_real_context()
+            parent = real_ctx.get_parent()
+            self.assertEquals(real_ctx.get_shift_set(), sync_ctx.get_shift_set())
+            self.assertEquals(remote_cbs[0].context_handler_dict, {})
+            self.assertEquals(remote_cbs[0]._cached_dataframes.keys(), [real_ctx.get_id()])
+            assert remote_cbs[0].get_dataframe(real_ctx).equals(sync_df_builder.get_dataframe(sync_ctx))
+            self.assertEquals(len([c for c in parent.get_shifted_contexts()
+                                   if c.get_shift_set() in [s.get_shift_set() for s in sync_shifted_ctxs]]),
+                              len(shifts) - i)
+
+        self.assertRaises(IndexError, api.next_shift_result, "a")
+        api.release_run_contexts("a")
+        self.assertEquals(parent.get_shifted_contexts(), [])
+
+    def test_worker_pool_default_chunksize(self):
+        # by default the shifts are split evenly between the processes
+        # in chunks of no more than a few shifts
+        pool = WorkerPool(3)
+        self.assertEquals(pool._get_chunksize(7), 3)
+        self.assertEquals(pool._get_chunksize(9), 3)
+        self.assertEquals(pool._get_chunksize(2), 1)
+        self.assertEquals(pool._get_chunksize(300), 4)
+
+        # unless larger chunks are asked for
+        self.assertEquals(WorkerPool(3, chunksize=2)._get_chunksize(7), 2)
+        self.assertEquals(WorkerPool(3, chunksize=100)._get_chunksize(300), 100)
+
+    def _check_server_pool(self, pool, node, shifts, date_range):
+        df_builder = DataFrameBuilder([node])
+        shifted_ctxs = pool.run(date_range, [df_builder], shifts=shifts, ctx=self.ctx)
+
+        sync_df_builder = DataFrameBuilder([node])
+        sync_shifted_ctxs = run(date_range, [sync_df_builder], shifts=shifts, ctx=self.ctx)
+        self.assertEquals(shifted_ctxs, sync_shifted_ctxs)
+
+        for ctx in shifted_ctxs:
+            df = df_builder.get_dataframe(ctx)
+            sync_df = sync_df_builder.get_dataframe(ctx)
+            assert df.equals(sync_df)
+
+    def test_server_pool(self):
+        date_range = pd.bdate_range(datetime(1970, 1, 1), periods=5)
+        shifts = [{A: i, B: i * 2} for i in range(4)]
+
+        servers = [_start_worker() for i in range(3)]
+        try:
+            # one server dies before the run starts
+            servers[0][0].terminate()
+            servers[0][0].join()
+
+            uris = [str(proxy._pyroUri) for process, proxy in servers]
+            with ServerPool(uris) as pool:
+                self._check_server_pool(pool, X, shifts, date_range)
+                self.assertEquals(len(pool._workers), 2)
+        finally:
+            for process, proxy in servers:
+                process.terminate()
+
+    def test_server_pool_failover(self):
+        date_range = pd.bdate_range(datetime(1970, 1, 1), periods=10)
+        shifts = [{A: i, B: i * 2} for i in range(4)]
+
+        servers = [_start_worker() for i in range(2)]
+        try:
+            # one server dies while it's running some shifts
+            timer = threading.Timer(0.25, servers[0][0].terminate)
+            timer.start()
+
+            uris = [str(proxy._pyroUri) for process, proxy in servers]
+            with ServerPool(uris, heartbeat_interval=0.1) as pool:
+                self._check_server_pool(pool, SlowX, shifts, date_range)
+                self.assertEquals(len(pool._workers), 1)
+        finally:
+            for process, proxy in servers:
+                process.terminate()
+
+    def test_worker_pool_timeout(self):
+        date_range = pd.bdate_range(datetime(1970, 1, 1), periods=5)
+        shifts = [{A: i, B: i * 2} for i in range(4)]
+
+        # every chunk times out and is resubmitted while it's still running,
+        # which shouldn't count as a failed attempt
+        with WorkerPool(2, chunksize=1, timeout=0.01, max_attempts=1) as pool:
+            self._check_server_pool(pool, SlowX, shifts, date_range)
+            self.assertEquals(len(pool._workers), 2)
+
+    def test_heartbeat(self):
+        # a server that accepts connections but never responds
+        sock = socket.socket()
+        sock.bind(("localhost", 0))
+        sock.listen(1)
+        ping_timeout = mdf.remote.pool._ping_timeout
+        mdf.remote.pool._ping_timeout = 0.5
+        try:
+            worker = _Worker(Pyro4.Proxy("PYRO:obj@localhost:%d" % sock.getsockname()[1]))
+            worker.last_heartbeat = 0
+
+            # the ping is done in the background so checking doesn't wait for it
+            self.assertTrue(worker.check_heartbeat(10))
+
+            # until the ping times out
+            for i in range(100):
+                if not worker.check_heartbeat(10):
+                    break
+                time.sleep(0.05)
+            else:
+                self.fail("ping didn't time out")
+            worker.release()
+        finally:
+            mdf.remote.pool._ping_timeout = ping_timeout
+            sock.close()
+
+    def test_run_partitioned(self):
+        date_range = pd.bdate_range(datetime(1970, 1, 1), periods=20)
+        self.ctx[A] = 1
+        self.ctx[B] = 2
+
+        df_builder = DataFrameBuilder([X, RollingX])
+        final_values = FinalValueCollector([X, RollingX])
+        csv_fh = StringIO()
+        csv_writer = CSVWriter(csv_fh, [X, RollingX])
+
+        # the rolling window only depends on the last 3 dates so a warm-up
+        # of 2 dates should be enough to get the same results as a serial run
+        run_partitioned(date_range,
+                        [df_builder, final_values, csv_writer],
+                        ctx=self.ctx,
+                        num_partitions=3,
+                        warmup=2,
+                        verify_nodes=[RollingX])
+
+        # the verification run shouldn't have advanced the context
+        self.assertEquals(self.ctx.get_date(), date_range[0])
+
+        sync_df_builder = DataFrameBuilder([X, RollingX])
+        sync_final_values = FinalValueCollector([X, RollingX])
+        sync_csv_fh = StringIO()
+        sync_csv_writer = CSVWriter(sync_csv_fh, [X, RollingX])
+        run(date_range, [sync_df_builder, sync_final_values, sync_csv_writer], ctx=self.ctx)
+
+        df = df_builder.get_dataframe(self.ctx)
+        sync_df = sync_df_builder.get_dataframe(self.ctx)
+        self.assertEquals(len(df), len(date_range))
+        assert df.equals(sync_df)
+        self.assertEquals(final_values.get_values(self.ctx), sync_final_values.get_values(self.ctx))
+        self.assertEquals(csv_fh.getvalue(), sync_csv_fh.getvalue())
+
+        # dates with a time zone can be partitioned too
+        tz_date_range = list(pd.bdate_range(datetime(1970, 1, 1), periods=10, tz=pytz.utc))
+        tz_df_builder = DataFrameBuilder([X, RollingX])
+        tz_ctx = run_partitioned(tz_date_range,
+                                 [tz_df_builder],
+                                 values={A : 1, B : 2},
+                                 num_partitions=2,
+                                 warmup=2,
+                                 tzinfo=pytz.utc,
+                                 verify_nodes=[RollingX])
+        tz_df = tz_df_builder.get_dataframe(tz_ctx)
+        self.assertEquals(list(tz_df.index), tz_date_range)
+
+        # without enough warm-up the results won't match
+        self.assertRaises(Exception,
+                          run_partitioned,
+                          date_range,
+                          [DataFrameBuilder([RollingX])],
+                          ctx=self.ctx,
+                          num_partitions=3,
+                          verify_nodes=[RollingX])
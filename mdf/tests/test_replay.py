@@ -0,0 +1,80 @@
+"""
+Tests for replaying runs after changing inputs
+"""
+from mdf import (
+    MDFContext,
+    varnode,
+    evalnode,
+    run,
+    replay,
+    ReplayRecorder,
+    DataFrameBuilder,
+)
+
+import pandas as pa
+import unittest
+
+# this is necessary to stop namespace from looking
+# too far up the stack as it looks for the first frame
+# not in the mdf package
+__package__ = None
+
+A = varnode(default=1.0)
+B = varnode(default=2.0)
+
+num_calls_cum_b = 0
+
+@evalnode
+def cum_a():
+    total = 0.0
+    while True:
+        total += A()
+        yield total
+
+@evalnode
+def cum_b():
+    global num_calls_cum_b
+    total = 0.0
+    while True:
+        num_calls_cum_b += 1
+        total += B()
+        yield total
+
+@evalnode
+def total():
+    return cum_a() * cum_b()
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.daterange = pa.bdate_range("2014-01-01", periods=10)
+
+    def _run(self, **values):
+        builder = DataFrameBuilder([total])
+        ctx = MDFContext()
+        for name, value in values.items():
+            ctx[globals()[name]] = value
+        run(self.daterange, [builder], ctx=ctx)
+        return builder.get_dataframe(ctx)["total"]
+
+    def test_replay(self):
+        global num_calls_cum_b
+        recorder = ReplayRecorder()
+        builder = DataFrameBuilder([total])
+        ctx = MDFContext()
+        run(self.daterange, [builder, recorder], ctx=ctx)
+        self.assertEqual(list(recorder.get_values(total)),
+                         list(builder.get_dataframe(ctx)["total"]))
+
+        # only the nodes depending on A should be re-evaluated
+        num_calls_cum_b = 0
+        replayed = replay(recorder, {A : 2.0})
+        self.assertEqual(num_calls_cum_b, 0)
+        self.assertEqual(list(replayed.get_values(total)), list(self._run(A=2.0)))
+
+        # the original recording is unchanged
+        self.assertEqual(list(recorder.get_values(total)), list(self._run()))
+
+        # replayed runs can be replayed again
+        replayed = replay(replayed, {B : 3.0})
+        self.assertEqual(list(replayed.get_values(total)), list(self._run(A=2.0, B=3.0)))
@@ -0,0 +1,137 @@
+"""
+Tests for the custom Pyro serializer
+"""
+import unittest
+from mdf.remote.serializer import Serializer, BZ2Reader, _remove_all_shared_memory
+import numpy as np
+import bz2
+import pandas as pd
+import os
+
+class SerializerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.serializer = Serializer()
+        self.array = np.random.randn(250000)
+        self.df = pd.DataFrame({"x" : self.array, "y" : np.arange(len(self.array))})
+        self.prev_out_of_band = Serializer._out_of_band
+        self.prev_shared_memory_threshold = Serializer._shared_memory_threshold
+        self.prev_compression = Serializer._compression
+
+    def tearDown(self):
+        Serializer._out_of_band = self.prev_out_of_band
+        Serializer._shared_memory_threshold = self.prev_shared_memory_threshold
+        Serializer._compression = self.prev_compression
+
+    def _round_trip(self, data):
+        serialized, compressed = self.serializer.serialize(data)
+        return self.serializer.deserialize(serialized, compressed)
+
+    def test_small(self):
+        data = {"x" : [1, 2, 3], "y" : np.arange(3)}
+        serialized, compressed = self.serializer.serialize(data)
+        self.assertFalse(compressed)
+        result = self.serializer.deserialize(serialized, compressed)
+        self.assertEquals(result["x"], data["x"])
+        self.assertTrue((result["y"] == data["y"]).all())
+
+    def test_out_of_band(self):
+        fortran_array = np.asfortranarray(np.random.randn(300, 200))
+        data = (self.array, self.df, fortran_array, self.array)
+        result = self._round_trip(data)
+
+        self.assertTrue((result[0] == self.array).all())
+        self.assertTrue(result[1].equals(self.df))
+        self.assertTrue((result[2] == fortran_array).all())
+
+        # the same array should only be sent once and be the same object when loaded
+        self.assertTrue(result[0] is result[3])
+
+        # arrays should be writable
+        result[0][0] = 1.0
+
+    def test_no_copy(self):
+        Serializer._out_of_band = True
+        Serializer._compression = [(None, "none")]
+        serialized, compressed = self.serializer.serialize(self.array)
+
+        # arrays are views on the received data, so they're read-only
+        # if it's not writable
+        result = self.serializer.deserialize(bytes(serialized), compressed)
+        self.assertTrue((result == self.array).all())
+        self.assertFalse(result.flags.writeable)
+
+        result = self.serializer.deserialize(serialized, compressed)
+        self.assertTrue(result.flags.writeable)
+        serialized[-self.array.nbytes:] = np.zeros_like(self.array).tostring()
+        self.assertTrue((result == 0.0).all())
+
+    def test_frames(self):
+        Serializer._out_of_band = True
+        data = (self.array, self.df, {"x" : 1})
+        frames, compressed = self.serializer.serialize_frames(data)
+        self.assertTrue(compressed)
+        self.assertTrue(len(frames) > 2)
+
+        result = self.serializer.deserialize_frames([memoryview(bytearray(f)) for f in frames], compressed)
+        self.assertTrue((result[0] == self.array).all())
+        self.assertTrue(result[1].equals(self.df))
+        self.assertEquals(result[2], {"x" : 1})
+
+        frames, compressed = self.serializer.serialize_frames({"x" : 1})
+        self.assertEquals(self.serializer.deserialize_frames(frames, compressed), {"x" : 1})
+
+    def test_compression(self):
+        # compressible data larger than the uncompressed size should be compressed
+        data = np.zeros(1 << 20)
+        serialized, compressed = self.serializer.serialize(data)
+        self.assertTrue(len(serialized) < data.nbytes / 10)
+        self.assertTrue((self.serializer.deserialize(serialized, compressed) == data).all())
+
+    def _get_shared_memory_files(self):
+        return set(f for f in os.listdir(Serializer._shared_memory_dir) if f.startswith("mdf-pyro-"))
+
+    def test_shared_memory(self):
+        if Serializer._shared_memory_dir is None:
+            self.skipTest("shared memory isn't available")
+        Serializer._shared_memory_threshold = 1 << 20
+        files = self._get_shared_memory_files()
+        serialized, compressed = self.serializer.serialize(self.array)
+        self.assertTrue(len(serialized) < self.array.nbytes)
+        result = self.serializer.deserialize(serialized, compressed)
+        self.assertTrue((result == self.array).all())
+        self.assertEquals(self._get_shared_memory_files(), files)
+
+        # files for messages that are never loaded are removed at exit
+        self.serializer.serialize(self.array)
+        self.assertNotEquals(self._get_shared_memory_files(), files)
+        _remove_all_shared_memory()
+        self.assertEquals(self._get_shared_memory_files(), files)
+
+    def test_bz2_reader(self):
+        lines = [("line %d\n" % i).encode("ascii") * (i % 7) for i in range(20000)]
+        data = b"".join(lines)
+        reader = BZ2Reader(bz2.compress(data))
+        reader._block_size = 1000
+
+        self.assertEquals(reader.read(5), data[:5])
+        self.assertEquals(reader.readline(), data[5:data.index(b"\n") + 1])
+        pos = data.index(b"\n") + 1
+
+        buf = bytearray(100000)
+        self.assertEquals(reader.readinto(buf), len(buf))
+        self.assertEquals(bytes(buf), data[pos:pos + len(buf)])
+        pos += len(buf)
+
+        self.assertEquals(reader.readline(3), data[pos:pos + 3])
+        pos += 3
+
+        self.assertEquals(reader.read(), data[pos:])
+        self.assertEquals(reader.read(10), b"")
+        self.assertEquals(reader.readline(), b"")
+
+    def test_bz2(self):
+        Serializer._out_of_band = False
+        result = self._round_trip([self.array, self.df])
+        self.assertTrue((result[0] == self.array).all())
+        self.assertTrue(result[1].equals(self.df))
@@ -0,0 +1,75 @@
+"""
+Tests for parameter sweeps using successive halving
+"""
+from mdf import (
+    MDFContext,
+    varnode,
+    evalnode,
+    sweep,
+    DataFrameBuilder,
+)
+
+import pandas as pa
+import numpy as np
+import unittest
+
+# this is necessary to stop namespace from looking
+# too far up the stack as it looks for the first frame
+# not in the mdf package
+__package__ = None
+
+X = varnode(default=1.0)
+
+num_calls_total = 0
+
+@evalnode
+def total():
+    global num_calls_total
+    t = 0.0
+    while True:
+        num_calls_total += 1
+        t += X()
+        yield t
+
+class SweepTest(unittest.TestCase):
+
+    def setUp(self):
+        global num_calls_total
+        num_calls_total = 0
+        self.daterange = pa.bdate_range("2014-01-01", periods=40)
+        self.shifts = [{X: float(x)} for x in range(1, 9)]
+
+    def test_sweep(self):
+        builder = DataFrameBuilder([total])
+        contexts = sweep(self.daterange,
+                         total,
+                         self.shifts,
+                         callbacks=[builder],
+                         ctx=MDFContext())
+
+        # 8 shifts halved each round leaves a single shift for the last round
+        self.assertEqual(len(contexts), 1)
+        ctx = contexts[0]
+        self.assertEqual(ctx[X], 8.0)
+
+        # the surviving context shouldn't have been restarted
+        self.assertEqual(ctx[total], 8.0 * len(self.daterange))
+        df = builder.get_dataframe(ctx)
+        self.assertEqual(len(df), len(self.daterange))
+        self.assertEqual(list(df["total"]), [8.0 * (i + 1) for i in range(len(self.daterange))])
+
+        # the dropped shifts should have stopped being evaluated
+        self.assertTrue(num_calls_total < len(self.shifts) * len(self.daterange) / 2)
+
+    def test_sweep_minimize(self):
+        contexts = sweep(self.daterange,
+                         total,
+                         self.shifts,
+                         ctx=MDFContext(),
+                         num_rounds=2,
+                         maximize=False,
+                         min_survivors=2)
+
+        self.assertEqual([c[X] for c in contexts], [1.0, 2.0, 3.0, 4.0])
+        self.assertEqual([c[total] for c in contexts],
+                         [x * len(self.daterange) for x in (1.0, 2.0, 3.0, 4.0)])
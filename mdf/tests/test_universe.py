@@ -0,0 +1,178 @@
+"""
+Tests for cross-sectional values aligned to a fixed universe
+"""
+from mdf import (
+    MDFContext,
+    evalnode,
+    datanode,
+    panelnode,
+    delaynode,
+    now,
+    run,
+    Universe,
+    PanelArray,
+    DataFrameBuilder,
+)
+
+from numpy.testing.utils import assert_almost_equal
+import pandas as pa
+import numpy as np
+import unittest
+import cPickle
+
+# this is necessary to stop namespace from looking
+# too far up the stack as it looks for the first frame
+# not in the mdf package
+__package__ = None
+
+assets = Universe(["A", "B", "C"])
+
+_index = pa.bdate_range("2014-01-01", periods=10)
+
+# the data has an extra column not in the universe and is missing "C"
+_prices_df = pa.DataFrame({
+    "B" : np.arange(10, dtype=float) + 100.0,
+    "A" : [1.0, np.nan, 3.0, 4.0, np.nan, 6.0, 7.0, 8.0, 9.0, 10.0],
+    "D" : np.arange(10, dtype=float),
+}, index=_index)
+
+prices = datanode("prices", _prices_df, universe=assets)
+prices_df = datanode("prices_df", _prices_df[["A", "B"]].reindex(columns=assets.index))
+
+@delaynode(periods=1, initial_value=np.nan)
+def prev_prices():
+    return prices()
+
+@evalnode
+def weights():
+    return pa.Series({"C" : 0.5, "A" : 0.25})
+
+@panelnode(universe=assets, fill_value=0.0)
+def aligned_weights():
+    return weights()
+
+@evalnode
+def plain():
+    return np.arange(3, dtype=float)
+
+@evalnode
+def panel():
+    return assets.wrap(np.ones(3))
+
+@evalnode
+def changing_universe():
+    # the universe changes from the second date
+    if now() > _index[0]:
+        return Universe(["C", "B", "A"]).align(1.0)
+    return assets.align(1.0)
+
+class UniverseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = MDFContext(_index[0])
+
+    def _run(self, *nodes):
+        builder = DataFrameBuilder(list(nodes))
+        run(_index, [builder], ctx=self.ctx)
+        return builder
+
+    def test_universe(self):
+        self.assertTrue(Universe(["A", "B", "C"]) is assets)
+        self.assertTrue(Universe(assets) is assets)
+        self.assertFalse(Universe(["C", "B", "A"]) is assets)
+        self.assertTrue(cPickle.loads(cPickle.dumps(assets)) is assets)
+        self.assertRaises(ValueError, Universe, ["A", "A"])
+
+    def test_align(self):
+        value = assets.align(pa.Series({"C" : 3.0, "A" : 1.0}))
+        self.assertTrue(isinstance(value, PanelArray))
+        self.assertTrue(value.universe is assets)
+        assert_almost_equal(value, [1.0, np.nan, 3.0])
+
+        other = Universe(["C", "A"])
+        assert_almost_equal(other.align(value), [3.0, 1.0])
+        assert_almost_equal(assets.align(other.align(value), fill_value=0.0), [1.0, 0.0, 3.0])
+        assert_almost_equal(assets.align(2.0), [2.0, 2.0, 2.0])
+        self.assertRaises(ValueError, assets.align, np.zeros(2))
+
+        # operations keep the universe, but values for different universes can't be combined
+        result = value * 2.0 + value
+        self.assertTrue(result.universe is assets)
+        self.assertRaises(ValueError, lambda: value + Universe(["C", "B", "A"]).align(1.0))
+
+        unpickled = cPickle.loads(cPickle.dumps(result))
+        self.assertTrue(unpickled.universe is assets)
+        assert_almost_equal(unpickled, result)
+
+        series = result.to_series()
+        self.assertEqual(list(series.index), ["A", "B", "C"])
+        assert_almost_equal(series.values, [3.0, np.nan, 9.0])
+
+    def test_datanode(self):
+        for date in _index:
+            self.ctx.set_date(date)
+            value = self.ctx[prices]
+            self.assertTrue(isinstance(value, PanelArray))
+            self.assertTrue(value.universe is assets)
+            assert_almost_equal(value, self.ctx[prices_df].values)
+
+        # dates not in the data should be missing for all labels
+        self.ctx.set_date(_index[-1] + pa.datetools.BDay())
+        assert_almost_equal(self.ctx[prices], [np.nan, np.nan, np.nan])
+
+    def test_node_types(self):
+        nodes = [
+            (prices.ffillnode(), prices_df.ffillnode()),
+            (prices.nansumnode(), prices_df.nansumnode()),
+            (prices.returnsnode(), prices_df.returnsnode()),
+            (prices.delaynode(periods=2, initial_value=np.nan),
+             prices_df.delaynode(periods=2, initial_value=np.nan)),
+            ((prices - prev_prices) / prev_prices, None),
+        ]
+        for date in _index:
+            self.ctx.set_date(date)
+            for node, expected_node in nodes:
+                value = self.ctx[node]
+                self.assertTrue(isinstance(value, PanelArray), node.name)
+                self.assertTrue(value.universe is assets, node.name)
+                if expected_node is not None:
+                    assert_almost_equal(value, self.ctx[expected_node].values)
+
+        prev = _prices_df.reindex(columns=assets.index).values[-2]
+        current = _prices_df.reindex(columns=assets.index).values[-1]
+        assert_almost_equal(self.ctx[(prices - prev_prices) / prev_prices], (current - prev) / prev)
+
+    def test_universe_changes(self):
+        node = changing_universe.nansumnode()
+        assert_almost_equal(self.ctx[node], [1.0, 1.0, 1.0])
+        self.assertRaises(ValueError, self.ctx.set_date, _index[1])
+
+    def test_fused_expressions(self):
+        # expressions mixing plain arrays and PanelArrays should keep the
+        # universe whichever operand the results are written to
+        for node, expected in [(plain * 2.0 + panel, [1.0, 3.0, 5.0]),
+                               ((plain + 1.0) * panel, [1.0, 2.0, 3.0]),
+                               (panel * 2.0 + plain, [2.0, 3.0, 4.0]),
+                               (-plain - panel, [-1.0, -2.0, -3.0])]:
+            value = self.ctx[node]
+            self.assertTrue(isinstance(value, PanelArray), node.name)
+            self.assertTrue(value.universe is assets, node.name)
+            assert_almost_equal(value, expected)
+
+        # the results should be converted to series by the builders
+        builder = self._run(plain * 2.0 + panel)
+        df = builder.get_dataframe(self.ctx)
+        self.assertEqual(sorted(df.columns), ["A", "B", "C"])
+
+    def test_panelnode(self):
+        value = self.ctx[aligned_weights]
+        self.assertTrue(value.universe is assets)
+        assert_almost_equal(value, [0.25, 0.0, 0.5])
+        assert_almost_equal(self.ctx[weights.panelnode(universe=assets)], [0.25, np.nan, 0.5])
+
+    def test_dataframe_builder(self):
+        builder = self._run(prices)
+        df = builder.get_dataframe(self.ctx)
+        self.assertEqual(sorted(df.columns), ["A", "B", "C"])
+        assert_almost_equal(df[["A", "B", "C"]].values.astype(float),
+                            _prices_df.reindex(columns=assets.index).values)
@@ -0,0 +1,173 @@
+"""
+Tests for running shifts vectorized
+"""
+from mdf import (
+    MDFContext,
+    varnode,
+    evalnode,
+    scenario,
+    run,
+    non_vectorizable,
+    DataFrameBuilder,
+)
+
+from numpy.testing.utils import assert_almost_equal
+import pandas as pa
+import numpy as np
+import unittest
+import cPickle
+
+# this is necessary to stop namespace from looking
+# too far up the stack as it looks for the first frame
+# not in the mdf package
+__package__ = None
+
+X = varnode(default=1.0)
+Y = varnode(default=1.0)
+
+num_calls_total = 0
+
+@evalnode
+def total():
+    global num_calls_total
+    t = 0.0
+    while True:
+        num_calls_total += 1
+        t += X() * Y()
+        yield t
+
+@non_vectorizable
+@evalnode
+def capped():
+    # uses the value in a condition so can't be evaluated with arrays
+    return min(total(), 50.0)
+
+@evalnode
+def result():
+    return capped() + X()
+
+@evalnode
+def unshifted():
+    return 2.0
+
+@evalnode
+def total_mean():
+    # reduces across the scenarios when vectorized
+    return np.mean(total())
+
+@evalnode
+def total_first():
+    # loses the scenario axis when vectorized
+    return np.atleast_1d(total())[:1] * 2.0
+
+class VectorizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.daterange = pa.bdate_range("2014-01-01", periods=20)
+        self.x_shifts = [1.0, 2.0, 3.0]
+        self.y_shifts = [0.5, 1.0]
+
+    def test_scenario(self):
+        global num_calls_total
+        expected = scenario(self.daterange,
+                            total,
+                            X, self.x_shifts,
+                            Y, self.y_shifts)
+
+        num_calls_total = 0
+        actual = scenario(self.daterange,
+                          total,
+                          X, self.x_shifts,
+                          Y, self.y_shifts,
+                          vectorize=True)
+
+        assert_almost_equal(actual, expected)
+
+        # total should only have been evaluated once per date for all shifts
+        self.assertEqual(num_calls_total, len(self.daterange))
+
+    def test_non_vectorizable(self):
+        expected = scenario(self.daterange,
+                            result,
+                            X, self.x_shifts,
+                            Y, self.y_shifts)
+
+        actual = scenario(self.daterange,
+                          result,
+                          X, self.x_shifts,
+                          Y, self.y_shifts,
+                          vectorize=True)
+
+        assert_almost_equal(actual, expected)
+
+    def test_run(self):
+        shifts = [{X: x} for x in self.x_shifts]
+        nodes = [total, capped, result, unshifted]
+
+        builder = DataFrameBuilder(nodes)
+        expected_ctxs = run(self.daterange, [builder], shifts=shifts, ctx=MDFContext())
+
+        vectorized_builder = DataFrameBuilder(nodes)
+        actual_ctxs = run(self.daterange,
+                          [vectorized_builder],
+                          shifts=shifts,
+                          ctx=MDFContext(),
+                          vectorize=True)
+
+        self.assertEqual(len(actual_ctxs), len(shifts))
+        for expected_ctx, actual_ctx in zip(expected_ctxs, actual_ctxs):
+            self.assertTrue(isinstance(actual_ctx, MDFContext))
+            expected = builder.get_dataframe(expected_ctx)
+            actual = vectorized_builder.get_dataframe(actual_ctx)
+            self.assertEqual(list(actual.columns), list(expected.columns))
+            assert_almost_equal(actual.values, expected.values)
+
+    def test_reduced(self):
+        shifts = [{X: x} for x in self.x_shifts]
+
+        def get_values(vectorize):
+            values = []
+            def callback(date, ctx):
+                if date == self.daterange[-1]:
+                    values.append((ctx[total_mean], ctx[total_first]))
+            run(self.daterange, [callback], shifts=shifts, ctx=MDFContext(), vectorize=vectorize)
+            return values
+
+        expected = get_values(False)
+        actual = get_values(True)
+
+        # the values that don't have the scenario axis are evaluated in each
+        # scenario rather than getting the value reduced across all of them
+        self.assertEqual(len(actual), len(shifts))
+        assert_almost_equal(actual, expected)
+
+    def test_contexts(self):
+        shifts = [{X: x} for x in self.x_shifts]
+        ctx = MDFContext()
+        seen = []
+
+        def callback(date, shifted_ctx):
+            seen.append((shifted_ctx, shifted_ctx.get_shift_set(), shifted_ctx[total]))
+
+        ctxs = run(self.daterange, [callback], shifts=shifts, ctx=ctx, vectorize=True)
+
+        # the callbacks get the shifted contexts with the value for each shift
+        for shifted_ctx, shift_set, value in seen[-len(shifts):]:
+            self.assertTrue(isinstance(shifted_ctx, MDFContext))
+            self.assertTrue(shifted_ctx.get_parent() is ctx)
+            self.assertEqual(value, shift_set[X] * len(self.daterange))
+
+        # the stacked context is released after the run, and running the
+        # same shifts again re-uses the same contexts
+        self.assertEqual(sorted(ctx.get_shifted_contexts()), sorted(ctxs))
+        ctxs2 = run(self.daterange, [callback], shifts=shifts, ctx=ctx, vectorize=True)
+        self.assertEqual(ctxs2, ctxs)
+        self.assertEqual(sorted(ctx.get_shifted_contexts()), sorted(ctxs))
+
+        # the shifted contexts are pickled as normal contexts
+        unpickled = cPickle.loads(cPickle.dumps(ctxs[0]))
+        self.assertTrue(type(unpickled) is MDFContext)
+
+    def test_different_shifts(self):
+        shifts = [{X: 1.0}, {Y: 1.0}]
+        self.assertRaises(Exception, run, self.daterange, [], shifts=shifts, vectorize=True)
@@ -0,0 +1,152 @@
+"""
+Fixed universes for cross-sectional values.
+
+A :py:class:`Universe` is an interned index of labels (e.g. the assets in
+a portfolio) shared by all the nodes whose values are indexed by it.
+Values for a universe are stored as :py:class:`PanelArray` objects, which
+are numpy arrays aligned to the universe's labels. Arithmetic on them is
+done on the arrays directly without the alignment and boxing costs of
+pandas, and they are only converted to Series by builders and the viewer.
+
+Values can be aligned to a universe using :py:func:`mdf.panelnode`, or
+read from a DataFrame using the `universe` argument to
+:py:func:`mdf.datanode` or :py:func:`mdf.rowiternode`.
+"""
+import numpy as np
+import pandas as pa
+import threading
+
+_universes = {}
+_universes_lock = threading.Lock()
+
+class Universe(object):
+    """
+    An ordered set of labels that cross-sectional values are aligned to.
+
+    Universes are interned, so constructing a Universe with the same labels
+    as an existing one returns the existing Universe.
+    """
+
+    def __new__(cls, labels):
+        if isinstance(labels, Universe):
+            return labels
+
+        index = pa.Index(labels)
+        if not index.is_unique:
+            raise ValueError("Universe labels must be unique")
+
+        key = tuple(index)
+        with _universes_lock:
+            universe = _universes.get(key)
+            if universe is None:
+                universe = object.__new__(cls)
+                universe.index = index
+                universe._indexers = {}
+                _universes[key] = universe
+            return universe
+
+    def __reduce__(self):
+        return (Universe, (list(self.index),))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        return "<Universe of %d labels at 0x%x>" % (len(self), id(self))
+
+    def align(self, value, fill_value=np.nan):
+        """
+        Returns value as a :py:class:`PanelArray` aligned to this universe.
+
+        value may be a Series, a PanelArray for another universe, an array
+        already in the order of the universe or a scalar. Labels in the
+        universe missing from value are set to fill_value.
+        """
+        if isinstance(value, PanelArray):
+            if value.universe is self:
+                return value
+            if value.universe is not None:
+                indexer = self._get_indexer(value.universe)
+                result = np.asarray(value).take(indexer, axis=-1)
+                return self._fill_missing(result, indexer, fill_value)
+
+        if isinstance(value, pa.Series):
+            indexer = value.index.get_indexer(self.index)
+            result = value.values.take(indexer)
+            return self._fill_missing(result, indexer, fill_value)
+
+        if isinstance(value, np.ndarray):
+            if value.ndim == 0 or value.shape[-1] != len(self):
+                raise ValueError("Can't align an array of shape %s to a universe of %d labels"
+                                    % (value.shape, len(self)))
+            return self.wrap(value)
+
+        result = np.empty(len(self), dtype=np.result_type(value))
+        result.fill(value)
+        return self.wrap(result)
+
+    def wrap(self, array):
+        """returns a PanelArray for this universe that's a view of an array"""
+        result = np.asarray(array).view(PanelArray)
+        result.universe = self
+        return result
+
+    def _get_indexer(self, other):
+        # the indexers are cached as universes are fixed
+        indexer = self._indexers.get(other)
+        if indexer is None:
+            indexer = self._indexers[other] = other.index.get_indexer(self.index)
+        return indexer
+
+    def _fill_missing(self, result, indexer, fill_value):
+        missing = indexer == -1
+        if missing.any():
+            if not np.can_cast(np.result_type(fill_value), result.dtype):
+                result = result.astype(np.result_type(result, fill_value))
+            result[..., missing] = fill_value
+        return self.wrap(result)
+
+class PanelArray(np.ndarray):
+    """
+    Numpy array of values aligned to a :py:class:`Universe`.
+
+    The result of any numpy operation on PanelArrays has the same universe
+    as its inputs, and combining PanelArrays for different universes
+    raises a ValueError.
+    """
+
+    universe = None
+
+    def __array_finalize__(self, obj):
+        # slices or reductions that don't have a value for every label
+        # in the universe are no longer aligned to it
+        universe = getattr(obj, "universe", None)
+        if universe is not None and self.ndim > 0 and self.shape[-1] == len(universe):
+            self.universe = universe
+
+    def __array_prepare__(self, array, context=None):
+        if context is not None:
+            universes = set(x.universe for x in context[1] if isinstance(x, PanelArray)) - set([None])
+            if len(universes) > 1:
+                raise ValueError("Can't combine values for different universes")
+        return np.ndarray.__array_prepare__(self, array, context)
+
+    def __array_wrap__(self, array, context=None):
+        # return scalars rather than 0d arrays
+        if array.ndim == 0:
+            return array[()]
+        return np.ndarray.__array_wrap__(self, array, context)
+
+    def __reduce__(self):
+        return (_unpickle_panel_array, (np.asarray(self), self.universe))
+
+    def to_series(self):
+        """returns the values as a pandas Series indexed by the universe's labels"""
+        if self.universe is None or self.ndim != 1:
+            raise ValueError("Only 1d values aligned to a universe can be converted to a Series")
+        return pa.Series(np.asarray(self), index=self.universe.index)
+
+def _unpickle_panel_array(array, universe):
+    if universe is None:
+        return array.view(PanelArray)
+    return universe.wrap(array)
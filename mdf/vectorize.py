@@ -0,0 +1,219 @@
+"""
+Support for evaluating many shifts of the same varnodes as a single
+'stacked' context.
+
+Instead of evaluating the graph once per shifted context, each shifted
+varnode is set to an array of its shifted values with a leading scenario
+axis and the graph is evaluated once in a single context. Any node built
+from numpy arithmetic of the shifted varnodes then evaluates to an array
+of values for all the shifts at once.
+
+Nodes that can't be evaluated like this (e.g. because they use the values
+of the shifted varnodes in conditional statements) should be marked using
+:py:func:`non_vectorizable`. Those nodes are evaluated in each shifted
+context separately and their values are stacked for any vectorized nodes
+that depend on them.
+
+Nodes whose stacked values don't have the leading scenario axis (e.g.
+because they reduce across it) are also evaluated in each shifted context
+separately when their values are requested.
+"""
+from .context import MDFContext
+from .nodes import MDFNode, MDFVarNode, MDFEvalNode, _get_node_alt_context
+from .ctx_pickle import _pickle_context, _unpickle_context
+from collections import OrderedDict
+import numpy as np
+import itertools
+import weakref
+
+# nodes that have to be evaluated in each shifted context separately
+_non_vectorizable_nodes = set()
+
+# used to give the nodes created for each run unique names
+_node_counter = itertools.count()
+
+def non_vectorizable(node):
+    """
+    Marks a node as not being suitable for evaluating with vectorized
+    shifts (see :py:func:`run`). Can be used as a decorator::
+
+        @non_vectorizable
+        @evalnode
+        def my_node():
+            if x() > 0:
+                ...
+    """
+    assert isinstance(node, MDFNode), "non_vectorizable can only be used with nodes"
+    _non_vectorizable_nodes.add(node)
+    return node
+
+class _ScenarioContext(MDFContext):
+    """
+    The shifted context for one of the shifts when running with vectorized
+    shifts. Values of nodes that depend on the shifted nodes are taken from
+    the stacked context and the value for this context's shift is selected
+    from them. Other nodes are evaluated in this context as usual, and once
+    the run has finished (see _release_scenario_contexts) it behaves the
+    same as any other shifted context.
+    """
+
+    def __init__(self, ctx, shift_set):
+        # cached so the alt contexts of nodes evaluated in this context are
+        # this context rather than another one with the same shifts
+        MDFContext.__init__(self, ctx.get_date(),
+                            _shift_parent=ctx,
+                            _shift_set=shift_set,
+                            _cache_shifted=True)
+        self.__stacked_ctx = None
+        self.__index = None
+        self.__num_scenarios = None
+
+    def __reduce__(self):
+        # pickled as a plain context as the stacked context isn't
+        args = _pickle_context(self)
+        return (_unpickle_context, (MDFContext,) + tuple(args[1:]), None, None, None)
+
+    def _get_stacked_context(self):
+        return self.__stacked_ctx
+
+    def _set_stacked_context(self, stacked_ctx, index, num_scenarios):
+        self.__stacked_ctx = stacked_ctx
+        self.__index = index
+        self.__num_scenarios = num_scenarios
+
+    def get_value(self, node):
+        stacked_ctx = self.__stacked_ctx
+        if stacked_ctx is None or node in _non_vectorizable_nodes:
+            return MDFContext.get_value(self, node)
+
+        value = stacked_ctx.get_value(node)
+
+        # only values that depend on the shifted nodes are stacked, and those
+        # don't belong to the unshifted context
+        if _get_node_alt_context(node, stacked_ctx) is stacked_ctx.get_parent():
+            return value
+
+        # if the value doesn't have the scenario axis it can't be split into
+        # the value for each scenario, so it's evaluated in this context instead
+        if np.ndim(value) == 0 or len(value) != self.__num_scenarios:
+            return MDFContext.get_value(self, node)
+
+        return value[self.__index]
+
+class _ScenarioNodes(object):
+    """
+    The nodes used to override the shifted nodes and non-vectorizable nodes
+    in the stacked context for a set of shifts, and the _ScenarioContexts
+    the non-vectorizable nodes are evaluated in.
+
+    The contexts are only weakly referenced so the cache of these doesn't
+    keep the contexts alive.
+    """
+
+    def __init__(self, shifted_nodes, shifts):
+        self.__context_refs = []
+
+        # each shifted node is overridden with a node that holds all the shifted values
+        run_id = next(_node_counter)
+        self.stacked_shift = {}
+        for node in shifted_nodes:
+            values = np.array([shift[node] for shift in shifts])
+            name = "%s.__scenarios_%d__" % (node.name, run_id)
+            self.stacked_shift[node] = MDFVarNode(name, default=values)
+
+        # and any nodes that can't be vectorized are overridden with a node that
+        # evaluates them in each of the scenario contexts
+        for node in _non_vectorizable_nodes:
+            name = "%s.__scenarios_%d__" % (node.name, run_id)
+            self.stacked_shift[node] = MDFEvalNode(self.__get_stacked_value_func(node), name=name)
+
+        # the generated nodes aren't needed by anything else
+        for node in self.stacked_shift.values():
+            MDFContext.unregister_node(node)
+
+    def __get_stacked_value_func(self, node):
+        """returns a function that stacks the values of node in all the scenario contexts"""
+        def stacked_value():
+            return np.array([MDFContext.get_value(ctx, node) for ctx in self.get_contexts()])
+        return stacked_value
+
+    def get_contexts(self):
+        """returns the scenario contexts, or an empty list if any have been deleted"""
+        contexts = [ref() for ref in self.__context_refs]
+        if None in contexts:
+            return []
+        return contexts
+
+    def set_contexts(self, contexts):
+        self.__context_refs = [weakref.ref(ctx) for ctx in contexts]
+
+# generated nodes for the most recently used sets of shifts, so running the
+# same shifts again doesn't create new nodes and contexts
+_scenario_nodes_cache = OrderedDict()
+_max_cached_scenario_nodes = 8
+
+def _get_scenario_nodes(shifted_nodes, shifts):
+    """returns the _ScenarioNodes for shifts, from the cache if possible"""
+    key = (tuple(shifted_nodes),
+           tuple(tuple(shift[node] for node in shifted_nodes) for shift in shifts),
+           frozenset(_non_vectorizable_nodes))
+    try:
+        scenario_nodes = _scenario_nodes_cache.pop(key)
+    except TypeError:
+        # the shift values can't be used as a key
+        return _ScenarioNodes(shifted_nodes, shifts)
+    except KeyError:
+        scenario_nodes = _ScenarioNodes(shifted_nodes, shifts)
+
+    _scenario_nodes_cache[key] = scenario_nodes
+    while len(_scenario_nodes_cache) > _max_cached_scenario_nodes:
+        _scenario_nodes_cache.popitem(last=False)
+    return scenario_nodes
+
+def _make_scenario_contexts(ctx, shift_sets):
+    """
+    returns a list of _ScenarioContext objects to use in place of
+    the shifted contexts for each shift set.
+
+    The shift sets must all shift the same nodes and the shifted values
+    can't be nodes.
+    """
+    shifts = [dict(shift_set) for shift_set in shift_sets]
+    shifted_nodes = sorted(shifts[0].keys(), key=lambda n: n.name)
+    for shift in shifts:
+        if set(shift.keys()) != set(shifted_nodes):
+            raise Exception("Vectorized shifts must all shift the same nodes")
+        for node, value in shift.items():
+            if isinstance(value, MDFNode):
+                raise Exception("Vectorized shifts can't be node overrides (%s)" % node.name)
+
+    # the contexts from the last run of the same shifts are re-used if
+    # they're still shifted contexts of ctx
+    scenario_nodes = _get_scenario_nodes(shifted_nodes, shifts)
+    contexts = scenario_nodes.get_contexts()
+    if not contexts or not set(contexts).issubset(ctx.iter_shifted_contexts()):
+        contexts = [_ScenarioContext(ctx, shift) for shift in shifts]
+        scenario_nodes.set_contexts(contexts)
+
+    stacked_ctx = ctx.shift(scenario_nodes.stacked_shift)
+    for i, scenario_ctx in enumerate(contexts):
+        scenario_ctx._set_stacked_context(stacked_ctx, i, len(contexts))
+    return contexts
+
+def _release_scenario_contexts(contexts):
+    """
+    releases the stacked context used by a list of contexts returned
+    by _make_scenario_contexts once they've been run.
+    """
+    stacked_ctx = contexts[0]._get_stacked_context()
+    for ctx in contexts:
+        ctx._set_stacked_context(None, None, None)
+
+    # the stacked context, and any other contexts shifted by the generated
+    # nodes, are only used for the one run so are removed from the parent
+    if stacked_ctx is not None:
+        parent = stacked_ctx.get_parent()
+        generated_nodes = set(stacked_ctx.get_shift_set().values())
+        parent._release_shifted_contexts([ctx for ctx in parent.get_shifted_contexts()
+                                          if any(isinstance(value, MDFNode) and value in generated_nodes
+                                                 for value in ctx.get_shift_set().values())])
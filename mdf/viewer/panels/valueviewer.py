@@ -11,6 +11,7 @@ from collections import deque
 import numpy as np
 from ..mixins import GridCopyMixin
 from ...nodes import MDFNode
+from ...universe import PanelArray
 
 _default_float_format = "%.9f"
 
@@ -71,6 +72,10 @@ class NodeValueViewer(wx.Panel):
         if node.has_value(ctx) and not node.is_dirty(ctx):
             value = ctx[node]
 
+        # show values aligned to a universe with their labels
+        if isinstance(value, PanelArray):
+            value = value.to_series()
+
         # get the type of the current value
         self.curr_type = _get_type_name(value)
 
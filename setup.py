@@ -33,6 +33,7 @@ if __name__ == "__main__":
         Extension("mdf.nodetypes", ["mdf/nodetypes.py"]),
         Extension("mdf.ctx_pickle", ["mdf/ctx_pickle.py"]),
         Extension("mdf.cqueue", ["mdf/cqueue.py"]),
+        Extension("mdf.memory", ["mdf/memory.py"]),
     ]
 
     for e in ext_modules: